@@ -0,0 +1,409 @@
+"""
+Processing backends of the clip cuts and the video/audio merges: ffmpeg run as a
+subprocess, or libav called in-process through PyAV
+"""
+
+import os
+import time
+import shlex
+import logging
+import tempfile
+import subprocess
+from abc import ABC, abstractmethod
+from fractions import Fraction
+
+from metrics import METRICS, FPS_BUCKETS
+
+DEFAULT_BACKEND = 'subprocess'  # 'subprocess': one ffmpeg process per run, 'pyav': libav in-process
+
+
+def secs_to_timestr(secs):
+    """Format seconds as an ffmpeg HH:MM:SS.cc time string"""
+    hrs = secs // (60 * 60)
+    min = (secs - hrs * 3600) // 60
+    sec = secs % 60
+    end = (secs - int(secs)) * 100
+    return "{:02d}:{:02d}:{:02d}.{:02d}".format(int(hrs), int(min), int(sec), int(end))
+
+
+def encoder_cli_args(encoder):
+    """
+    ffmpeg output options of an encode
+
+    Args:
+        encoder: {'threads', 'codec', 'preset', 'crf'} and optionally 'gop' (fixed GOP without
+            scene-cut keyframes), 'pix_fmt' and 'faststart'
+
+    Returns:
+        list: ffmpeg arguments
+    """
+    args = ['-threads', str(encoder['threads']), '-c:v', encoder['codec'], '-preset', encoder['preset'],
+            '-crf', str(encoder['crf'])]
+    gop = encoder.get('gop')
+    if gop:
+        args += ['-g', str(gop), '-keyint_min', str(gop), '-sc_threshold', '0']
+        if encoder['codec'] == 'libx265':
+            # x265 ignores the generic options above
+            args += ['-x265-params', f"keyint={gop}:min-keyint={gop}:scenecut=0"]
+    if encoder.get('pix_fmt'):
+        args += ['-pix_fmt', encoder['pix_fmt']]
+    if encoder.get('faststart'):
+        args += ['-movflags', '+faststart']
+    return args
+
+
+def observe_fps(fps):
+    """Record the frames per second of a finished encode"""
+    if fps > 0:
+        METRICS.observe('ffmpeg_fps', fps, buckets=FPS_BUCKETS)
+        METRICS.set_gauge('ffmpeg_last_fps', fps)
+
+
+class ProcessingBackend(ABC):
+    """
+    Engine that cuts clips out of raw videos and muxes merged clips.
+
+    A clip is a dict: {'save_name', 'out_path', 'start' and 'end' (seconds in the raw video),
+    'seek' (seconds the input may be seeked to before decoding, 0 to decode from the start),
+    'filters' (ffmpeg video filter chain: crop, then fps and scale of the encode profile)}.
+    Every decoded frame written to an output counts in ffmpeg_frames_total as it is encoded,
+    and progress, when given, is called with (save_name, frames written so far).
+    """
+
+    name = None
+    shares_demuxer = False  # True if cut_clips reads the raw video once for all clips
+
+    @abstractmethod
+    def cut_clip(self, raw_vid_path, clip, encoder, progress=None):
+        """
+        Cut, crop and encode one clip
+
+        Returns:
+            bool: True if the clip was written
+        """
+
+    def cut_clips(self, raw_vid_path, clips, encoder, progress=None):
+        """
+        Cut, crop and encode several clips of one raw video
+
+        Returns:
+            dict: {save_name: True if the clip was written}
+        """
+        return {clip['save_name']: self.cut_clip(raw_vid_path, clip, encoder, progress) for clip in clips}
+
+    @abstractmethod
+    def merge(self, video_path, audio_path, output_path):
+        """
+        Mux the video of video_path with the audio of audio_path, both copied, up to the
+        shorter of the two
+
+        Returns:
+            bool: True if output_path was written
+        """
+
+
+class SubprocessBackend(ProcessingBackend):
+    """ffmpeg run as a child process with an argument list, no shell, progress read from -progress pipe:1"""
+
+    name = 'subprocess'
+
+    def run(self, cmd, description, progress=None, save_name=None):
+        """
+        Run an ffmpeg argument list, counting frames from its progress blocks as they arrive
+
+        Returns:
+            tuple: (True if ffmpeg exited with 0, its stderr)
+        """
+        logging.info(f"Running: {description}")
+        logging.debug(f"Command: {shlex.join(cmd)}")
+        frames = 0
+        fps = 0.0
+        with tempfile.TemporaryFile() as stderr:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, text=True)
+            with proc.stdout:
+                for line in proc.stdout:
+                    key, sep, value = line.strip().partition('=')
+                    try:
+                        if key == 'frame' and sep:
+                            METRICS.inc('ffmpeg_frames_total', max(0, int(value) - frames))
+                            frames = max(frames, int(value))
+                        elif key == 'fps' and sep:
+                            fps = float(value)
+                    except ValueError:
+                        continue
+                    if key == 'progress' and progress is not None:
+                        progress(save_name, frames)
+            returncode = proc.wait()
+            stderr.seek(0)
+            errors = stderr.read().decode(errors='replace').strip()
+        if returncode != 0:
+            logging.error(f"Command failed: {description}")
+            logging.error(f"Error: {errors}")
+            return False, errors
+        observe_fps(fps)
+        return True, errors
+
+    def clip_command(self, raw_vid_path, clip, encoder):
+        seek = clip.get('seek', 0.0)
+        cmd = ['ffmpeg', '-threads', str(encoder['threads'])]
+        if seek > 0:
+            cmd += ['-ss', str(seek)]
+        cmd += ['-i', raw_vid_path, '-vf', clip['filters'],
+                '-ss', secs_to_timestr(clip['start'] - seek), '-to', secs_to_timestr(clip['end'] - seek)]
+        return cmd + encoder_cli_args(encoder) + ['-loglevel', 'error', '-progress', 'pipe:1', '-nostats', '-y',
+                                                  clip['out_path']]
+
+    def cut_clip(self, raw_vid_path, clip, encoder, progress=None):
+        cmd = self.clip_command(raw_vid_path, clip, encoder)
+        logging.info(f"FFmpeg command: {shlex.join(cmd)}")
+        success, _ = self.run(cmd, f"Processing video {clip['save_name']}", progress, clip['save_name'])
+        return success and os.path.exists(clip['out_path'])
+
+    def merge(self, video_path, audio_path, output_path):
+        cmd = ['ffmpeg', '-i', video_path, '-i', audio_path, '-c:v', 'copy', '-c:a', 'copy',
+               '-map', '0:v:0', '-map', '1:a:0', '-shortest', '-y', output_path]
+        try:
+            subprocess.run(cmd, check=True, capture_output=True)
+            return True
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Error merging {os.path.basename(video_path)}: "
+                          f"{e.stderr.decode(errors='replace').strip()}")
+            return False
+
+
+class PyAVBackend(ProcessingBackend):
+    """
+    libav in-process through PyAV: no process spawn per clip, one demuxer per raw video.
+
+    cut_clips opens the raw video once and, for each clip, seeks to the keyframe before its
+    start, decodes up to its end and encodes it, so clip after clip reuses the same demuxer
+    and decoder. Frames are counted as they are encoded. Decoding always starts at the
+    preceding keyframe, whatever the seek mode, which yields the frames of output seeking.
+    The video filter chain runs in a libavfilter graph, audio is re-encoded to AAC as the
+    ffmpeg command does by default.
+    """
+
+    name = 'pyav'
+    shares_demuxer = True
+
+    def __init__(self):
+        import av  # Optional dependency, only needed for this backend
+        self.av = av
+
+    def cut_clip(self, raw_vid_path, clip, encoder, progress=None):
+        return self.cut_clips(raw_vid_path, [clip], encoder, progress)[clip['save_name']]
+
+    def cut_clips(self, raw_vid_path, clips, encoder, progress=None):
+        results = {clip['save_name']: False for clip in clips}
+        try:
+            container = self.av.open(raw_vid_path)
+        except self.av.FFmpegError as e:
+            logging.error(f"Cannot open {raw_vid_path}: {e}")
+            return results
+        with container:
+            video = container.streams.video[0]
+            video.thread_type = 'AUTO'
+            video.codec_context.thread_count = encoder['threads']
+            audio = container.streams.audio[0] if container.streams.audio else None
+            # ffmpeg's clip times count from the start of the file, not from timestamp 0
+            origin = container.start_time / self.av.time_base if container.start_time is not None else 0.0
+            for clip in sorted(clips, key=lambda clip: clip['start']):
+                try:
+                    results[clip['save_name']] = self._cut(container, video, audio, origin, clip, encoder, progress)
+                except (self.av.FFmpegError, ValueError, OSError) as e:
+                    logging.error(f"Error processing {clip['save_name']}: {e}")
+                if not results[clip['save_name']] and os.path.exists(clip['out_path']):
+                    os.remove(clip['out_path'])
+        return results
+
+    def _filter_graph(self, video, filters):
+        graph = self.av.filter.Graph()
+        nodes = [graph.add_buffer(template=video)]
+        for part in filters.split(','):
+            name, _, args = part.partition('=')
+            nodes.append(graph.add(name, args))
+        nodes.append(graph.add('buffersink'))
+        graph.link_nodes(*nodes)
+        graph.configure()
+        return graph
+
+    def _open_output(self, clip, encoder, video, audio, frame):
+        """Output container and streams, created from the first filtered frame, which gives the frame size"""
+        options = {'movflags': '+faststart'} if encoder.get('faststart') else {}
+        output = self.av.open(clip['out_path'], 'w', options=options)
+        rate = Fraction(encoder['fps']) if encoder.get('fps') else video.average_rate or Fraction(25)
+        out_video = output.add_stream(encoder['codec'], rate=rate)
+        out_video.width = frame.width
+        out_video.height = frame.height
+        out_video.pix_fmt = encoder.get('pix_fmt') or 'yuv420p'
+        out_video.time_base = frame.time_base
+        out_video.codec_context.time_base = frame.time_base
+        codec_options = {'preset': encoder['preset'], 'crf': str(encoder['crf']), 'threads': str(encoder['threads'])}
+        gop = encoder.get('gop')
+        if gop:
+            out_video.codec_context.gop_size = gop
+            codec_options.update({'keyint_min': str(gop), 'sc_threshold': '0'})
+            if encoder['codec'] == 'libx265':
+                codec_options['x265-params'] = f"keyint={gop}:min-keyint={gop}:scenecut=0"
+        out_video.options = codec_options
+        out_audio = None
+        if audio is not None:
+            out_audio = output.add_stream('aac', rate=audio.codec_context.sample_rate)
+            out_audio.layout = audio.codec_context.layout
+        return output, out_video, out_audio
+
+    def _cut(self, container, video, audio, origin, clip, encoder, progress):
+        av = self.av
+        start, end = clip['start'], clip['end']
+        container.seek(int((start + origin) / video.time_base), stream=video, backward=True)
+        graph = self._filter_graph(video, clip['filters'])
+        output = out_video = out_audio = None
+        pending_audio = []  # Audio frames decoded before the output exists
+        fifo = av.AudioFifo() if audio is not None else None
+        audio_samples = 0
+        frames = 0
+        started = time.monotonic()
+
+        def encode_audio(frame):
+            nonlocal audio_samples
+            frame.pts = None
+            fifo.write(frame)
+            frame_size = out_audio.codec_context.frame_size or 1024
+            while fifo.samples >= frame_size:
+                chunk = fifo.read(frame_size)
+                chunk.pts = audio_samples
+                chunk.time_base = Fraction(1, out_audio.codec_context.sample_rate)
+                audio_samples += chunk.samples
+                output.mux(out_audio.encode(chunk))
+
+        def drain_graph():
+            nonlocal output, out_video, out_audio, frames
+            while True:
+                try:
+                    filtered = graph.vpull()
+                except (BlockingIOError, av.EOFError):
+                    return
+                if output is None:
+                    output, out_video, out_audio = self._open_output(clip, encoder, video, audio, filtered)
+                    for frame in pending_audio:
+                        encode_audio(frame)
+                    pending_audio.clear()
+                filtered = filtered.reformat(format=out_video.pix_fmt)
+                # Decoded frames keep their picture type, which would force keyframes where the source had them
+                filtered.pict_type = av.video.frame.PictureType.NONE
+                output.mux(out_video.encode(filtered))
+                frames += 1
+                METRICS.inc('ffmpeg_frames_total')
+                if progress is not None:
+                    progress(clip['save_name'], frames)
+
+        video_done = False
+        audio_done = audio is None
+        streams = [video] + ([audio] if audio is not None else [])
+        try:
+            for packet in container.demux(*streams):
+                for frame in packet.decode():
+                    if frame.time is None:
+                        continue
+                    t = frame.time - origin
+                    if packet.stream.type == 'video':
+                        if t >= end:
+                            video_done = True
+                        elif t >= start:
+                            # Timestamps of the clip start at its first frame, as with ffmpeg -ss on the output
+                            frame.pts = round((t - start) / video.time_base)
+                            graph.vpush(frame)
+                            drain_graph()
+                    elif not audio_done:
+                        if t >= end:
+                            audio_done = True
+                        elif t + frame.samples / frame.sample_rate > start:
+                            if output is None:
+                                pending_audio.append(frame)
+                            else:
+                                encode_audio(frame)
+                if video_done and audio_done:
+                    break
+
+            graph.vpush(None)
+            drain_graph()
+            if output is None:
+                logging.error(f"No frames decoded for {clip['save_name']}")
+                return False
+            output.mux(out_video.encode(None))
+            if out_audio is not None:
+                if fifo.samples:
+                    chunk = fifo.read()
+                    chunk.pts = audio_samples
+                    chunk.time_base = Fraction(1, out_audio.codec_context.sample_rate)
+                    output.mux(out_audio.encode(chunk))
+                output.mux(out_audio.encode(None))
+        finally:
+            if output is not None:
+                output.close()
+        elapsed = time.monotonic() - started
+        observe_fps(frames / elapsed if elapsed > 0 else 0.0)
+        logging.info(f"Encoded {frames} frames of {clip['save_name']} in-process")
+        return True
+
+    def merge(self, video_path, audio_path, output_path):
+        av = self.av
+        try:
+            with av.open(video_path) as video_in, av.open(audio_path) as audio_in:
+                video = video_in.streams.video[0]
+                audio = audio_in.streams.audio[0]
+                # -shortest: stop both streams at the end of the shorter input
+                limit = min(video_in.duration or 0, audio_in.duration or 0) / av.time_base
+                with av.open(output_path, 'w', format='mp4') as output:
+                    out_video = output.add_stream_from_template(video)
+                    out_audio = output.add_stream_from_template(audio)
+
+                    def packets(source, stream):
+                        for packet in source.demux(stream):
+                            if packet.dts is None:
+                                continue
+                            if packet.pts is not None and limit and packet.pts * packet.time_base >= limit:
+                                return
+                            yield packet
+
+                    # Both inputs are read together and the earlier packet is muxed first, so the
+                    # video and audio stay interleaved however long the clip is, as with ffmpeg
+                    inputs = [(packets(video_in, video), out_video), (packets(audio_in, audio), out_audio)]
+                    heads = [next(source, None) for source, _ in inputs]
+                    while any(head is not None for head in heads):
+                        i = min((i for i, head in enumerate(heads) if head is not None),
+                                key=lambda i: heads[i].dts * heads[i].time_base)
+                        packet = heads[i]
+                        packet.stream = inputs[i][1]
+                        output.mux(packet)
+                        heads[i] = next(inputs[i][0], None)
+            return True
+        except (av.FFmpegError, IndexError) as e:
+            logging.error(f"Error merging {os.path.basename(video_path)}: {e}")
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            return False
+
+
+_backend = SubprocessBackend()
+
+
+def configure_backend(name):
+    """Set the process-wide backend by name, falling back to the subprocess backend without PyAV"""
+    global _backend
+    if name == 'pyav':
+        try:
+            _backend = PyAVBackend()
+        except ImportError:
+            logging.warning("PyAV is not installed (pip install av), using the ffmpeg subprocess backend")
+            _backend = SubprocessBackend()
+    else:
+        if name != 'subprocess':
+            logging.warning(f"Unknown processing backend {name}, using {DEFAULT_BACKEND}")
+        _backend = SubprocessBackend()
+    return _backend
+
+
+def get_backend():
+    """The process-wide ProcessingBackend, the ffmpeg subprocess one by default"""
+    return _backend
@@ -0,0 +1,212 @@
+"""
+Per-clip overhead of the processing backends on the short clips that dominate the dataset
+
+Encodes one synthetic raw video, then cuts the same random 5-20s clips out of it with each
+backend, and once more as 0.2s clips at the same positions: what a near-empty clip costs
+is the fixed cost of a clip (process spawn, open and probe, seek, encoder setup), paid
+again for every clip whatever its length. Also times the video/audio merges of
+merge_video.py. Reports wall and CPU seconds per clip, the CPU of ffmpeg child processes
+included.
+
+    python benchmark/backend_overhead.py --clips 24 --duration 180
+    python benchmark/backend_overhead.py --backends subprocess,pyav --json overhead.json
+
+The subprocess backend and the synthetic inputs need ffmpeg, the pyav backend needs PyAV
+(pip install av). To compare the backends on whole runs, use run_benchmark.py with
+--env CELEBV_BACKEND=pyav.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+
+from synthetic import make_video, make_audio
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from backends import SubprocessBackend, PyAVBackend
+
+EMPTY_CLIP_SECONDS = 0.2
+
+
+def cpu_seconds():
+    """CPU seconds of this process and its finished children"""
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def make_backend(name):
+    """Backend by name, or None if what it needs is not installed"""
+    if name == 'subprocess':
+        return SubprocessBackend() if shutil.which('ffmpeg') else None
+    if name == 'pyav':
+        try:
+            return PyAVBackend()
+        except ImportError:
+            return None
+    raise ValueError(f"Unknown backend {name}")
+
+
+def random_clips(rng, count, duration, width, height, min_length, max_length, input_seek):
+    """
+    Clips of min_length to max_length seconds with a random square crop
+
+    Returns:
+        list: clip dicts as taken by the backends, without out_path
+    """
+    clips = []
+    for i in range(count):
+        length = rng.uniform(min_length, max_length)
+        start = round(rng.uniform(0, duration - length), 2)
+        side = rng.randrange(height // 3, height) // 2 * 2
+        x, y = rng.randrange(0, width - side + 1), rng.randrange(0, height - side + 1)
+        clips.append({'save_name': f"clip{i:04d}.mp4", 'start': start, 'end': round(start + length, 2),
+                      'seek': start if input_seek else 0.0, 'filters': f"crop=w={side}:h={side}:x={x}:y={y}"})
+    return clips
+
+
+def shortened(clips, length):
+    """The same clips cut down to length seconds"""
+    return [dict(clip, end=clip['start'] + length) for clip in clips]
+
+
+def time_cuts(backend, raw_path, clips, out_dir, encoder):
+    """
+    Cut clips with backend into out_dir
+
+    Returns:
+        dict: clips, clips_done, wall_seconds, cpu_seconds
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    clips = [dict(clip, out_path=os.path.join(out_dir, clip['save_name'])) for clip in clips]
+    cpu_before = cpu_seconds()
+    start_time = time.monotonic()
+    written = backend.cut_clips(raw_path, clips, encoder)
+    return {'clips': len(clips), 'clips_done': sum(bool(ok) for ok in written.values()),
+            'wall_seconds': time.monotonic() - start_time, 'cpu_seconds': cpu_seconds() - cpu_before}
+
+
+def time_merges(backend, clips_dir, audio_path, out_dir):
+    """Merge every clip of clips_dir with audio_path, as merge_video.py does"""
+    os.makedirs(out_dir, exist_ok=True)
+    names = sorted(name for name in os.listdir(clips_dir) if name.endswith('.mp4'))
+    cpu_before = cpu_seconds()
+    start_time = time.monotonic()
+    done = sum(backend.merge(os.path.join(clips_dir, name), audio_path, os.path.join(out_dir, name)) for name in names)
+    return {'clips': len(names), 'clips_done': done,
+            'wall_seconds': time.monotonic() - start_time, 'cpu_seconds': cpu_seconds() - cpu_before}
+
+
+def per_clip(result, key):
+    return result[key] / result['clips'] if result['clips'] else 0.0
+
+
+def bench_backend(backend, raw_path, audio_path, clips, workspace, encoder):
+    run_dir = os.path.join(workspace, backend.name)
+    full = time_cuts(backend, raw_path, clips, os.path.join(run_dir, 'clips'), encoder)
+    empty = time_cuts(backend, raw_path, shortened(clips, EMPTY_CLIP_SECONDS), os.path.join(run_dir, 'empty'), encoder)
+    merge = time_merges(backend, os.path.join(run_dir, 'clips'), audio_path, os.path.join(run_dir, 'merged'))
+    clip_seconds = sum(clip['end'] - clip['start'] for clip in clips)
+    return {
+        'backend': backend.name,
+        'clips': full['clips'],
+        'clips_done': full['clips_done'],
+        'clip_seconds': clip_seconds,
+        'wall_seconds': full['wall_seconds'],
+        'wall_seconds_per_clip': per_clip(full, 'wall_seconds'),
+        'cpu_seconds_per_clip': per_clip(full, 'cpu_seconds'),
+        'realtime_factor': clip_seconds / full['wall_seconds'] if full['wall_seconds'] else 0.0,
+        'overhead_wall_seconds_per_clip': per_clip(empty, 'wall_seconds'),
+        'overhead_cpu_seconds_per_clip': per_clip(empty, 'cpu_seconds'),
+        'merge_wall_seconds_per_clip': per_clip(merge, 'wall_seconds'),
+        'merges_done': merge['clips_done'],
+    }
+
+
+def log_results(results):
+    logging.info(f"{'backend':<12} {'clips':>9} {'wall s':>8} {'x realtime':>10} {'wall s/clip':>11} "
+                 f"{'CPU s/clip':>10} {'overhead s':>10} {'merge s':>8}")
+    for row in results:
+        logging.info(f"{row['backend']:<12} {row['clips_done']:>4}/{row['clips']:<4} {row['wall_seconds']:>8.2f} "
+                     f"{row['realtime_factor']:>10.1f} {row['wall_seconds_per_clip']:>11.3f} "
+                     f"{row['cpu_seconds_per_clip']:>10.3f} {row['overhead_wall_seconds_per_clip']:>10.3f} "
+                     f"{row['merge_wall_seconds_per_clip']:>8.3f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Per-clip overhead of the processing backends on short clips")
+    parser.add_argument('--backends', default='subprocess,pyav', help="comma-separated: subprocess, pyav")
+    parser.add_argument('--clips', type=int, default=12, help="clips cut from the raw video")
+    parser.add_argument('--min-length', type=float, default=5.0, help="shortest clip, in seconds")
+    parser.add_argument('--max-length', type=float, default=20.0, help="longest clip, in seconds")
+    parser.add_argument('--duration', type=float, default=120.0, help="seconds of the synthetic raw video")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--threads', type=int, default=1, help="encoder threads per clip")
+    parser.add_argument('--preset', default='veryfast')
+    parser.add_argument('--output-seek', action='store_true',
+                        help="decode the subprocess clips from the start of the raw video instead of seeking the input")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='PATH', help="write the results to PATH")
+    parser.add_argument('--workspace', help="folder for inputs and outputs, a temporary one by default")
+    parser.add_argument('--keep', action='store_true', help="keep the workspace afterwards")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    if args.max_length >= args.duration:
+        sys.exit("--duration must be longer than --max-length")
+
+    backends = []
+    for name in (name.strip() for name in args.backends.split(',') if name.strip()):
+        backend = make_backend(name)
+        if backend is None:
+            logging.warning(f"Skipping the {name} backend, its dependencies are not installed")
+        else:
+            backends.append(backend)
+    if not backends:
+        sys.exit("No backend to benchmark")
+
+    workspace = args.workspace or tempfile.mkdtemp(prefix='celebv_backends_')
+    os.makedirs(workspace, exist_ok=True)
+    logging.info(f"Benchmark workspace: {workspace}")
+    encoder = {'threads': args.threads, 'codec': 'libx264', 'preset': args.preset, 'crf': 23}
+
+    try:
+        raw_path = os.path.join(workspace, 'raw.mp4')
+        audio_path = os.path.join(workspace, 'audio.m4a')
+        make_video(raw_path, args.duration, args.width, args.height)
+        make_audio(audio_path, args.max_length)
+        clips = random_clips(random.Random(args.seed), args.clips, args.duration, args.width, args.height,
+                             args.min_length, args.max_length, not args.output_seek)
+
+        results = []
+        for backend in backends:
+            logging.info(f"Cutting {len(clips)} clips with the {backend.name} backend")
+            results.append(bench_backend(backend, raw_path, audio_path, clips, workspace, encoder))
+    finally:
+        if not args.keep and not args.workspace:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    log_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+        logging.info(f"Saved results to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Shared helpers of the fake yt-dlp and rclone executables used by the benchmark
+"""
+
+import os
+import time
+import shutil
+
+# Seconds added to every invocation, like a round trip to the real service
+LATENCY = float(os.getenv('CELEBV_FAKE_LATENCY', '0'))
+# Transfer rate in MB/s, 0 for unlimited
+BANDWIDTH = float(os.getenv('CELEBV_FAKE_BANDWIDTH', '0'))
+# Folder holding one subfolder per fake rclone remote
+REMOTE_ROOT = os.getenv('CELEBV_FAKE_REMOTE_ROOT', '/tmp/celebv_fake_remote')
+# Folder holding the synthetic source videos served by fake yt-dlp, <ytb_id>.mp4
+SOURCE_DIR = os.getenv('CELEBV_FAKE_SOURCE_DIR', '/tmp/celebv_fake_source')
+
+
+def wait_latency():
+    if LATENCY > 0:
+        time.sleep(LATENCY)
+
+
+def throttle(size):
+    """Sleep as long as moving size bytes takes at the configured bandwidth"""
+    if BANDWIDTH > 0:
+        time.sleep(size / (BANDWIDTH * 1024 * 1024))
+
+
+def transfer(src, dst, move=False):
+    """Copy or move one file at the configured bandwidth"""
+    throttle(os.path.getsize(src))
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    if move:
+        shutil.move(src, dst)
+    else:
+        shutil.copyfile(src, dst)
+
+
+def resolve(location):
+    """Map 'remote:path' to a folder under REMOTE_ROOT, local paths are returned as they are"""
+    remote, sep, path = location.partition(':')
+    if not sep or os.sep in remote or not remote:
+        return location
+    return os.path.join(REMOTE_ROOT, remote, path)
@@ -0,0 +1,413 @@
+"""
+Offline throughput benchmark of download_and_process.py and merge_video.py
+
+Generates synthetic inputs, puts fake yt-dlp and rclone executables first on PATH so no
+network service is touched, and runs each script at several worker counts. Reports
+clips/sec, CPU-seconds per clip (all child processes, ffmpeg included) and peak disk of
+the working folders. Results can be saved as a baseline and compared against later.
+
+For download_and_process.py it also times random-frame fetches from the uploaded clips, a
+seek to a random timestamp and the decode of one frame, and counts the clips whose moov
+atom comes before their media data. Compare CELEBV_ENCODE_PROFILE=random_access against
+the default profile with --env. --compare-schedules runs it with CELEBV_SCHEDULE=input and
+=cost on jobs of uneven size and reports the wall time of both.
+
+    python benchmark/run_benchmark.py --workers 1,2,4 --save-baseline main
+    python benchmark/run_benchmark.py --workers 1,2,4 --compare main
+    python benchmark/run_benchmark.py --scripts download --videos 12 --workers 2,4 --compare-schedules
+
+Requires ffmpeg and ffprobe, and PyAV to time random-frame fetches.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import struct
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+
+from synthetic import make_download_inputs, make_merge_inputs
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+FAKES_DIR = os.path.join(BENCHMARK_DIR, 'fakes')
+BASELINE_DIR = os.path.join(BENCHMARK_DIR, 'baselines')
+DEFAULT_TOLERANCE = 0.10  # Relative slowdown tolerated before a result counts as a regression
+DISK_POLL_INTERVAL = 0.1
+
+
+def dir_size(path):
+    """Total size of the files under path, ignoring files that vanish while walking"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+    return total
+
+
+class DiskSampler:
+    """Track the peak size of a folder while a benchmark run is in progress"""
+
+    def __init__(self, path):
+        self.path = path
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(DISK_POLL_INTERVAL):
+            self.peak = max(self.peak, dir_size(self.path))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, dir_size(self.path))
+
+
+def children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_script(script, run_dir, env):
+    """
+    Run one of the repo scripts with run_dir as its working folder
+
+    Returns:
+        tuple: (wall seconds, CPU seconds of all its child processes, peak bytes in run_dir)
+    """
+    cpu_before = children_cpu_seconds()
+    start_time = time.monotonic()
+    with DiskSampler(run_dir) as sampler, open(os.path.join(run_dir, 'benchmark_stdout.log'), 'w') as log:
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, script)], cwd=run_dir, env=env,
+                       stdout=log, stderr=subprocess.STDOUT, check=False)
+    return time.monotonic() - start_time, children_cpu_seconds() - cpu_before, sampler.peak
+
+
+def base_env(remote_root, args):
+    env = dict(os.environ)
+    env.update({
+        'PATH': FAKES_DIR + os.pathsep + env.get('PATH', ''),
+        'CELEBV_FAKE_REMOTE_ROOT': remote_root,
+        'CELEBV_FAKE_LATENCY': str(args.latency),
+        'CELEBV_FAKE_BANDWIDTH': str(args.bandwidth),
+    })
+    for assignment in args.env:
+        key, _, value = assignment.partition('=')
+        env[key] = value
+    return env
+
+
+def count_files(path):
+    """Clips in a folder, keyframe sidecars left out"""
+    if not os.path.isdir(path):
+        return 0
+    return sum(1 for name in os.listdir(path) if not name.endswith('.json'))
+
+
+def count_shard_members(path):
+    """Clips in the shards of a folder, from their JSON indexes"""
+    if not os.path.isdir(path):
+        return 0
+    count = 0
+    for name in os.listdir(path):
+        if name.endswith('.json'):
+            with open(os.path.join(path, name)) as f:
+                count += sum('sidecar_of' not in member for member in json.load(f)['members'])
+    return count
+
+
+def moov_first(path):
+    """True if the moov atom of an MP4 comes before its mdat, so playback can start while it downloads"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, box = struct.unpack('>I4s', header)
+            if box == b'moov':
+                return True
+            if box == b'mdat':
+                return False
+            if size == 1:
+                size = struct.unpack('>Q', f.read(8))[0] - 8
+            elif size == 0:
+                return False
+            f.seek(size - 8, os.SEEK_CUR)
+
+
+def clip_duration(path):
+    result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path],
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip())
+
+
+def fetch_frame(av, path, timestamp):
+    """Open a clip, seek to timestamp and decode the frame shown at it, in-process with PyAV"""
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        target = int(timestamp / stream.time_base)
+        # Seeks to the keyframe at or before the target, the frames up to it are decoded
+        container.seek(target, stream=stream, backward=True)
+        for frame in container.decode(stream):
+            if frame.pts is None or frame.pts >= target:
+                return frame
+    return None
+
+
+def measure_random_access(clips_dir, samples, seed=0):
+    """
+    Time random-frame fetches from the clips of a folder: open, seek to a random timestamp
+    and decode one frame, as a data loader reading single frames would. Fetches run
+    in-process with PyAV so no process start is timed.
+
+    Returns:
+        dict: mean and p95 fetch latency in ms and the share of faststart clips, empty without
+        clips or without PyAV
+    """
+    if not os.path.isdir(clips_dir):
+        return {}
+    clips = sorted(os.path.join(clips_dir, name) for name in os.listdir(clips_dir) if name.endswith('.mp4'))
+    if not clips or samples <= 0:
+        return {}
+    try:
+        import av
+    except ImportError:
+        logging.warning("PyAV is not installed, random-frame fetches are not timed")
+        return {}
+
+    durations = {clip: clip_duration(clip) for clip in clips}
+    rng = random.Random(seed)
+    latencies = []
+    for _ in range(samples):
+        clip = rng.choice(clips)
+        timestamp = rng.uniform(0, max(0.0, durations[clip] - 0.1))
+        start_time = time.monotonic()
+        fetch_frame(av, clip, timestamp)
+        latencies.append((time.monotonic() - start_time) * 1000)
+    latencies.sort()
+    return {
+        'random_frame_ms': round(sum(latencies) / len(latencies), 2),
+        'random_frame_p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+        'faststart_ratio': round(sum(moov_first(clip) for clip in clips) / len(clips), 3),
+    }
+
+
+def bench_download(workspace, workers, clip_count, args, schedule=None):
+    """Run download_and_process.py on the synthetic JSON, with CELEBV_SCHEDULE set to schedule if given"""
+    suffix = f"_{schedule}" if schedule else ""
+    run_dir = os.path.join(workspace, f"download_w{workers}{suffix}")
+    remote_root = os.path.join(workspace, f"remote_download_w{workers}{suffix}")
+    os.makedirs(run_dir)
+    env = base_env(remote_root, args)
+    env.update({
+        'CELEBV_FAKE_SOURCE_DIR': os.path.join(workspace, 'inputs', 'sources'),
+        'CELEBV_JSON_PATH': os.path.join(workspace, 'inputs', 'celebvtext_info.json'),
+        'CELEBV_RAW_ROOT': os.path.join(run_dir, 'raw'),
+        'CELEBV_PROCESSED_ROOT': os.path.join(run_dir, 'processed'),
+        'CELEBV_MAX_WORKERS': str(workers),
+        'CELEBV_DOWNLOAD_WORKERS': str(workers),
+        'CELEBV_TRANSCODE_WORKERS': str(workers),
+        'CELEBV_RAW_REMOTE': 'dropbox:celebv-text-raw/',
+        'CELEBV_PROCESSED_REMOTE': 'dropbox:celebv-text-processed/',
+    })
+    if schedule:
+        env['CELEBV_SCHEDULE'] = schedule
+    wall, cpu, peak = run_script('download_and_process.py', run_dir, env)
+    clips_dir = os.path.join(remote_root, 'dropbox', 'celebv-text-processed')
+    done = count_files(clips_dir) + count_shard_members(os.path.join(remote_root, 'dropbox', 'celebv-text-shards'))
+    row = result_row('download_and_process', workers, clip_count, done, wall, cpu, peak)
+    if schedule:
+        row['schedule'] = schedule
+    row.update(measure_random_access(clips_dir, args.random_frames))
+    return row
+
+
+def bench_merge(workspace, workers, clip_count, args):
+    """Run merge_video.py on the synthetic tars"""
+    run_dir = os.path.join(workspace, f"merge_w{workers}")
+    remote_root = os.path.join(workspace, f"remote_merge_w{workers}")
+    os.makedirs(run_dir)
+    os.makedirs(remote_root)
+    # The tars are only read, every run shares them
+    os.symlink(os.path.join(workspace, 'inputs', 'gdrive'), os.path.join(remote_root, 'gdrive'))
+    os.symlink(os.path.join(workspace, 'inputs', 'celebvtext_audio'), os.path.join(run_dir, 'celebvtext_audio'))
+    env = base_env(remote_root, args)
+    env['CELEBV_MERGE_WORKERS'] = str(workers)
+    wall, cpu, peak = run_script('merge_video.py', run_dir, env)
+    merged_dir = os.path.join(remote_root, 'dropbox', 'celebv_merged')
+    done = len(os.listdir(merged_dir)) if os.path.isdir(merged_dir) else 0
+    return result_row('merge_video', workers, clip_count, done, wall, cpu, peak)
+
+
+def result_row(script, workers, clips, done, wall, cpu, peak):
+    return {
+        'script': script,
+        'workers': workers,
+        'clips': clips,
+        'clips_done': done,
+        'wall_seconds': round(wall, 3),
+        'clips_per_sec': round(done / wall, 4) if wall > 0 else 0.0,
+        'cpu_seconds_per_clip': round(cpu / done, 4) if done else None,
+        'peak_disk_mb': round(peak / 1024 ** 2, 2),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with a baseline run of the same scripts and worker counts
+
+    Returns:
+        list: regression messages, empty if none
+    """
+    reference = {(row['script'], row['workers'], row.get('schedule')): row for row in baseline['results']}
+    regressions = []
+    for row in results:
+        base = reference.get((row['script'], row['workers'], row.get('schedule')))
+        if base is None:
+            continue
+        name = f"{row_name(row)} with {row['workers']} workers"
+        if row['clips_done'] < base['clips_done']:
+            regressions.append(f"{name}: {row['clips_done']} clips done, baseline {base['clips_done']}")
+        if row['clips_per_sec'] < base['clips_per_sec'] * (1 - tolerance):
+            regressions.append(f"{name}: {row['clips_per_sec']} clips/sec, baseline {base['clips_per_sec']}")
+        if (row['cpu_seconds_per_clip'] and base['cpu_seconds_per_clip']
+                and row['cpu_seconds_per_clip'] > base['cpu_seconds_per_clip'] * (1 + tolerance)):
+            regressions.append(f"{name}: {row['cpu_seconds_per_clip']} CPU-s/clip, "
+                               f"baseline {base['cpu_seconds_per_clip']}")
+        if row['peak_disk_mb'] > base['peak_disk_mb'] * (1 + tolerance):
+            regressions.append(f"{name}: {row['peak_disk_mb']} MB peak disk, baseline {base['peak_disk_mb']}")
+        if row.get('random_frame_ms') and base.get('random_frame_ms') \
+                and row['random_frame_ms'] > base['random_frame_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: {row['random_frame_ms']} ms per random frame, "
+                               f"baseline {base['random_frame_ms']}")
+    return regressions
+
+
+def row_name(row):
+    return f"{row['script']} ({row['schedule']})" if row.get('schedule') else row['script']
+
+
+def log_results(results):
+    logging.info(f"{'script':<28} {'workers':>7} {'clips':>9} {'wall s':>8} {'clips/s':>8} "
+                 f"{'CPU-s/clip':>10} {'peak MB':>8}")
+    for row in results:
+        cpu = f"{row['cpu_seconds_per_clip']:.3f}" if row['cpu_seconds_per_clip'] is not None else '-'
+        logging.info(f"{row_name(row):<28} {row['workers']:>7} {row['clips_done']:>4}/{row['clips']:<4} "
+                     f"{row['wall_seconds']:>8.2f} {row['clips_per_sec']:>8.3f} {cpu:>10} {row['peak_disk_mb']:>8.1f}")
+    for row in results:
+        if 'random_frame_ms' in row:
+            logging.info(f"{row_name(row)} with {row['workers']} workers: random frame {row['random_frame_ms']:.1f} ms "
+                         f"(p95 {row['random_frame_p95_ms']:.1f} ms), {row['faststart_ratio']:.0%} of clips faststart")
+
+    by_schedule = {(row['workers'], row['schedule']): row for row in results if row.get('schedule')}
+    for (workers, schedule), row in by_schedule.items():
+        base = by_schedule.get((workers, 'input'))
+        if schedule != 'cost' or base is None or not base['wall_seconds']:
+            continue
+        change = row['wall_seconds'] / base['wall_seconds'] - 1
+        logging.info(f"Schedule cost vs input with {workers} workers: {row['wall_seconds']:.2f}s vs "
+                     f"{base['wall_seconds']:.2f}s wall ({change:+.1%})")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of download_and_process.py and merge_video.py")
+    parser.add_argument('--scripts', default='download,merge', help="comma-separated: download, merge")
+    parser.add_argument('--workers', default='1,2,4', help="comma-separated worker counts")
+    parser.add_argument('--videos', type=int, default=4, help="synthetic raw videos (ytb_ids)")
+    parser.add_argument('--clips-per-video', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=20.0, help="seconds per synthetic raw video")
+    parser.add_argument('--tars', type=int, default=2, help="synthetic tars for merge_video.py")
+    parser.add_argument('--clips-per-tar', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every fake yt-dlp/rclone call")
+    parser.add_argument('--bandwidth', type=float, default=0.0, help="fake transfer rate in MB/s, 0 for unlimited")
+    parser.add_argument('--random-frames', type=int, default=20,
+                        help="random-frame fetches timed on the processed clips, 0 to skip")
+    parser.add_argument('--compare-schedules', action='store_true',
+                        help="run download_and_process.py with CELEBV_SCHEDULE=input and =cost on jobs of uneven size")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="extra environment for the scripts, e.g. CELEBV_EXTRACT_MODE=batch")
+    parser.add_argument('--workspace', help="folder for inputs and runs, a temporary one by default")
+    parser.add_argument('--keep', action='store_true', help="keep the workspace afterwards")
+    parser.add_argument('--save-baseline', metavar='NAME', help="save the results as baselines/NAME.json")
+    parser.add_argument('--compare', metavar='NAME', help="compare with baselines/NAME.json, exit 1 on regression")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    scripts = [script.strip() for script in args.scripts.split(',') if script.strip()]
+    worker_counts = [int(workers) for workers in args.workers.split(',')]
+
+    workspace = args.workspace or tempfile.mkdtemp(prefix='celebv_bench_')
+    os.makedirs(workspace, exist_ok=True)
+    logging.info(f"Benchmark workspace: {workspace}")
+
+    try:
+        results = []
+        if 'download' in scripts:
+            clip_count = make_download_inputs(os.path.join(workspace, 'inputs', 'sources'),
+                                              os.path.join(workspace, 'inputs', 'celebvtext_info.json'),
+                                              args.videos, args.clips_per_video, args.duration,
+                                              skew=args.compare_schedules)
+            schedules = ('input', 'cost') if args.compare_schedules else (None,)
+            for workers in worker_counts:
+                for schedule in schedules:
+                    logging.info(f"Running download_and_process.py with {workers} workers"
+                                 + (f", schedule {schedule}" if schedule else ""))
+                    results.append(bench_download(workspace, workers, clip_count, args, schedule))
+        if 'merge' in scripts:
+            clip_count = make_merge_inputs(os.path.join(workspace, 'inputs', 'gdrive', 'CelebV-Text', 'video'),
+                                           os.path.join(workspace, 'inputs', 'celebvtext_audio'),
+                                           args.tars, args.clips_per_tar)
+            for workers in worker_counts:
+                logging.info(f"Running merge_video.py with {workers} workers")
+                results.append(bench_merge(workspace, workers, clip_count, args))
+    finally:
+        if not args.keep and not args.workspace:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    log_results(results)
+
+    config = {key: value for key, value in vars(args).items()
+              if key not in ('workspace', 'keep', 'save_baseline', 'compare', 'tolerance')}
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        baseline_path = os.path.join(BASELINE_DIR, f"{args.save_baseline}.json")
+        with open(baseline_path, 'w') as f:
+            json.dump({'config': config, 'machine': {'platform': platform.platform(), 'cpus': os.cpu_count()},
+                       'results': results}, f, indent=2)
+        logging.info(f"Saved baseline {baseline_path}")
+
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json")) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            logging.warning(f"Baseline {args.compare} was recorded with another configuration: {baseline['config']}")
+        regressions = compare(results, baseline, args.tolerance)
+        for message in regressions:
+            logging.error(f"Regression: {message}")
+        if regressions:
+            sys.exit(1)
+        logging.info(f"No regressions against baseline {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
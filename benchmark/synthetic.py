@@ -0,0 +1,97 @@
+"""
+Synthetic inputs for the benchmark: raw videos from ffmpeg test sources, a matching
+celebvtext_info.json, and video tars plus audio files for merge_video.py
+"""
+
+import os
+import json
+import random
+import tarfile
+import subprocess
+
+
+def make_video(path, duration, width=640, height=360, fps=25, with_audio=True):
+    """Encode a test pattern video (and a sine tone) of duration seconds"""
+    cmd = ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate={fps}:duration={duration}']
+    if with_audio:
+        cmd += ['-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}', '-c:a', 'aac', '-shortest']
+    cmd += ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-y', path]
+    subprocess.run(cmd, check=True)
+
+
+def make_audio(path, duration):
+    """Encode a sine tone m4a of duration seconds"""
+    subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f'sine=frequency=220:duration={duration}',
+                    '-c:a', 'aac', '-y', path], check=True)
+
+
+def random_bbox(rng):
+    top = round(rng.uniform(0.0, 0.4), 4)
+    left = round(rng.uniform(0.0, 0.4), 4)
+    return {'top': top, 'bottom': round(top + rng.uniform(0.3, 0.6), 4),
+            'left': left, 'right': round(left + rng.uniform(0.3, 0.6), 4)}
+
+
+def make_download_inputs(source_dir, json_path, videos=4, clips_per_video=4, duration=20.0, clip_length=3.0,
+                         seed=0, skew=False):
+    """
+    Write synthetic raw videos to source_dir as <ytb_id>.mp4 and a celebvtext_info.json
+    describing clips cut from them
+
+    Args:
+        skew: give every fourth ytb_id four times the clips and the others half, so a few long
+            jobs come late in the JSON order, as in the real dataset
+
+    Returns:
+        int: number of clips in the JSON
+    """
+    rng = random.Random(seed)
+    os.makedirs(source_dir, exist_ok=True)
+    info = {}
+    for v in range(videos):
+        ytb_id = f"bench{v:06d}"
+        make_video(os.path.join(source_dir, f"{ytb_id}.mp4"), duration)
+        clip_count = clips_per_video
+        if skew:
+            clip_count = clips_per_video * 4 if v % 4 == 3 else max(1, clips_per_video // 2)
+        for c in range(clip_count):
+            start_sec = round(rng.uniform(0, duration - clip_length), 2)
+            info[f"{ytb_id}_{c}_0.mp4"] = {
+                'meta_video_names': f"{ytb_id}_{c}",
+                'ytb_id': ytb_id,
+                'duration': {'start_sec': start_sec, 'end_sec': round(start_sec + clip_length, 2)},
+                'bbox': random_bbox(rng),
+                'version': 'bench',
+            }
+    with open(json_path, 'w') as f:
+        json.dump(info, f, indent=2)
+    return len(info)
+
+
+def make_merge_inputs(remote_tar_dir, audio_dir, tars=2, clips_per_tar=4, clip_length=3.0, first_tar=2):
+    """
+    Write sp_NNNN.tar files of video-only clips to remote_tar_dir and a matching .m4a for
+    every clip to audio_dir
+
+    Returns:
+        int: number of clips across all tars
+    """
+    os.makedirs(remote_tar_dir, exist_ok=True)
+    os.makedirs(audio_dir, exist_ok=True)
+    clip_dir = os.path.join(remote_tar_dir, '.clips')
+    os.makedirs(clip_dir, exist_ok=True)
+
+    count = 0
+    for t in range(first_tar, first_tar + tars):
+        tar_path = os.path.join(remote_tar_dir, f"sp_{t:04d}.tar")
+        with tarfile.open(tar_path, 'w') as tar:
+            for c in range(clips_per_tar):
+                name = f"merge{t:04d}_{c:03d}"
+                clip_path = os.path.join(clip_dir, f"{name}.mp4")
+                make_video(clip_path, clip_length, 256, 256, with_audio=False)
+                make_audio(os.path.join(audio_dir, f"{name}.m4a"), clip_length)
+                tar.add(clip_path, arcname=f"{name}.mp4")
+                os.remove(clip_path)
+                count += 1
+    os.rmdir(clip_dir)
+    return count
@@ -4,13 +4,42 @@ Improved Downloader with ytb_id grouping, rclone integration, progress tracking,
 
 import os
 import json
-import cv2
+import argparse
+import shlex
+import hashlib
+import shutil
 from collections import defaultdict
 import subprocess
 import logging
 import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
+import socket
+from queue import Queue
+from backends import (configure_backend, get_backend, SubprocessBackend, encoder_cli_args, secs_to_timestr,
+                      DEFAULT_BACKEND)
+from metadata_index import MetadataIndex, is_metadata_index
+from download_control import (configure_download_controller, get_download_controller, classify_failure,
+                              PermanentFailures, DEFAULT_DOWNLOAD_ATTEMPTS, DEFAULT_PERMANENT_FAILURES,
+                              DEFAULT_PERMANENT_FAILURE_TTL)
+from metrics import (METRICS, MetricsReporter, timed, DEFAULT_METRICS_INTERVAL)
+from pipeline import StagedPipeline
+from progress_journal import ProgressJournal
+from raw_cache import configure_raw_cache, get_raw_cache, DEFAULT_RAW_CACHE_GB
+from resource_governor import configure_governor, get_governor
+from scheduler import CostModel, job_features, order_by_cost, DEFAULT_COST_MODEL
+from tensor_sink import (configure_frame_sink, get_frame_sink, DEFAULT_FRAME_SIZE, DEFAULT_FRAME_STRIDE,
+                         DEFAULT_CHUNK_MB)
+from shard_writer import (configure_shard_writer, get_shard_writer, DEFAULT_SHARD_SIZE_MB, DEFAULT_SHARD_MAX_AGE,
+                          DEFAULT_SHARD_LOG)
+from sharding import filter_shard, shard_plan_report, log_shard_plan
+from upload import BatchUploader, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL, DEFAULT_RCD_ADDR
+from verify import (configure_verifier, get_verifier, DEFAULT_VERIFY_CACHE, DEFAULT_CHECKSUM_LOG,
+                    DEFAULT_DURATION_TOLERANCE)
+from video_probe import (load_keyframes, preceding_keyframe, keyframe_index_path, KEYFRAME_INDEX_SUFFIX,
+                         get_video_info, configure_probe_cache)
+from work_queue import (open_work_queue, iter_claims, LeaseKeeper, DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS,
+                        DEFAULT_POLL_INTERVAL)
 
 # Configuration constants
 DEFAULT_MAX_WORKERS = 5  # Default number of concurrent YouTube videos to process
@@ -18,8 +47,53 @@ DEFAULT_JSON_PATH = 'celebvtext_info.json'
 DEFAULT_RAW_VID_ROOT = './downloaded_celebvtext/raw/'
 DEFAULT_PROCESSED_VID_ROOT = './downloaded_celebvtext/processed/'
 DEFAULT_PROGRESS_FILE = 'progress.txt'
+DEFAULT_PROBE_CACHE = 'probe_cache.json'
+DEFAULT_EXTRACT_MODE = 'clip'  # 'clip': one ffmpeg per clip, 'batch': one ffmpeg per raw video
+DEFAULT_BATCH_MAX_CLIPS = 16  # Upper bound on outputs of a single batched ffmpeg invocation
+DEFAULT_SEEK_MODE = 'output'  # 'output': decode from 0 and trim, 'keyframe': seek the input to the preceding keyframe
+DEFAULT_DOWNLOAD_MODE = 'full'  # 'full': whole video, 'sections': only the time ranges the clips need
+DEFAULT_SECTION_PADDING = 2.0  # Seconds added around each clip window, absorbs keyframe alignment of section cuts
+DEFAULT_SECTION_MAX_COVERAGE = 0.5  # Download the full video when sections would cover more than this fraction
+DEFAULT_DEDUP_FILL = 'link'  # How duplicate clips are filled in: 'link' locally, or 'remote_copy' on Dropbox
+DEFAULT_DEDUP_REPORT = 'dedup_report.json'
+DEFAULT_UPLOAD_WORKERS = 4  # rclone uploads in flight in pipeline mode
+DEFAULT_QUEUE_SIZE = 4  # Jobs waiting between pipeline stages, bounds raw videos on disk
+DEFAULT_MIN_FREE_DISK_GB = 0  # Pause downloads below this much free disk in the raw folder, 0 to disable
+DEFAULT_DISK_POLL_INTERVAL = 10  # Seconds between free disk checks while downloads are paused
+DEFAULT_UPLOAD_MODE = 'file'  # 'file': one rclone move per file, 'files-from' or 'rcd': batched uploads
+DEFAULT_ARIA2C_CONNECTIONS = 16  # aria2c connections per download
+DEFAULT_OUTPUT_MODE = 'mp4'  # 'mp4': one uploaded file per clip, 'shards': clips packed into tar shards,
+                             # 'frames': raw RGB frames in memory-mappable chunks, no encode
+DEFAULT_FRAMES_ROOT = './downloaded_celebvtext/frames/'
+DEFAULT_ENCODE_PROFILE = 'default'  # 'default': encoder defaults, 'random_access': short fixed GOP, faststart,
+                                    # fixed fps and size, keyframe sidecar per clip
+DEFAULT_GOP = 12  # Frames between keyframes of the random_access profile
+DEFAULT_OUTPUT_FPS = '25'
+DEFAULT_OUTPUT_SIZE = 512  # Side of the square clips of the random_access profile, in pixels
+RAW_REMOTE = os.getenv('CELEBV_RAW_REMOTE', "dropbox:celebv-text-raw/")
+PROCESSED_REMOTE = os.getenv('CELEBV_PROCESSED_REMOTE', "dropbox:celebv-text-processed/")
+SHARD_REMOTE = os.getenv('CELEBV_SHARD_REMOTE', "dropbox:celebv-text-shards/")
 
-def download(video_path, ytb_id, proxy=None):
+ARIA2C_CONNECTIONS = int(os.getenv('CELEBV_ARIA2C_CONNECTIONS', DEFAULT_ARIA2C_CONNECTIONS))
+
+# Settings that change the bytes of a processed clip, part of the clip-spec key
+ENCODE_SETTINGS = {
+    'expand_ratio': 0.02,
+    'codec': os.getenv('CELEBV_VIDEO_CODEC', 'libx264'),
+    'preset': os.getenv('CELEBV_PRESET', 'auto'),  # 'auto' lets the resource governor pick one per thread count
+    'crf': int(os.getenv('CELEBV_CRF', 23)),
+}
+if os.getenv('CELEBV_ENCODE_PROFILE', DEFAULT_ENCODE_PROFILE) == 'random_access':
+    # Only set with the profile, so clip-spec keys of the default profile stay the same
+    ENCODE_SETTINGS.update({
+        'profile': 'random_access',
+        'gop': int(os.getenv('CELEBV_GOP', DEFAULT_GOP)),
+        'fps': os.getenv('CELEBV_OUTPUT_FPS', DEFAULT_OUTPUT_FPS),
+        'size': int(os.getenv('CELEBV_OUTPUT_SIZE', DEFAULT_OUTPUT_SIZE)),
+    })
+
+@timed('download')
+def download(video_path, ytb_id, proxy=None, section=None, min_duration=None):
     """
     Download YouTube video
     
@@ -27,49 +101,359 @@ def download(video_path, ytb_id, proxy=None):
         video_path: path to save the video
         ytb_id: youtube video id
         proxy: proxy url, default None
+        section: (start_sec, end_sec) to download only that time range, default None for the full video
+        min_duration: seconds an existing file must last to be kept, e.g. the end of the last clip
     
     Returns:
         bool: True if successful, False otherwise
     """
+    verifier = get_verifier()
+    raw_cache = get_raw_cache()
     if os.path.exists(video_path):
-        logging.info(f"Video already exists: {video_path}")
-        return True
+        if verifier is None or verifier.verify(video_path, min_duration=min_duration):
+            logging.info(f"Video already exists: {video_path}")
+            return True
+        logging.warning(f"Downloading {video_path} again, the existing file is incomplete")
+        cleanup_files(video_path, keyframe_index_path(video_path))
+        if raw_cache is not None:
+            # The raw folder file may be a link of the cached one, which would be served again
+            raw_cache.discard(video_path)
+    
+    if raw_cache is not None and raw_cache.fetch(video_path):
+        if verifier is None or verifier.verify(video_path, min_duration=min_duration):
+            return True
+        logging.warning(f"Downloading {video_path} again, its cached copy is incomplete")
+        cleanup_files(video_path, keyframe_index_path(video_path))
+        raw_cache.discard(video_path)
+        
+    controller = get_download_controller()
+    if controller.is_permanent(ytb_id):
+        logging.info(f"Skipping {ytb_id}, it failed permanently before")
+        return False
         
     if proxy is not None:
         proxy_cmd = f"--proxy {proxy}"
     else:
         proxy_cmd = ""
     
-    down_video = " ".join([
-        "yt-dlp",
-        proxy_cmd,
-        '-f', "'bestvideo[ext=mp4]+bestaudio[ext=m4a]/bestvideo+bestaudio'",
-        '--skip-unavailable-fragments',
-        '--merge-output-format', 'mp4',
-        f"https://www.youtube.com/watch?v={ytb_id}",
-        "--output", f"'{video_path}'",
-        "--external-downloader", "aria2c",
-        "--external-downloader-args", '"-x 16 -k 1M"'
-    ])
-    
-    logging.info(f"down_video command: {down_video}")
-    success, output = run_command(down_video, f"Downloading video {ytb_id}")
+    if section is not None:
+        section_cmd = f"--download-sections '*{section[0]:.2f}-{section[1]:.2f}'"
+    else:
+        section_cmd = ""
+    
+    for attempt in range(1, controller.max_attempts + 1):
+        with controller.slot() as connections:
+            down_video = " ".join([
+                "yt-dlp",
+                proxy_cmd,
+                section_cmd,
+                '-f', "'bestvideo[ext=mp4]+bestaudio[ext=m4a]/bestvideo+bestaudio'",
+                '--skip-unavailable-fragments',
+                '--merge-output-format', 'mp4',
+                f"https://www.youtube.com/watch?v={ytb_id}",
+                "--output", f"'{video_path}'",
+                "--external-downloader", "aria2c",
+                "--external-downloader-args", f'"-x {min(connections, ARIA2C_CONNECTIONS)} -k 1M"'
+            ])
+            
+            logging.info(f"down_video command: {down_video}")
+            start_time = time.monotonic()
+            success, output = run_command(down_video, f"Downloading video {ytb_id} (attempt {attempt})")
+            elapsed = time.monotonic() - start_time
+        
+        if success and os.path.exists(video_path):
+            size = os.path.getsize(video_path)
+            controller.record_success(size, elapsed)
+            METRICS.inc('download_bytes_total', size)
+            if raw_cache is not None:
+                raw_cache.store(video_path)
+            logging.info(f"Successfully downloaded: {ytb_id}" + (f" section {section}" if section else ""))
+            return True
+        
+        if success:
+            logging.error(f"Download completed but file not found: {video_path}")
+            kind = 'retryable'
+        else:
+            kind = classify_failure(output)
+        METRICS.inc('download_failures_total', kind=kind)
+        logging.error(f"Failed to download video: {ytb_id} ({kind})")
+        
+        delay = controller.record_failure(ytb_id, kind, output)
+        if kind == 'permanent':
+            return False
+        if attempt < controller.max_attempts:
+            time.sleep(delay)
     
+    return False
+
+
+def get_video_duration(ytb_id, proxy=None):
+    """
+    Look up the duration of a YouTube video without downloading it
+    
+    The lookup is a request to YouTube like a download, so it takes a download slot and its
+    failure feeds the download controller: a throttled lookup pauses downloads, a removed
+    video is recorded as a permanent failure.
+    
+    Returns:
+        float: duration in seconds, or None if unknown
+    """
+    controller = get_download_controller()
+    if controller.is_permanent(ytb_id):
+        return None
+    
+    proxy_cmd = f"--proxy {proxy}" if proxy is not None else ""
+    cmd = f"yt-dlp {proxy_cmd} --skip-download --print duration https://www.youtube.com/watch?v={ytb_id}"
+    with controller.slot():
+        success, output = run_command(cmd, f"Looking up duration of {ytb_id}")
     if not success:
-        logging.error(f"Failed to download video: {ytb_id}")
-        return False
+        kind = classify_failure(output)
+        logging.error(f"Failed to look up duration of {ytb_id} ({kind})")
+        controller.record_failure(ytb_id, kind, output)
+        return None
+    
+    try:
+        return float(output.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        logging.warning(f"Unknown duration for {ytb_id}: {output.strip()}")
+        return None
+
+
+def merge_clip_windows(video_data_list, padding=DEFAULT_SECTION_PADDING, duration=None):
+    """
+    Merge the clip time windows of a ytb_id into padded, non-overlapping intervals
+    
+    Returns:
+        list: sorted [(start_sec, end_sec)] intervals
+    """
+    windows = sorted((max(start_sec - padding, 0.0), end_sec + padding)
+                     for start_sec, end_sec in (video_data['time'] for video_data in video_data_list))
+    
+    merged = []
+    for start_sec, end_sec in windows:
+        if merged and start_sec <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end_sec)
+        else:
+            merged.append([start_sec, end_sec])
+    
+    if duration is not None:
+        merged = [[start_sec, min(end_sec, duration)] for start_sec, end_sec in merged if start_sec < duration]
+    # Rounded to the precision passed to yt-dlp, so clip times map exactly onto the section files
+    return [(round(start_sec, 2), round(end_sec, 2)) for start_sec, end_sec in merged]
+
+
+def plan_sections(ytb_id, video_data_list, proxy=None, padding=DEFAULT_SECTION_PADDING,
+                  max_coverage=DEFAULT_SECTION_MAX_COVERAGE):
+    """
+    Plan the sections to download for a ytb_id
+    
+    Returns:
+        list: [(start_sec, end_sec)] sections, or None if the full video should be downloaded
+    """
+    duration = get_video_duration(ytb_id, proxy)
+    if duration is None:
+        logging.info(f"Duration of {ytb_id} unknown, downloading full video")
+        return None
+    
+    sections = merge_clip_windows(video_data_list, padding, duration)
+    covered = sum(end_sec - start_sec for start_sec, end_sec in sections)
+    if covered > max_coverage * duration:
+        logging.info(f"Sections of {ytb_id} cover {covered:.1f}s of {duration:.1f}s, downloading full video")
+        return None
+    
+    logging.info(f"Downloading {len(sections)} sections of {ytb_id} covering {covered:.1f}s of {duration:.1f}s")
+    return sections
+
+
+def section_video_path(raw_vid_root, ytb_id, section):
+    """Path of a downloaded section of a raw video"""
+    return os.path.join(raw_vid_root, f"{ytb_id}.{section[0]:.2f}-{section[1]:.2f}.mp4")
+
+
+def map_to_sections(video_data_list, sections):
+    """
+    Map clip times onto downloaded section files
+    
+    Args:
+        video_data_list: list of video processing data for this ytb_id
+        sections: [(start_sec, end_sec, path)] of the downloaded sections
+    
+    Returns:
+        list: [(section path, list of video processing data with times relative to the section)]
+    """
+    grouped = defaultdict(list)
+    for video_data in video_data_list:
+        start_sec, end_sec = video_data['time']
+        for section_start, section_end, path in sections:
+            if section_start <= start_sec and end_sec <= section_end:
+                grouped[path].append(dict(video_data, time=(start_sec - section_start, end_sec - section_start)))
+                break
+        else:
+            logging.error(f"No downloaded section covers {video_data['save_name']} at {video_data['time']}")
+    return [(path, grouped[path]) for _, _, path in sections if grouped[path]]
+
+
+def expand(bbox, ratio):
+    """Expand a normalized [top, bottom, left, right] bbox by ratio, clipped to 0~1"""
+    top, bottom = max(bbox[0] - ratio, 0), min(bbox[1] + ratio, 1)
+    left, right = max(bbox[2] - ratio, 0), min(bbox[3] + ratio, 1)
+    return top, bottom, left, right
+
+
+def to_square(bbox):
+    """Shrink a bbox to the largest square sharing its center"""
+    top, bottom, leftx, right = bbox
+    h = bottom - top
+    w = right - leftx
+    c = min(h, w) / 2
+    c_h = (top + bottom) / 2
+    c_w = (leftx + right) / 2
+
+    top, bottom = c_h - c, c_h + c
+    leftx, right = c_w - c, c_w + c
+    return top, bottom, leftx, right
+
+
+def denorm(bbox, height, width):
+    """Convert a normalized bbox to pixel coordinates"""
+    top = round(bbox[0] * height)
+    bottom = round(bbox[1] * height)
+    left = round(bbox[2] * width)
+    right = round(bbox[3] * width)
+    return top, bottom, left, right
+
+
+def random_access_profile():
+    """True when processed clips are encoded with the random_access profile"""
+    return ENCODE_SETTINGS.get('profile') == 'random_access'
+
+
+def encoder_options(threads):
+    """
+    Encoder settings of one encode, as taken by the processing backends: thread count, codec,
+    preset and CRF
+    
+    The random_access profile adds a fixed GOP without scene-cut keyframes, so any frame is
+    at most gop - 1 frames of decoding away from a keyframe, and moves the moov atom to the
+    front of the file, so a reader can start before the whole clip is fetched.
+    """
+    encoder = {'threads': threads, 'codec': ENCODE_SETTINGS['codec'], 'preset': get_governor().preset_for(threads),
+               'crf': ENCODE_SETTINGS['crf']}
+    if random_access_profile():
+        encoder.update({'gop': ENCODE_SETTINGS['gop'], 'pix_fmt': 'yuv420p', 'faststart': True,
+                        'fps': ENCODE_SETTINGS['fps']})
+    return encoder
+
+
+def crop_filter(bbox, width, height):
+    """Build the ffmpeg crop filter for a normalized bbox on a width x height video"""
+    top, bottom, left, right = to_square(denorm(expand(bbox, ENCODE_SETTINGS['expand_ratio']), height, width))
+    return f"crop=w={right - left}:h={bottom - top}:x={left}:y={top}"
+
+
+def output_filter(bbox, width, height):
+    """Video filters of an encoded clip: the crop, then the fps and size of the random_access profile"""
+    filters = crop_filter(bbox, width, height)
+    if random_access_profile():
+        size = ENCODE_SETTINGS['size']
+        filters += f",fps={ENCODE_SETTINGS['fps']},scale={size}:{size}:flags=bicubic,setsar=1"
+    return filters
+
+
+def keyframe_sidecar(processed_path):
+    """
+    Write the keyframe timestamps of a processed clip to <clip>.keyframes.json when the
+    random_access profile is on, so readers can seek without probing the clip
+    
+    Returns:
+        str: path of the sidecar, or None without the profile or if the clip cannot be probed
+    """
+    if not random_access_profile():
+        return None
+    try:
+        load_keyframes(processed_path)
+        return keyframe_index_path(processed_path)
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        logging.warning(f"Cannot index keyframes of {processed_path}: {e}")
+        return None
+
+
+def get_video_size(raw_vid_path):
+    """
+    Read frame size of a video from the probe cache
+    
+    Returns:
+        tuple: (width, height), or None if the video cannot be opened
+    """
+    try:
+        info = get_video_info(raw_vid_path)
+        return info['width'], info['height']
+    except FileNotFoundError as e:
+        if not os.path.exists(raw_vid_path):
+            return None
+        logging.warning(f"ffprobe unavailable ({e}), falling back to OpenCV")
+    except (subprocess.CalledProcessError, ValueError, KeyError) as e:
+        logging.error(f"Cannot probe video {raw_vid_path}: {e}")
+        return None
+    
+    import cv2  # Only needed without ffprobe, and slow to import
+    cap = cv2.VideoCapture(raw_vid_path)
+    if not cap.isOpened():
+        return None
         
-    if not os.path.exists(video_path):
-        logging.error(f"Download completed but file not found: {video_path}")
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    return width, height
+
+
+def has_audio_stream(raw_vid_path):
+    """Check whether a video has at least one audio stream"""
+    try:
+        return get_video_info(raw_vid_path)['has_audio']
+    except Exception as e:
+        logging.warning(f"Cannot probe audio streams of {raw_vid_path}: {e}")
         return False
+
+
+def seek_args(raw_vid_path, time, seek_mode):
+    """
+    Build the input and output time arguments of an ffmpeg clip command
     
-    logging.info(f"Successfully downloaded: {ytb_id}")
-    return True
+    With seek_mode 'keyframe' the input is seeked to the keyframe preceding the clip start,
+    so ffmpeg skips decoding everything before it, and the clip is then trimmed exactly from
+    there. Input seeking shifts the timeline so that the seek point becomes 0.
+    
+    Returns:
+        tuple: (input args, output args)
+    """
+    start_sec, end_sec = time
+    offset = 0.0
+    if seek_mode == 'keyframe':
+        offset = preceding_keyframe(load_keyframes(raw_vid_path), start_sec)
+    
+    input_args = f"-ss {offset} " if offset > 0 else ""
+    output_args = f"-ss {secs_to_timestr(start_sec - offset)} -to {secs_to_timestr(end_sec - offset)}"
+    return input_args, output_args
+
+
+def backend_clip(raw_vid_path, save_folder, save_vid_name, bbox, time, width, height, seek_mode):
+    """
+    Describe a clip for the processing backend, see ProcessingBackend
+    
+    With seek_mode 'keyframe' the input may be seeked to the keyframe preceding the clip
+    start, as in seek_args.
+    """
+    start_sec, end_sec = time
+    seek = preceding_keyframe(load_keyframes(raw_vid_path), start_sec) if seek_mode == 'keyframe' else 0.0
+    return {'save_name': save_vid_name, 'out_path': os.path.join(save_folder, save_vid_name),
+            'start': start_sec, 'end': end_sec, 'seek': seek, 'filters': output_filter(bbox, width, height)}
 
 
-def process_ffmpeg(raw_vid_path, save_folder, save_vid_name, bbox, time):
+@timed('process_ffmpeg', none_is_failure=True)
+def process_ffmpeg(raw_vid_path, save_folder, save_vid_name, bbox, time, seek_mode=DEFAULT_SEEK_MODE):
     """
-    Process raw video with ffmpeg to crop and trim
+    Process raw video with the processing backend to crop and trim
     
     Args:
         raw_vid_path: path to raw video
@@ -77,60 +461,23 @@ def process_ffmpeg(raw_vid_path, save_folder, save_vid_name, bbox, time):
         save_vid_name: name of processed video
         bbox: bounding box [top, bottom, left, right] normalized to 0~1
         time: (begin_sec, end_sec)
+        seek_mode: 'output' to decode from the start, 'keyframe' to seek the input first
     
     Returns:
         str: path to processed video file, or None if failed
     """
-    def secs_to_timestr(secs):
-        hrs = secs // (60 * 60)
-        min = (secs - hrs * 3600) // 60
-        sec = secs % 60
-        end = (secs - int(secs)) * 100
-        return "{:02d}:{:02d}:{:02d}.{:02d}".format(int(hrs), int(min), int(sec), int(end))
-
-    def expand(bbox, ratio):
-        top, bottom = max(bbox[0] - ratio, 0), min(bbox[1] + ratio, 1)
-        left, right = max(bbox[2] - ratio, 0), min(bbox[3] + ratio, 1)
-        return top, bottom, left, right
-
-    def to_square(bbox):
-        top, bottom, leftx, right = bbox
-        h = bottom - top
-        w = right - leftx
-        c = min(h, w) / 2
-        c_h = (top + bottom) / 2
-        c_w = (leftx + right) / 2
-
-        top, bottom = c_h - c, c_h + c
-        leftx, right = c_w - c, c_w + c
-        return top, bottom, leftx, right
-
-    def denorm(bbox, height, width):
-        top = round(bbox[0] * height)
-        bottom = round(bbox[1] * height)
-        left = round(bbox[2] * width)
-        right = round(bbox[3] * width)
-        return top, bottom, left, right
-
     out_path = os.path.join(save_folder, save_vid_name)
     
     try:
         logging.info(f"Processing video: {save_vid_name} with bbox {bbox} and time {time}")
-        cap = cv2.VideoCapture(raw_vid_path)
-        if not cap.isOpened():
+        size = get_video_size(raw_vid_path)
+        if size is None:
             logging.error(f"Cannot open video: {raw_vid_path}")
             return None
             
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        cap.release()
-        
-        top, bottom, left, right = to_square(denorm(expand(bbox, 0.02), height, width))
-        start_sec, end_sec = time
-
-        cmd = f"ffmpeg -i '{raw_vid_path}' -vf crop=w={right - left}:h={bottom - top}:x={left}:y={top} -ss {secs_to_timestr(start_sec)} -to {secs_to_timestr(end_sec)} -loglevel error -y '{out_path}'"
-        logging.info(f"FFmpeg command: {cmd}")
-        success, output = run_command(cmd, f"Processing video {save_vid_name}")
+        width, height = size
+        clip = backend_clip(raw_vid_path, save_folder, save_vid_name, bbox, time, width, height, seek_mode)
+        success = get_backend().cut_clip(raw_vid_path, clip, encoder_options(get_governor().threads_per_job()))
         
         if success and os.path.exists(out_path):
             logging.info(f"Successfully processed: {save_vid_name}")
@@ -144,13 +491,239 @@ def process_ffmpeg(raw_vid_path, save_folder, save_vid_name, bbox, time):
         return None
 
 
-def load_and_group_data(file_path):
+@timed('process_clips')
+def process_clips(raw_vid_path, save_folder, video_data_list, seek_mode=DEFAULT_SEEK_MODE):
+    """
+    Process every clip of a raw video with the processing backend
+    
+    A backend that shares its demuxer opens the raw video once for all clips, others run
+    process_ffmpeg clip by clip.
+    
+    Returns:
+        dict: {save_name: path to processed video file, or None if failed}
+    """
+    backend = get_backend()
+    if not backend.shares_demuxer:
+        return {video_data['save_name']: process_ffmpeg(raw_vid_path, save_folder, video_data['save_name'],
+                                                        video_data['bbox'], video_data['time'], seek_mode)
+                for video_data in video_data_list}
+    
+    results = {video_data['save_name']: None for video_data in video_data_list}
+    try:
+        size = get_video_size(raw_vid_path)
+        if size is None:
+            logging.error(f"Cannot open video: {raw_vid_path}")
+            return results
+        width, height = size
+        clips = [backend_clip(raw_vid_path, save_folder, video_data['save_name'], video_data['bbox'],
+                              video_data['time'], width, height, seek_mode)
+                 for video_data in video_data_list]
+        logging.info(f"Processing {len(clips)} clips from {os.path.basename(raw_vid_path)} with the {backend.name} backend")
+        written = backend.cut_clips(raw_vid_path, clips, encoder_options(get_governor().threads_per_job()))
+    except Exception as e:
+        logging.error(f"Error processing clips of {raw_vid_path}: {e}")
+        return results
+    
+    for clip in clips:
+        if written.get(clip['save_name']) and os.path.exists(clip['out_path']):
+            logging.info(f"Successfully processed: {clip['save_name']}")
+            results[clip['save_name']] = clip['out_path']
+        else:
+            logging.error(f"Failed to process video: {clip['save_name']}")
+    return results
+
+
+@timed('process_frames', none_is_failure=True)
+def process_frames(raw_vid_path, ytb_id, save_vid_name, bbox, time, seek_mode=DEFAULT_SEEK_MODE, alias_names=()):
+    """
+    Crop, trim and resize a clip into raw RGB frames stored by the frame sink, without encoding it
+    
+    Args:
+        raw_vid_path: path to raw video
+        ytb_id: YouTube video ID of the clip
+        save_vid_name: name the clip is indexed under
+        bbox: bounding box [top, bottom, left, right] normalized to 0~1
+        time: (begin_sec, end_sec)
+        seek_mode: 'output' to decode from the start, 'keyframe' to seek the input first
+        alias_names: duplicate clip names indexed to the same frames
+    
+    Returns:
+        str: save_vid_name once its frames are stored, or None if failed
+    """
+    try:
+        size = get_video_size(raw_vid_path)
+        if size is None:
+            logging.error(f"Cannot open video: {raw_vid_path}")
+            return None
+        
+        width, height = size
+        sink = get_frame_sink()
+        input_args, output_args = seek_args(raw_vid_path, time, seek_mode)
+        threads = get_governor().threads_per_job()
+        cmd = (['ffmpeg', '-threads', str(threads)] + input_args.split() + ['-i', raw_vid_path,
+               '-vf', sink.video_filter(crop_filter(bbox, width, height))] + output_args.split()
+               + ['-loglevel', 'error'] + sink.output_args())
+        logging.info(f"Extracting frames of {save_vid_name} with bbox {bbox} and time {time}")
+        frames = sink.write_clip(cmd, save_vid_name, ytb_id, alias_names)
+        if frames:
+            logging.info(f"Stored {frames} frames of {save_vid_name}")
+            return save_vid_name
+        logging.error(f"Failed to extract frames of {save_vid_name}")
+        return None
+    
+    except Exception as e:
+        logging.error(f"Error extracting frames of {save_vid_name}: {e}")
+        return None
+
+
+def build_batch_command(raw_vid_path, save_folder, video_data_list, width, height, with_audio, offset=0.0):
+    """
+    Build a single ffmpeg command that cuts every clip in video_data_list out of one decode.
+    
+    The decoded stream is split once, and each branch is trimmed and cropped into its own output.
+    A non-zero offset seeks the input there first, and clip times are shifted to match.
+    
+    Returns:
+        list: ffmpeg arguments
+    """
+    count = len(video_data_list)
+    threads = get_governor().threads_per_job()
+    # The encoders of all outputs run at once, so they share the threads of this ffmpeg run
+    encode = encoder_cli_args(encoder_options(max(1, threads // count)))
+    graph = ["[0:v]split={}{}".format(count, "".join(f"[v{i}]" for i in range(count)))]
+    if with_audio:
+        graph.append("[0:a]asplit={}{}".format(count, "".join(f"[a{i}]" for i in range(count))))
+    
+    outputs = []
+    for i, video_data in enumerate(video_data_list):
+        start_sec, end_sec = (t - offset for t in video_data['time'])
+        crop = output_filter(video_data['bbox'], width, height)
+        graph.append(f"[v{i}]trim=start={start_sec}:end={end_sec},setpts=PTS-STARTPTS,{crop}[vout{i}]")
+        outputs += ['-map', f"[vout{i}]"]
+        if with_audio:
+            graph.append(f"[a{i}]atrim=start={start_sec}:end={end_sec},asetpts=PTS-STARTPTS[aout{i}]")
+            outputs += ['-map', f"[aout{i}]"]
+        outputs += encode + [os.path.join(save_folder, video_data['save_name'])]
+    
+    input_args = ['-ss', str(offset)] if offset > 0 else []
+    return (['ffmpeg', '-threads', str(threads)] + input_args + ['-i', raw_vid_path, '-filter_complex', ';'.join(graph),
+             '-loglevel', 'error', '-progress', 'pipe:1', '-nostats', '-y'] + outputs)
+
+
+@timed('process_ffmpeg_batch')
+def process_ffmpeg_batch(raw_vid_path, save_folder, video_data_list, max_clips=None, seek_mode=DEFAULT_SEEK_MODE):
+    """
+    Process all clips of a raw video with one ffmpeg invocation per batch, so the
+    raw video is decoded once instead of once per clip
+    
+    Args:
+        raw_vid_path: path to raw video
+        save_folder: folder to save processed videos
+        video_data_list: list of video processing data for this raw video
+        max_clips: maximum number of clips per ffmpeg invocation
+        seek_mode: 'output' to decode from the start, 'keyframe' to seek each batch's input first
+    
+    Returns:
+        dict: {save_name: path to processed video file, or None if failed}
+    """
+    max_clips = max_clips or DEFAULT_BATCH_MAX_CLIPS
+    results = {video_data['save_name']: None for video_data in video_data_list}
+    
+    try:
+        size = get_video_size(raw_vid_path)
+        if size is None:
+            logging.error(f"Cannot open video: {raw_vid_path}")
+            return results
+        width, height = size
+        with_audio = has_audio_stream(raw_vid_path)
+        keyframes = load_keyframes(raw_vid_path) if seek_mode == 'keyframe' else []
+    except Exception as e:
+        logging.error(f"Error probing {raw_vid_path}: {e}")
+        return results
+    
+    if seek_mode == 'keyframe':
+        # Keep clips that are close in time in the same batch, so each batch seeks past as much as possible
+        video_data_list = sorted(video_data_list, key=lambda video_data: video_data['time'][0])
+    
+    for i in range(0, len(video_data_list), max_clips):
+        batch = video_data_list[i:i + max_clips]
+        names = [video_data['save_name'] for video_data in batch]
+        offset = preceding_keyframe(keyframes, min(video_data['time'][0] for video_data in batch)) if keyframes else 0.0
+        
+        cmd = build_batch_command(raw_vid_path, save_folder, batch, width, height, with_audio, offset)
+        logging.info(f"FFmpeg batch command: {shlex.join(cmd)}")
+        success, _ = SubprocessBackend().run(cmd, f"Processing {len(batch)} clips from {os.path.basename(raw_vid_path)}")
+        
+        if not success:
+            # A failed batch may leave truncated outputs behind, so every clip is redone on its own.
+            # This keeps one bad clip from failing the rest and keeps per-clip error reporting.
+            logging.warning(f"Batch failed for {', '.join(names)}, falling back to per-clip processing")
+            for video_data in batch:
+                results[video_data['save_name']] = process_ffmpeg(
+                    raw_vid_path, save_folder, video_data['save_name'], video_data['bbox'], video_data['time'],
+                    seek_mode)
+            continue
+        
+        for save_name in names:
+            out_path = os.path.join(save_folder, save_name)
+            if os.path.exists(out_path) and os.path.getsize(out_path) > 0:
+                logging.info(f"Successfully processed: {save_name}")
+                results[save_name] = out_path
+            else:
+                logging.error(f"Failed to process video: {save_name}")
+    
+    return results
+
+
+def check_seek_matches(raw_vid_path, bbox, time):
+    """
+    Check that keyframe seeking yields the same frames as the slow output-seek path
+    
+    Both paths are decoded and cropped without encoding, and the per-frame hashes are compared.
+    
+    Returns:
+        bool: True if both paths produce identical frames
+    """
+    size = get_video_size(raw_vid_path)
+    if size is None:
+        logging.error(f"Cannot open video: {raw_vid_path}")
+        return False
+    crop = crop_filter(bbox, *size)
+    
+    frame_hashes = {}
+    for seek_mode in ('output', 'keyframe'):
+        input_args, output_args = seek_args(raw_vid_path, time, seek_mode)
+        cmd = f"ffmpeg -threads {get_governor().threads_per_job()} {input_args}-i '{raw_vid_path}' -vf {crop} {output_args} -an -loglevel error -f framemd5 -"
+        success, output = run_command(cmd, f"Hashing frames of {os.path.basename(raw_vid_path)} ({seek_mode} seek)")
+        if not success:
+            return False
+        # framemd5 lines: stream_index, dts, pts, duration, size, hash
+        frame_hashes[seek_mode] = [line.rsplit(',', 1)[-1].strip()
+                                   for line in output.splitlines() if line and not line.startswith('#')]
+    
+    if frame_hashes['output'] != frame_hashes['keyframe']:
+        logging.error(f"Keyframe seek mismatch for {raw_vid_path} at {time}: "
+                      f"{len(frame_hashes['output'])} vs {len(frame_hashes['keyframe'])} frames")
+        return False
+    return True
+
+
+def load_and_group_data(file_path, shard_index=0, shard_count=1):
     """
     Load data from JSON and group by ytb_id for efficient processing
     
+    A compiled metadata index (see metadata_index.py) is memory-mapped instead of parsed.
+    With shard_count > 1 only the ytb_ids of shard shard_index are returned (see sharding.py).
+    
     Returns:
         dict: {ytb_id: [list of video processing data]}
     """
+    if shard_count > 1:
+        return filter_shard(load_and_group_data(file_path), shard_index, shard_count)
+    
+    if is_metadata_index(file_path):
+        return MetadataIndex(file_path)
+    
     with open(file_path) as f:
         data_dict = json.load(f)
     
@@ -171,6 +744,111 @@ def load_and_group_data(file_path):
     return grouped_data
 
 
+def clip_spec_key(ytb_id, time, bbox, encode_settings=None):
+    """
+    Content key of a clip job: clips with the same key produce identical files
+    
+    Built from the ytb_id, the time window rounded to the metadata precision, the crop
+    rectangle and the encode settings.
+    """
+    spec = {
+        'ytb_id': ytb_id,
+        'time': [round(t, 2) for t in time],
+        'bbox': [round(b, 4) for b in bbox],
+        'encode': encode_settings if encode_settings is not None else ENCODE_SETTINGS,
+    }
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def dedup_clips(ytb_id, video_data_list):
+    """
+    Collapse clips of a ytb_id that share a clip-spec key
+    
+    Returns:
+        tuple: (list of unique video processing data, {primary save_name: [duplicate save_names]})
+    """
+    primaries = {}
+    unique_list = []
+    duplicates = defaultdict(list)
+    
+    for video_data in video_data_list:
+        key = clip_spec_key(ytb_id, video_data['time'], video_data['bbox'])
+        if key in primaries:
+            duplicates[primaries[key]].append(video_data['save_name'])
+        else:
+            primaries[key] = video_data['save_name']
+            unique_list.append(video_data)
+    
+    return unique_list, dict(duplicates)
+
+
+def clip_seconds(video_data_list):
+    """Total duration in seconds of a list of clips"""
+    return sum(video_data['time'][1] - video_data['time'][0] for video_data in video_data_list)
+
+
+def build_dedup_report(grouped_data):
+    """
+    Summarize how much transcode work clip-spec deduplication skips across the dataset
+    
+    Returns:
+        dict: clip counts and clip seconds, total and skipped
+    """
+    total_clips = unique_clips = 0
+    total_secs = skipped_secs = 0.0
+    top_ytb_ids = []
+    
+    for ytb_id, video_data_list in grouped_data.items():
+        unique_list, duplicates = dedup_clips(ytb_id, video_data_list)
+        total_clips += len(video_data_list)
+        unique_clips += len(unique_list)
+        clip_secs = clip_seconds(video_data_list)
+        total_secs += clip_secs
+        skipped_secs += clip_secs - clip_seconds(unique_list)
+        if duplicates:
+            top_ytb_ids.append((sum(len(names) for names in duplicates.values()), ytb_id))
+    
+    top_ytb_ids.sort(reverse=True)
+    return {
+        'total_clips': total_clips,
+        'unique_clips': unique_clips,
+        'skipped_clips': total_clips - unique_clips,
+        'total_clip_seconds': round(total_secs, 2),
+        'skipped_clip_seconds': round(skipped_secs, 2),
+        'skipped_fraction': round((total_clips - unique_clips) / total_clips, 4) if total_clips else 0.0,
+        'top_ytb_ids': [{'ytb_id': ytb_id, 'skipped_clips': count} for count, ytb_id in top_ytb_ids[:20]],
+    }
+
+
+def link_duplicates(processed_path, duplicate_names):
+    """
+    Fill in duplicate clip names next to a processed clip by hardlink, or by copy if linking fails
+    
+    Returns:
+        tuple: (list of created paths, bool True if all duplicates were created)
+    """
+    save_folder = os.path.dirname(processed_path)
+    created = []
+    all_success = True
+    
+    for duplicate_name in duplicate_names:
+        duplicate_path = os.path.join(save_folder, duplicate_name)
+        try:
+            if os.path.exists(duplicate_path):
+                os.remove(duplicate_path)
+            try:
+                os.link(processed_path, duplicate_path)
+            except OSError:
+                shutil.copy2(processed_path, duplicate_path)
+            created.append(duplicate_path)
+            logging.info(f"Filled duplicate {duplicate_name} from {os.path.basename(processed_path)}")
+        except Exception as e:
+            logging.error(f"Failed to fill duplicate {duplicate_name}: {e}")
+            all_success = False
+    
+    return created, all_success
+
+
 class ThreadSafeProgress:
     """Thread-safe progress tracking"""
     
@@ -204,6 +882,14 @@ class ThreadSafeProgress:
         """Get number of completed ytb_ids"""
         with self.lock:
             return len(self.completed_ytb_ids)
+    
+    def clip_stages(self, ytb_id):
+        """Per-clip stages are not tracked in the progress file, see ProgressJournal"""
+        return {}
+    
+    def mark_clips(self, ytb_id, save_names, stage):
+        """Per-clip stages are not tracked in the progress file, see ProgressJournal"""
+        pass
 
 
 def load_progress(progress_file):
@@ -235,14 +921,17 @@ def run_command(cmd, description=""):
         return False, e.stderr
 
 
+@timed('move_to_dropbox')
 def move_to_dropbox(file_path, dropbox_path):
     """Move processed video to Dropbox using rclone"""
     filename = os.path.basename(file_path)
+    size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
     
     cmd = f"rclone move '{file_path}' '{dropbox_path}'"
     success, output = run_command(cmd, f"Moving {filename} to Dropbox")
     
     if success:
+        METRICS.inc('upload_bytes_total', size)
         logging.info(f"Successfully moved {filename} to Dropbox")
         return True
     else:
@@ -250,6 +939,35 @@ def move_to_dropbox(file_path, dropbox_path):
         return False
 
 
+def upload_files(uploads, uploader=None):
+    """
+    Move files to Dropbox, through the batch uploader if there is one
+    
+    Args:
+        uploads: list of (file path, remote folder)
+        uploader: BatchUploader instance, or None to run one rclone move per file
+    
+    Returns:
+        dict: {file path: True if moved}
+    """
+    if uploader is None:
+        return {file_path: move_to_dropbox(file_path, remote) for file_path, remote in uploads}
+    
+    futures = {file_path: uploader.submit(file_path, remote) for file_path, remote in uploads}
+    return {file_path: future.result() for file_path, future in futures.items()}
+
+
+def copy_on_dropbox(src_path, dst_path):
+    """Server-side copy of a file already on Dropbox using rclone"""
+    cmd = f"rclone copyto '{src_path}' '{dst_path}'"
+    success, output = run_command(cmd, f"Copying {src_path} to {dst_path} on Dropbox")
+    
+    if not success:
+        logging.error(f"Failed to copy {src_path} to {dst_path}: {output}")
+    return success
+
+
+@timed('cleanup_files')
 def cleanup_files(*file_paths):
     """Remove local files after successful upload"""
     for file_path in file_paths:
@@ -261,75 +979,670 @@ def cleanup_files(*file_paths):
                 logging.error(f"Failed to cleanup {file_path}: {e}")
 
 
-def process_ytb_id(ytb_id, video_data_list, raw_vid_root, processed_vid_root, progress_tracker, proxy=None):
+class ProcessOptions:
+    """Processing options shared by every ytb_id of a run"""
+    
+    def __init__(self, extract_mode=DEFAULT_EXTRACT_MODE, seek_mode=DEFAULT_SEEK_MODE, seek_check=False,
+                 download_mode=DEFAULT_DOWNLOAD_MODE, dedup=True, dedup_fill=DEFAULT_DEDUP_FILL, min_free_disk=0,
+                 output_mode=DEFAULT_OUTPUT_MODE):
+        """
+        Args:
+            extract_mode: 'clip' to run ffmpeg per clip, 'batch' to cut all clips from one decode
+            seek_mode: 'output' to decode from the start, 'keyframe' to seek to the preceding keyframe
+            seek_check: verify keyframe seeking against the slow path on the first clip before using it
+            download_mode: 'full' to download the whole video, 'sections' to download only the clip time ranges
+            dedup: transcode clips sharing a clip-spec key once and fill in the duplicates
+            dedup_fill: 'link' to hardlink duplicates locally, 'remote_copy' to copy them on Dropbox after upload
+            min_free_disk: bytes that must stay free in the raw folder before a download starts, 0 to disable
+            output_mode: 'mp4' to upload every clip as its own file, 'shards' to pack clips into tar shards,
+                'frames' to store cropped raw frames locally for training
+        """
+        self.extract_mode = extract_mode
+        self.seek_mode = seek_mode
+        self.seek_check = seek_check
+        self.download_mode = download_mode
+        self.dedup = dedup
+        self.dedup_fill = dedup_fill
+        self.min_free_disk = min_free_disk
+        self.output_mode = output_mode
+    
+    @classmethod
+    def from_env(cls):
+        """Read options from CELEBV_* environment variables"""
+        return cls(
+            extract_mode=os.getenv('CELEBV_EXTRACT_MODE', DEFAULT_EXTRACT_MODE),
+            seek_mode=os.getenv('CELEBV_SEEK_MODE', DEFAULT_SEEK_MODE),
+            seek_check=os.getenv('CELEBV_SEEK_CHECK', '0') == '1',
+            download_mode=os.getenv('CELEBV_DOWNLOAD_MODE', DEFAULT_DOWNLOAD_MODE),
+            dedup=os.getenv('CELEBV_DEDUP', '1') == '1',
+            dedup_fill=os.getenv('CELEBV_DEDUP_FILL', DEFAULT_DEDUP_FILL),
+            min_free_disk=int(float(os.getenv('CELEBV_MIN_FREE_DISK_GB', DEFAULT_MIN_FREE_DISK_GB)) * 1024 ** 3),
+            output_mode=os.getenv('CELEBV_OUTPUT_MODE', DEFAULT_OUTPUT_MODE),
+        )
+
+
+class YtbJob:
+    """State of one ytb_id as it moves through the download, transcode and upload stages"""
+    
+    def __init__(self, ytb_id, video_data_list):
+        self.ytb_id = ytb_id
+        self.video_data_list = video_data_list
+        self.unique_list = video_data_list
+        self.duplicates = {}
+        self.sources = []  # [(raw video or section path, video processing data list)]
+        self.processed_files = []
+        self.success = True
+        self.busy_seconds = 0.0  # Time spent in stages, excluding waits between them
+
+
+def wait_for_free_disk(path, min_free_bytes, poll_interval=DEFAULT_DISK_POLL_INTERVAL):
+    """Block until the filesystem holding path has at least min_free_bytes free"""
+    waiting = False
+    while shutil.disk_usage(path).free < min_free_bytes:
+        if not waiting:
+            logging.info(f"Free disk in {path} below {min_free_bytes / 1024 ** 3:.1f} GB, pausing downloads")
+            waiting = True
+        time.sleep(poll_interval)
+    if waiting:
+        logging.info(f"Free disk in {path} recovered, resuming downloads")
+
+
+def clip_duration(video_data):
+    """Expected length of a processed clip in seconds"""
+    start_sec, end_sec = video_data['time']
+    return end_sec - start_sec
+
+
+def resume_job(job, progress_tracker, processed_vid_root):
     """
-    Process all videos for a single YouTube ID
+    Drop the clips a previous run already finished from a job
     
-    Args:
-        ytb_id: YouTube video ID
-        video_data_list: List of video processing data for this ytb_id
-        raw_vid_root: Directory for raw videos
-        processed_vid_root: Directory for processed videos
-        progress_tracker: ThreadSafeProgress instance
-        proxy: Proxy URL if needed
+    Uploaded clips are skipped. Clips that were transcoded but not uploaded, and whose file is
+    still in processed_vid_root, only go through the upload stage. With a verifier, those files
+    must pass verification, and a clip file that passes is reused even if its transcode was
+    never recorded; files that fail are removed and their clips transcoded again.
+    """
+    stages = progress_tracker.clip_stages(job.ytb_id)
+    verifier = get_verifier()
+    if not stages and verifier is None:
+        return
+    
+    candidates = {}
+    for video_data in job.video_data_list:
+        clip_stages = stages.get(video_data['save_name'], set())
+        processed_path = os.path.join(processed_vid_root, video_data['save_name'])
+        if 'uploaded' not in clip_stages and os.path.exists(processed_path) \
+                and ('transcoded' in clip_stages or verifier is not None):
+            candidates[video_data['save_name']] = processed_path
+    if not candidates and not stages:
+        return
+    
+    if verifier is not None:
+        expected = {video_data['save_name']: clip_duration(video_data) for video_data in job.video_data_list}
+        verified = verifier.verify_many([(path, {'expected_duration': expected[save_name]})
+                                         for save_name, path in candidates.items()])
+    else:
+        verified = {path: True for path in candidates.values()}
+    
+    remaining = []
+    resumed_uploads = 0
+    redone = 0
+    unrecorded = []
+    for video_data in job.video_data_list:
+        save_name = video_data['save_name']
+        if 'uploaded' in stages.get(save_name, set()):
+            continue
+        processed_path = candidates.get(save_name)
+        if processed_path is not None and verified[processed_path]:
+            job.processed_files.append(processed_path)
+            resumed_uploads += 1
+            if 'transcoded' not in stages.get(save_name, set()):
+                unrecorded.append(save_name)
+        else:
+            if processed_path is not None:
+                cleanup_files(processed_path, keyframe_index_path(processed_path))
+                redone += 1
+            remaining.append(video_data)
+    if unrecorded:
+        progress_tracker.mark_clips(job.ytb_id, unrecorded, 'transcoded')
+    
+    logging.info(f"Resuming {job.ytb_id}: {len(job.video_data_list) - len(remaining) - resumed_uploads} clips done, "
+                 f"{resumed_uploads} to upload, {len(remaining)} to transcode"
+                 + (f" ({redone} failed verification)" if redone else ""))
+    job.video_data_list = job.unique_list = remaining
+
+
+def release_raw_files(raw_files):
+    """Let the raw cache evict the cached copies of raw files a job is done with"""
+    raw_cache = get_raw_cache()
+    if raw_cache is not None:
+        for raw_file in raw_files:
+            raw_cache.release(raw_file)
+
+
+def discard_raw_files(job):
+    """
+    Remove the raw files of a job that stopped before its upload stage cleaned them up, and
+    unpin them from the raw cache so their cached copies can be evicted
+    """
+    raw_files = [source_path for source_path, _ in job.sources]
+    if any(os.path.exists(raw_file) for raw_file in raw_files):
+        logging.warning(f"Removing raw files of {job.ytb_id}, its job stopped early")
+    cleanup_files(*raw_files, *(keyframe_index_path(raw_file) for raw_file in raw_files))
+    release_raw_files(raw_files)
+    job.sources = []
+
+
+def download_stage(job, raw_vid_root, proxy=None, options=None, progress_tracker=None):
+    """
+    Download stage: deduplicate the clips of a job and download its raw video or sections
     
     Returns:
-        bool: True if all videos processed successfully
+        bool: True if the job can move on to transcoding
     """
+    options = options or ProcessOptions()
     thread_id = threading.current_thread().name
+    ytb_id = job.ytb_id
     logging.info(f"[{thread_id}] Starting processing: {ytb_id}")
     
-    raw_vid_path = os.path.join(raw_vid_root, f"{ytb_id}.mp4")
+    if not job.video_data_list:
+        logging.info(f"[{thread_id}] No clips of {ytb_id} left to transcode, skipping download")
+        return True
     
-    # Download raw video
-    if not download(raw_vid_path, ytb_id, proxy):
-        logging.error(f"[{thread_id}] Failed to download {ytb_id}, skipping all related videos")
-        return False
+    if options.dedup:
+        job.unique_list, job.duplicates = dedup_clips(ytb_id, job.video_data_list)
+        if job.duplicates:
+            logging.info(f"[{thread_id}] {len(job.video_data_list) - len(job.unique_list)} duplicate clips of {ytb_id} "
+                         f"will be filled in from {len(job.duplicates)} transcodes")
     
-    processed_files = []
-    all_success = True
+    if options.min_free_disk:
+        wait_for_free_disk(raw_vid_root, options.min_free_disk)
+    
+    sections = plan_sections(ytb_id, job.unique_list, proxy) if options.download_mode == 'sections' else None
+    
+    # Download raw video, or only the sections the clips need
+    if sections is None:
+        raw_vid_path = os.path.join(raw_vid_root, f"{ytb_id}.mp4")
+        last_clip_end = max(video_data['time'][1] for video_data in job.unique_list)
+        if not download(raw_vid_path, ytb_id, proxy, min_duration=last_clip_end):
+            logging.error(f"[{thread_id}] Failed to download {ytb_id}, skipping all related videos")
+            job.success = False
+            return False
+        job.sources = [(raw_vid_path, job.unique_list)]
+    else:
+        downloaded = []
+        for section in sections:
+            section_path = section_video_path(raw_vid_root, ytb_id, section)
+            if not download(section_path, ytb_id, proxy, section):
+                logging.error(f"[{thread_id}] Failed to download {ytb_id} section {section}, skipping all related videos")
+                cleanup_files(*(path for _, _, path in downloaded))
+                release_raw_files(path for _, _, path in downloaded)
+                job.success = False
+                return False
+            downloaded.append((section[0], section[1], section_path))
+        job.sources = map_to_sections(job.unique_list, downloaded)
+    
+    if progress_tracker is not None:
+        progress_tracker.mark_clips(ytb_id, [video_data['save_name'] for video_data in job.unique_list], 'downloaded')
+    return True
+
+
+def transcode_stage(job, processed_vid_root, options=None, progress_tracker=None):
+    """
+    Transcode stage: cut and crop every unique clip of a job, then fill in duplicates
+    
+    Returns:
+        bool: True, the job always moves on so raw files and finished clips get uploaded
+    """
+    options = options or ProcessOptions()
+    thread_id = threading.current_thread().name
+    ytb_id = job.ytb_id
+    seek_mode = options.seek_mode
+    
+    if seek_mode == 'keyframe' and options.seek_check and job.sources:
+        source_path, source_data_list = job.sources[0]
+        first = source_data_list[0]
+        if not check_seek_matches(source_path, first['bbox'], first['time']):
+            logging.warning(f"[{thread_id}] Keyframe seeking does not match for {ytb_id}, using output seeking")
+            seek_mode = 'output'
+    
+    if options.output_mode == 'frames':
+        return frames_transcode_stage(job, seek_mode, progress_tracker)
     
     # Process all videos for this ytb_id
-    for video_data in video_data_list:
+    results = {}
+    backend = get_backend()
+    for source_path, source_data_list in job.sources:
+        if backend.shares_demuxer:
+            # The in-process backend already reads the raw video once for all of its clips, in either mode
+            logging.info(f"[{thread_id}] Processing {len(source_data_list)} clips from {ytb_id} with the {backend.name} backend")
+            results.update(process_clips(source_path, processed_vid_root, source_data_list, seek_mode))
+        elif options.extract_mode == 'batch':
+            logging.info(f"[{thread_id}] Processing {len(source_data_list)} clips from {ytb_id} in batch mode")
+            results.update(process_ffmpeg_batch(source_path, processed_vid_root, source_data_list, seek_mode=seek_mode))
+        else:
+            for video_data in source_data_list:
+                save_name = video_data['save_name']
+                logging.info(f"[{thread_id}] Processing {save_name} from {ytb_id}")
+                results[save_name] = process_ffmpeg(
+                    source_path, processed_vid_root, save_name, video_data['bbox'], video_data['time'], seek_mode)
+    
+    verifier = get_verifier()
+    if verifier is not None:
+        # Catch truncated or short outputs before they are uploaded, and record their checksums
+        produced = [(results[video_data['save_name']], {'expected_duration': clip_duration(video_data)})
+                    for video_data in job.unique_list if results.get(video_data['save_name'])]
+        for processed_path, passed in verifier.verify_many(produced, record=True).items():
+            if not passed:
+                cleanup_files(processed_path)
+                results[os.path.basename(processed_path)] = None
+    
+    transcoded = []
+    for video_data in job.unique_list:
         save_name = video_data['save_name']
-        time = video_data['time']
-        bbox = video_data['bbox']
-        
-        logging.info(f"[{thread_id}] Processing {save_name} from {ytb_id}")
-        
-        processed_path = process_ffmpeg(raw_vid_path, processed_vid_root, save_name, bbox, time)
+        processed_path = results.get(save_name)
         
         if processed_path:
-            processed_files.append(processed_path)
+            transcoded.append(processed_path)
+            if options.dedup_fill == 'link' and save_name in job.duplicates:
+                created, linked = link_duplicates(processed_path, job.duplicates[save_name])
+                transcoded.extend(created)
+                job.success = job.success and linked
         else:
             logging.error(f"[{thread_id}] Failed to process {save_name}")
-            all_success = False
+            for duplicate_name in job.duplicates.get(save_name, []):
+                logging.error(f"[{thread_id}] Failed to process {duplicate_name}")
+            job.success = False
+    
+    job.processed_files.extend(transcoded)
+    if progress_tracker is not None:
+        progress_tracker.mark_clips(ytb_id, [os.path.basename(path) for path in transcoded], 'transcoded')
+    return True
+
+
+def frames_transcode_stage(job, seek_mode, progress_tracker=None):
+    """
+    Transcode stage of the 'frames' output mode: store the cropped frames of every unique clip
+    in the frame sink, duplicates indexed to the same frames
+    
+    The frame sink is the clips' destination, so stored clips are recorded as uploaded and
+    the upload stage only moves the raw files.
+    
+    Returns:
+        bool: True, the job always moves on so raw files get uploaded
+    """
+    thread_id = threading.current_thread().name
+    ytb_id = job.ytb_id
+    
+    stored = []
+    for source_path, source_data_list in job.sources:
+        for video_data in source_data_list:
+            save_name = video_data['save_name']
+            duplicate_names = job.duplicates.get(save_name, [])
+            logging.info(f"[{thread_id}] Extracting frames of {save_name} from {ytb_id}")
+            if process_frames(source_path, ytb_id, save_name, video_data['bbox'], video_data['time'], seek_mode,
+                              duplicate_names):
+                stored.extend([save_name, *duplicate_names])
+            else:
+                logging.error(f"[{thread_id}] Failed to process {save_name}")
+                job.success = False
+    
+    if progress_tracker is not None:
+        progress_tracker.mark_clips(ytb_id, stored, 'transcoded')
+        progress_tracker.mark_clips(ytb_id, stored, 'uploaded')
+    return True
+
+
+def upload_stage(job, progress_tracker, options=None, uploader=None):
+    """
+    Upload stage: move raw and processed files to Dropbox, clean up and record progress
+    
+    With an uploader, the files of this job are sent in batches together with those of other jobs.
     
-    # Move raw file to Dropbox
-    logging.info(f"[{thread_id}] Moving raw video {ytb_id} to Dropbox")
-    move_to_dropbox(raw_vid_path, "dropbox:celebv-text-raw/")
+    Returns:
+        bool: True if all videos of the job were processed and uploaded successfully
+    """
+    options = options or ProcessOptions()
+    if options.output_mode == 'shards':
+        return shard_upload_stage(job, options, uploader)
+    thread_id = threading.current_thread().name
+    ytb_id = job.ytb_id
+    
+    # Move raw file (or its sections) and processed files to Dropbox
+    logging.info(f"[{thread_id}] Moving raw video {ytb_id} and {len(job.processed_files)} clips to Dropbox")
+    raw_files = [source_path for source_path, _ in job.sources]
+    sidecars = {processed_path: keyframe_sidecar(processed_path) for processed_path in job.processed_files}
+    sidecars = {processed_path: sidecar for processed_path, sidecar in sidecars.items() if sidecar}
+    moved = upload_files([(raw_file, RAW_REMOTE) for raw_file in raw_files]
+                         + [(processed_path, PROCESSED_REMOTE) for processed_path in job.processed_files]
+                         + [(sidecar, PROCESSED_REMOTE) for sidecar in sidecars.values()], uploader)
 
-    # Move processed files to Dropbox
     moved_files = []
-    for processed_path in processed_files:
-        if move_to_dropbox(processed_path, "dropbox:celebv-text-processed/"):
+    uploaded_names = []
+    for processed_path in job.processed_files:
+        if moved[processed_path]:
             moved_files.append(processed_path)
+            save_name = os.path.basename(processed_path)
+            uploaded_names.append(save_name)
+            sidecar = sidecars.get(processed_path)
+            if sidecar and not moved[sidecar]:
+                logging.warning(f"[{thread_id}] Keyframe sidecar of {save_name} was not uploaded")
+                sidecar = None
+            if options.dedup_fill == 'remote_copy':
+                for duplicate_name in job.duplicates.get(save_name, []):
+                    if copy_on_dropbox(PROCESSED_REMOTE + save_name, PROCESSED_REMOTE + duplicate_name):
+                        uploaded_names.append(duplicate_name)
+                        if sidecar:
+                            copy_on_dropbox(PROCESSED_REMOTE + os.path.basename(sidecar),
+                                            PROCESSED_REMOTE + duplicate_name + KEYFRAME_INDEX_SUFFIX)
+                    else:
+                        job.success = False
         else:
-            all_success = False
+            job.success = False
+    progress_tracker.mark_clips(ytb_id, uploaded_names, 'uploaded')
     
     # Cleanup files (both raw and successfully moved processed files)
-    cleanup_files(raw_vid_path, *moved_files)
+    cleanup_files(*raw_files, *(keyframe_index_path(raw_file) for raw_file in raw_files), *moved_files,
+                  *(sidecars[moved_file] for moved_file in moved_files if moved_file in sidecars))
+    release_raw_files(raw_files)
     
-    if all_success:
+    if job.success:
         progress_tracker.mark_completed(ytb_id)
         logging.info(f"[{thread_id}] Successfully completed: {ytb_id}")
     else:
         logging.error(f"[{thread_id}] Some errors occurred while processing: {ytb_id}")
     
-    return all_success
+    return job.success
+
+
+def shard_upload_stage(job, options, uploader=None):
+    """
+    Upload stage of the 'shards' output mode: move the raw files to Dropbox and append the
+    processed clips to the open shard
+    
+    The shard writer records the clips as uploaded and completes the ytb_id once every shard
+    holding its clips is uploaded.
+    
+    Returns:
+        bool: True if all videos of the job were processed successfully
+    """
+    thread_id = threading.current_thread().name
+    ytb_id = job.ytb_id
+    
+    logging.info(f"[{thread_id}] Moving raw video {ytb_id} to Dropbox and {len(job.processed_files)} clips to a shard")
+    raw_files = [source_path for source_path, _ in job.sources]
+    upload_files([(raw_file, RAW_REMOTE) for raw_file in raw_files], uploader)
+    
+    members = []
+    sidecars = {}
+    for processed_path in job.processed_files:
+        save_name = os.path.basename(processed_path)
+        names = [save_name]
+        if options.dedup_fill == 'remote_copy':
+            # There is no server-side copy inside a shard, duplicates are stored as members of their own
+            names.extend(job.duplicates.get(save_name, []))
+        members.extend((processed_path, name) for name in names)
+        sidecar = keyframe_sidecar(processed_path)
+        if sidecar:
+            sidecars.update({name: (sidecar, name + KEYFRAME_INDEX_SUFFIX) for name in names})
+    get_shard_writer().add_job(ytb_id, members, job.success, sidecars)
+    
+    cleanup_files(*raw_files, *(keyframe_index_path(raw_file) for raw_file in raw_files), *job.processed_files,
+                  *(keyframe_index_path(processed_path) for processed_path in job.processed_files))
+    release_raw_files(raw_files)
+    
+    if job.success:
+        logging.info(f"[{thread_id}] Finished {ytb_id}, complete once its shards are uploaded")
+    else:
+        logging.error(f"[{thread_id}] Some errors occurred while processing: {ytb_id}")
+    return job.success
+
+
+def process_ytb_id(ytb_id, video_data_list, raw_vid_root, processed_vid_root, progress_tracker, proxy=None,
+                   options=None, uploader=None):
+    """
+    Process all videos for a single YouTube ID
+    
+    Args:
+        ytb_id: YouTube video ID
+        video_data_list: List of video processing data for this ytb_id
+        raw_vid_root: Directory for raw videos
+        processed_vid_root: Directory for processed videos
+        progress_tracker: ThreadSafeProgress instance
+        proxy: Proxy URL if needed
+        options: ProcessOptions instance, default options if None
+        uploader: BatchUploader instance, or None to upload each file with its own rclone run
+    
+    Returns:
+        bool: True if all videos processed successfully
+    """
+    job = YtbJob(ytb_id, video_data_list)
+    resume_job(job, progress_tracker, processed_vid_root)
+    
+    if not download_stage(job, raw_vid_root, proxy, options, progress_tracker):
+        return False
+    try:
+        transcode_stage(job, processed_vid_root, options, progress_tracker)
+        return upload_stage(job, progress_tracker, options, uploader)
+    except Exception:
+        discard_raw_files(job)
+        raise
+
+
+def timed_process_ytb_id(cost_model, ytb_id, video_data_list, raw_vid_root, *args):
+    """process_ytb_id that records how long a successful ytb_id took in cost_model"""
+    features = job_features(ytb_id, video_data_list, raw_vid_root)
+    start_time = time.monotonic()
+    with METRICS.busy('job'):
+        success = process_ytb_id(ytb_id, video_data_list, raw_vid_root, *args)
+    if success and cost_model is not None:
+        cost_model.observe(features, time.monotonic() - start_time)
+    return success
+
+
+def run_thread_pool(pending_ytb_ids, max_workers, raw_vid_root, processed_vid_root, progress_tracker, proxy=None,
+                    options=None, uploader=None, cost_model=None):
+    """
+    Process ytb_ids end to end, each on one worker thread, started in the given order
+    
+    Yields:
+        tuple: (ytb_id, bool success) as each ytb_id finishes
+    """
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="YTWorker") as executor:
+        # Submit all tasks
+        future_to_ytb_id = {
+            executor.submit(
+                timed_process_ytb_id,
+                cost_model,
+                ytb_id, 
+                video_data_list, 
+                raw_vid_root, 
+                processed_vid_root, 
+                progress_tracker,
+                proxy,
+                options,
+                uploader
+            ): ytb_id 
+            for ytb_id, video_data_list in pending_ytb_ids
+        }
+        
+        for future in as_completed(future_to_ytb_id):
+            ytb_id = future_to_ytb_id[future]
+            try:
+                yield ytb_id, future.result()
+            except Exception as e:
+                logging.error(f"Unexpected error processing {ytb_id}: {e}")
+                yield ytb_id, False
+
+
+def run_pipeline(pending_ytb_ids, raw_vid_root, processed_vid_root, progress_tracker, proxy=None, options=None,
+                 uploader=None, download_workers=DEFAULT_MAX_WORKERS, transcode_workers=1,
+                 upload_workers=DEFAULT_UPLOAD_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, cost_model=None):
+    """
+    Process ytb_ids through separate download, transcode and upload worker pools
+    
+    Yields:
+        tuple: (ytb_id, bool success) as each ytb_id leaves the pipeline
+    """
+    def guarded(stage, stage_fn):
+        def run(job):
+            start_time = time.monotonic()
+            try:
+                with METRICS.busy(stage):
+                    return stage_fn(job)
+            except Exception as e:
+                logging.error(f"Unexpected error processing {job.ytb_id}: {e}")
+                job.success = False
+                return False
+            finally:
+                job.busy_seconds += time.monotonic() - start_time
+        return run
+    
+    def download_job(job):
+        resume_job(job, progress_tracker, processed_vid_root)
+        return download_stage(job, raw_vid_root, proxy, options, progress_tracker)
+    
+    pipeline = StagedPipeline([
+        ('download', guarded('download', download_job), download_workers),
+        ('transcode', guarded('transcode',
+                              lambda job: transcode_stage(job, processed_vid_root, options, progress_tracker)),
+         transcode_workers),
+        ('upload', guarded('upload', lambda job: upload_stage(job, progress_tracker, options, uploader)),
+         upload_workers),
+    ], queue_size=queue_size, on_failed=discard_raw_files)
+    
+    def collect_queue_depths():
+        for stage, depth in pipeline.queue_depths().items():
+            METRICS.set_gauge('queue_depth', depth, stage=stage)
+    METRICS.add_collector(collect_queue_depths)
+    
+    features_by_ytb_id = {}
+    
+    def jobs():
+        for ytb_id, video_data_list in pending_ytb_ids:
+            features_by_ytb_id[ytb_id] = job_features(ytb_id, video_data_list, raw_vid_root)
+            yield YtbJob(ytb_id, video_data_list)
+    
+    try:
+        for job, _ in pipeline.run(jobs()):
+            features = features_by_ytb_id.pop(job.ytb_id)
+            if job.success and cost_model is not None:
+                cost_model.observe(features, job.busy_seconds)
+            yield job.ytb_id, job.success
+    finally:
+        METRICS.remove_collector(collect_queue_depths)
+
+
+def run_work_queue(work_queue, grouped_data, max_workers, raw_vid_root, processed_vid_root, progress_tracker,
+                   proxy=None, options=None, uploader=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+                   max_attempts=DEFAULT_MAX_ATTEMPTS, poll_interval=DEFAULT_POLL_INTERVAL, cost_model=None):
+    """
+    Process ytb_ids claimed from a shared work queue until it is drained, each on one worker thread
+    
+    Every worker claims one ytb_id at a time and keeps its lease renewed while processing it, so
+    idle nodes keep pulling work and the ytb_ids of a crashed node return to the queue.
+    
+    Yields:
+        tuple: (ytb_id, bool success) as each ytb_id finishes
+    """
+    results = Queue()
+    
+    # With shards, a ytb_id is only done once the shards holding its clips are uploaded, the
+    # shard writer completes it then. Its lease is renewed until then, so other nodes do not
+    # claim it again while its clips wait in an open shard.
+    shard_writer = get_shard_writer()
+    deferred = {}  # {ytb_id: (worker_id, LeaseKeeper)} of jobs waiting for their shards
+    deferred_lock = threading.Lock()
+    
+    def on_shards_uploaded(ytb_id, success):
+        with deferred_lock:
+            worker_id, keeper = deferred.pop(ytb_id, (None, None))
+        if worker_id is None:
+            return
+        keeper.stop()
+        if success:
+            work_queue.complete(ytb_id, worker_id)
+        else:
+            work_queue.fail(ytb_id, worker_id, max_attempts)
+    
+    if shard_writer is not None:
+        shard_writer.add_listener(on_shards_uploaded)
+    
+    def worker():
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+        unknown = set()  # ytb_ids enqueued by other nodes whose clips this node did not load
+        try:
+            for ytb_id in iter_claims(work_queue, worker_id, lease_seconds, poll_interval, max_attempts, unknown):
+                if ytb_id not in grouped_data:
+                    logging.info(f"[{worker_id}] No clips of {ytb_id} in this node's metadata, leaving it to others")
+                    unknown.add(ytb_id)
+                    work_queue.release(ytb_id, worker_id)
+                    continue
+                if progress_tracker.is_completed(ytb_id):
+                    work_queue.complete(ytb_id, worker_id)
+                    continue
+                
+                success = False
+                keeper = LeaseKeeper(work_queue, ytb_id, worker_id, lease_seconds).start()
+                if shard_writer is not None:
+                    with deferred_lock:
+                        deferred[ytb_id] = (worker_id, keeper)
+                try:
+                    success = timed_process_ytb_id(cost_model, ytb_id, grouped_data[ytb_id], raw_vid_root,
+                                                   processed_vid_root, progress_tracker, proxy, options, uploader)
+                except Exception as e:
+                    logging.error(f"[{worker_id}] Unexpected error processing {ytb_id}: {e}")
+                if keeper.lost:
+                    logging.warning(f"[{worker_id}] Finished {ytb_id} after losing its lease")
+                
+                if shard_writer is not None:
+                    # Failed jobs are failed now, unless the shard writer already reported them.
+                    # Successful ones keep their lease renewed until their shards are uploaded.
+                    with deferred_lock:
+                        waiting = deferred.pop(ytb_id, None) if not success else None
+                    if waiting is not None:
+                        keeper.stop()
+                        work_queue.fail(ytb_id, worker_id, max_attempts)
+                else:
+                    keeper.stop()
+                    if success:
+                        work_queue.complete(ytb_id, worker_id)
+                    else:
+                        work_queue.fail(ytb_id, worker_id, max_attempts)
+                results.put((ytb_id, success))
+        except Exception as e:
+            logging.error(f"[{worker_id}] Work queue error, stopping worker: {e}")
+        finally:
+            results.put(None)
+    
+    threads = [threading.Thread(target=worker, name=f"YTWorker-{i}", daemon=True) for i in range(max_workers)]
+    for thread in threads:
+        thread.start()
+    
+    running = len(threads)
+    while running:
+        result = results.get()
+        if result is None:
+            running -= 1
+        else:
+            yield result
+
+
+def parse_args():
+    """Command line options, everything else is configured through environment variables"""
+    parser = argparse.ArgumentParser(description="Download and process CelebV-Text videos")
+    parser.add_argument('--shard-index', type=int, default=int(os.getenv('CELEBV_SHARD_INDEX', 0)),
+                        help="shard processed by this node, 0-based")
+    parser.add_argument('--shard-count', type=int, default=int(os.getenv('CELEBV_SHARD_COUNT', 1)),
+                        help="number of nodes the ytb_ids are split across")
+    parser.add_argument('--shard-plan', action='store_true',
+                        help="log the expected load of every shard and exit")
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
+    args = parse_args()
+    
     # Setup logging
     logging.basicConfig(
         level=logging.INFO,
@@ -347,81 +1660,258 @@ if __name__ == '__main__':
     progress_file = os.getenv('CELEBV_PROGRESS_FILE', DEFAULT_PROGRESS_FILE)
     proxy = os.getenv('CELEBV_PROXY', None)  # Proxy URL, set environment variable if needed
     max_workers = int(os.getenv('CELEBV_MAX_WORKERS', DEFAULT_MAX_WORKERS))  # Number of concurrent YouTube videos
+    dedup_report_path = os.getenv('CELEBV_DEDUP_REPORT', DEFAULT_DEDUP_REPORT)
+    use_pipeline = os.getenv('CELEBV_PIPELINE', '0') == '1'  # Separate download / transcode / upload pools
+    download_workers = int(os.getenv('CELEBV_DOWNLOAD_WORKERS', max_workers))
+    transcode_workers = int(os.getenv('CELEBV_TRANSCODE_WORKERS', os.cpu_count() or 1))
+    cpu_budget = int(os.getenv('CELEBV_CPU_BUDGET', os.cpu_count() or 1))  # Cores shared by all ffmpeg runs
+    backend_name = os.getenv('CELEBV_BACKEND', DEFAULT_BACKEND)  # 'subprocess' or 'pyav'
+    adaptive_downloads = os.getenv('CELEBV_ADAPTIVE_DOWNLOADS', '1') == '1'
+    download_attempts = int(os.getenv('CELEBV_DOWNLOAD_ATTEMPTS', DEFAULT_DOWNLOAD_ATTEMPTS))
+    permanent_failures_path = os.getenv('CELEBV_PERMANENT_FAILURES', DEFAULT_PERMANENT_FAILURES)
+    permanent_failure_days = float(os.getenv('CELEBV_PERMANENT_FAILURE_DAYS', DEFAULT_PERMANENT_FAILURE_TTL / 86400))
+    retry_permanent_failures = os.getenv('CELEBV_RETRY_PERMANENT_FAILURES', '0') == '1'
+    raw_cache_dir = os.getenv('CELEBV_RAW_CACHE_DIR', None)  # Keep raw videos here for reruns, off if unset
+    raw_cache_gb = float(os.getenv('CELEBV_RAW_CACHE_GB', DEFAULT_RAW_CACHE_GB))
+    upload_workers = int(os.getenv('CELEBV_UPLOAD_WORKERS', DEFAULT_UPLOAD_WORKERS))
+    queue_size = int(os.getenv('CELEBV_QUEUE_SIZE', DEFAULT_QUEUE_SIZE))
+    upload_mode = os.getenv('CELEBV_UPLOAD_MODE', DEFAULT_UPLOAD_MODE)  # 'file', 'files-from' or 'rcd'
+    upload_batch_size = int(os.getenv('CELEBV_UPLOAD_BATCH_SIZE', DEFAULT_BATCH_SIZE))
+    upload_flush_interval = float(os.getenv('CELEBV_UPLOAD_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL))
+    rcd_addr = os.getenv('CELEBV_RCD_ADDR', DEFAULT_RCD_ADDR)
+    probe_cache_path = os.getenv('CELEBV_PROBE_CACHE', DEFAULT_PROBE_CACHE)
+    verify_cache_path = os.getenv('CELEBV_VERIFY_CACHE', DEFAULT_VERIFY_CACHE)  # Empty to trust existing files
+    verify_workers = int(os.getenv('CELEBV_VERIFY_WORKERS', os.cpu_count() or 1))
+    verify_tolerance = float(os.getenv('CELEBV_VERIFY_TOLERANCE', DEFAULT_DURATION_TOLERANCE))
+    checksum_log = os.getenv('CELEBV_CHECKSUM_LOG', DEFAULT_CHECKSUM_LOG)
+    journal_path = os.getenv('CELEBV_JOURNAL', None)  # SQLite clip-level progress journal, replaces the progress file
+    work_queue_spec = os.getenv('CELEBV_WORK_QUEUE', None)  # Shared queue 'sqlite:<db file>' or 'dir:<directory>'
+    lease_seconds = float(os.getenv('CELEBV_LEASE_SECONDS', DEFAULT_LEASE_SECONDS))
+    max_attempts = int(os.getenv('CELEBV_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS))
+    schedule = os.getenv('CELEBV_SCHEDULE', 'cost')  # 'cost': most expensive ytb_ids first, 'input': JSON order
+    cost_model_path = os.getenv('CELEBV_COST_MODEL', DEFAULT_COST_MODEL)
+    metrics_textfile = os.getenv('CELEBV_METRICS_TEXTFILE', None)  # Prometheus textfile, e.g. for node_exporter
+    metrics_jsonl = os.getenv('CELEBV_METRICS_JSONL', None)
+    metrics_interval = float(os.getenv('CELEBV_METRICS_INTERVAL', DEFAULT_METRICS_INTERVAL))
+    shard_dir = os.getenv('CELEBV_SHARD_DIR', os.path.join(processed_vid_root, 'shards'))
+    shard_size_mb = float(os.getenv('CELEBV_SHARD_SIZE_MB', DEFAULT_SHARD_SIZE_MB))
+    shard_max_age = float(os.getenv('CELEBV_SHARD_MAX_AGE', DEFAULT_SHARD_MAX_AGE))
+    shard_log_path = os.getenv('CELEBV_SHARD_LOG', DEFAULT_SHARD_LOG)
+    frames_root = os.getenv('CELEBV_FRAMES_ROOT', DEFAULT_FRAMES_ROOT)
+    frame_size = int(os.getenv('CELEBV_FRAME_SIZE', DEFAULT_FRAME_SIZE))
+    frame_stride = int(os.getenv('CELEBV_FRAME_STRIDE', DEFAULT_FRAME_STRIDE))
+    frame_chunk_mb = float(os.getenv('CELEBV_FRAME_CHUNK_MB', DEFAULT_CHUNK_MB))
+    options = ProcessOptions.from_env()
+    backend = configure_backend(backend_name)
     
     logging.info(f"Configuration:")
     logging.info(f"  JSON path: {json_path}")
     logging.info(f"  Raw video root: {raw_vid_root}")
     logging.info(f"  Processed video root: {processed_vid_root}")
     logging.info(f"  Progress file: {progress_file}")
-    logging.info(f"  Max workers: {max_workers}")
+    logging.info(f"  Progress journal: {journal_path if journal_path else 'None'}")
+    if args.shard_count > 1:
+        logging.info(f"  Shard: {args.shard_index} of {args.shard_count}")
+    if work_queue_spec:
+        logging.info(f"  Work queue: {work_queue_spec} (lease {lease_seconds:.0f}s, max attempts {max_attempts})")
+        if use_pipeline:
+            logging.warning("  Work queue mode runs on the thread pool, CELEBV_PIPELINE is ignored")
+            use_pipeline = False
+    if use_pipeline:
+        logging.info(f"  Pipeline workers: download {download_workers}, transcode {transcode_workers}, "
+                     f"upload {upload_workers} (queue size {queue_size})")
+    else:
+        logging.info(f"  Max workers: {max_workers}")
+    logging.info(f"  Extract mode: {options.extract_mode}")
+    logging.info(f"  Processing backend: {backend.name}"
+                 f"{', one demuxer per raw video' if backend.shares_demuxer else ''}")
+    logging.info(f"  Encoder: {ENCODE_SETTINGS['codec']} preset {ENCODE_SETTINGS['preset']} crf {ENCODE_SETTINGS['crf']}, "
+                 f"CPU budget {cpu_budget} cores")
+    if random_access_profile():
+        logging.info(f"  Encode profile: random_access, GOP {ENCODE_SETTINGS['gop']}, {ENCODE_SETTINGS['fps']} fps, "
+                     f"{ENCODE_SETTINGS['size']}x{ENCODE_SETTINGS['size']}, keyframe sidecars")
+    logging.info(f"  aria2c connections per download: {ARIA2C_CONNECTIONS}")
+    logging.info(f"  Adaptive downloads: {'on' if adaptive_downloads else 'off'}, {download_attempts} attempts, "
+                 f"permanent failures in {permanent_failures_path} "
+                 f"({'retried now' if retry_permanent_failures else f'kept {permanent_failure_days:g} days'})")
+    logging.info(f"  Seek mode: {options.seek_mode}{' (checked)' if options.seek_check else ''}")
+    logging.info(f"  Download mode: {options.download_mode}")
+    logging.info(f"  Dedup: {f'on ({options.dedup_fill})' if options.dedup else 'off'}")
+    logging.info(f"  Min free disk: {options.min_free_disk / 1024 ** 3:.1f} GB")
+    if options.output_mode == 'shards':
+        logging.info(f"  Output: shards of {shard_size_mb:.0f} MB or {shard_max_age:.0f}s in {shard_dir}, "
+                     f"uploaded to {SHARD_REMOTE}, log {shard_log_path}")
+    elif options.output_mode == 'frames':
+        logging.info(f"  Output: {frame_size}x{frame_size} RGB frames, every {frame_stride} frame(s), "
+                     f"in {frame_chunk_mb:.0f} MB chunks in {frames_root}")
+    else:
+        logging.info(f"  Output: one {options.output_mode} file per clip")
+    if upload_mode == 'file':
+        logging.info(f"  Upload mode: file")
+    else:
+        logging.info(f"  Upload mode: {upload_mode} (batch size {upload_batch_size}, "
+                     f"flush interval {upload_flush_interval}s)")
+    logging.info(f"  Probe cache: {probe_cache_path}")
+    if verify_cache_path:
+        logging.info(f"  Verification: cache {verify_cache_path}, {verify_workers} workers, "
+                     f"duration tolerance {verify_tolerance}s, checksums in {checksum_log}")
+    else:
+        logging.info(f"  Verification: off, existing files are trusted")
+    if raw_cache_dir:
+        logging.info(f"  Raw cache: {raw_cache_dir} ({raw_cache_gb:.0f} GB)")
+    logging.info(f"  Schedule: {schedule} (cost model {cost_model_path})")
+    if metrics_textfile or metrics_jsonl:
+        logging.info(f"  Metrics: textfile {metrics_textfile}, JSONL {metrics_jsonl}, every {metrics_interval:.0f}s")
     logging.info(f"  Proxy: {proxy if proxy else 'None'}")
     
+    probe_cache = configure_probe_cache(probe_cache_path)
+    verifier = configure_verifier(verify_cache_path, verify_workers, verify_tolerance, checksum_log)
+    configure_governor(cpu_budget, transcode_workers if use_pipeline else max_workers, ENCODE_SETTINGS['preset'])
+    permanent_failures = PermanentFailures(permanent_failures_path, permanent_failure_days * 86400,
+                                           retry_permanent_failures)
+    download_controller = configure_download_controller(
+        max_concurrency=download_workers if use_pipeline else max_workers, max_connections=ARIA2C_CONNECTIONS,
+        max_attempts=download_attempts, permanent_failures=permanent_failures, adaptive=adaptive_downloads)
+    
+    def collect_download_control():
+        METRICS.set_gauge('download_concurrency_limit', int(download_controller.limit))
+        METRICS.set_gauge('download_connections', int(download_controller.connections))
+        METRICS.set_gauge('download_active', download_controller.active)
+    METRICS.add_collector(collect_download_control)
+    
+    raw_cache = configure_raw_cache(raw_cache_dir, int(raw_cache_gb * 1024 ** 3))
+    if raw_cache is not None:
+        def collect_raw_cache():
+            for name, value in raw_cache.stats.items():
+                METRICS.set_gauge(f'raw_cache_{name}', value)
+            METRICS.set_gauge('raw_cache_bytes', raw_cache.total_bytes())
+        METRICS.add_collector(collect_raw_cache)
     
     # Create directories
     os.makedirs(raw_vid_root, exist_ok=True)
     os.makedirs(processed_vid_root, exist_ok=True)
     
     try:
+        if args.shard_plan:
+            log_shard_plan(shard_plan_report(load_and_group_data(json_path), args.shard_count))
+            raise SystemExit(0)
+        
         # Load and group data by ytb_id
         logging.info("Loading and grouping data by ytb_id...")
-        grouped_data = load_and_group_data(json_path)
+        grouped_data = load_and_group_data(json_path, args.shard_index, args.shard_count)
         logging.info(f"Loaded data for {len(grouped_data)} YouTube videos")
         
+        if options.dedup:
+            dedup_report = build_dedup_report(grouped_data)
+            with open(dedup_report_path, 'w') as f:
+                json.dump(dedup_report, f, indent=2)
+            logging.info(f"Dedup: {dedup_report['unique_clips']} unique of {dedup_report['total_clips']} clips, "
+                         f"skipping {dedup_report['skipped_clips']} transcodes "
+                         f"({dedup_report['skipped_clip_seconds']:.1f}s of clips), report written to {dedup_report_path}")
+        
         # Initialize thread-safe progress tracker
-        progress_tracker = ThreadSafeProgress(progress_file)
+        if journal_path:
+            progress_tracker = ProgressJournal(journal_path)
+            progress_tracker.import_progress_file(progress_file)
+        else:
+            progress_tracker = ThreadSafeProgress(progress_file)
         initial_completed = progress_tracker.get_completed_count()
         logging.info(f"Found {initial_completed} already completed videos")
         
-        # Filter out already completed videos
+        # Filter out already completed videos, and videos that can never be downloaded
         pending_ytb_ids = [(ytb_id, video_data_list) for ytb_id, video_data_list in grouped_data.items() 
-                          if not progress_tracker.is_completed(ytb_id)]
+                          if not progress_tracker.is_completed(ytb_id) and ytb_id not in permanent_failures]
+        if len(permanent_failures):
+            logging.info(f"{len(permanent_failures)} YouTube videos are recorded as permanently failed and skipped")
         
         total_pending = len(pending_ytb_ids)
-        logging.info(f"Processing {total_pending} pending YouTube videos with {max_workers} threads")
+        logging.info(f"Processing {total_pending} pending YouTube videos")
+        
+        cost_model = CostModel(cost_model_path)
+        costs = {}
+        if schedule == 'cost' and pending_ytb_ids:
+            pending_ytb_ids, costs = order_by_cost(pending_ytb_ids, cost_model, raw_vid_root)
+            logging.info(f"Scheduled longest first: {sum(costs.values()) / 3600:.1f} h of estimated work, "
+                         f"longest job {max(costs.values()) / 60:.1f} min")
         
         if total_pending == 0:
             logging.info("All videos already completed!")
         else:
-            # Process videos using ThreadPoolExecutor
             start_time = time.time()
             successful_count = 0
             failed_count = 0
             
-            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="YTWorker") as executor:
-                # Submit all tasks
-                future_to_ytb_id = {
-                    executor.submit(
-                        process_ytb_id, 
-                        ytb_id, 
-                        video_data_list, 
-                        raw_vid_root, 
-                        processed_vid_root, 
-                        progress_tracker,
-                        proxy
-                    ): ytb_id 
-                    for ytb_id, video_data_list in pending_ytb_ids
-                }
-                
-                # Process completed tasks
-                for future in as_completed(future_to_ytb_id):
-                    ytb_id = future_to_ytb_id[future]
-                    
-                    try:
-                        success = future.result()
-                        if success:
-                            successful_count += 1
-                        else:
-                            failed_count += 1
-                            
-                        completed_count = successful_count + failed_count
-                        progress_percentage = (completed_count / total_pending) * 100
-                        
-                        logging.info(f"Progress: {completed_count}/{total_pending} ({progress_percentage:.1f}%) - "
-                                   f"Success: {successful_count}, Failed: {failed_count}")
-                        
-                    except Exception as e:
+            uploader = None
+            if upload_mode != 'file':
+                uploader = BatchUploader(upload_mode, upload_batch_size, upload_flush_interval,
+                                         rcd_addr=rcd_addr).start()
+            
+            frame_sink = None
+            if options.output_mode == 'frames':
+                frame_sink = configure_frame_sink(frames_root, frame_size, frame_stride,
+                                                  int(frame_chunk_mb * 1024 ** 2))
+            
+            shard_writer = None
+            if options.output_mode == 'shards':
+                shard_writer = configure_shard_writer(
+                    shard_dir, SHARD_REMOTE, lambda uploads: upload_files(uploads, uploader), progress_tracker,
+                    int(shard_size_mb * 1024 ** 2), shard_max_age, shard_log_path)
+            
+            reporter = None
+            if metrics_textfile or metrics_jsonl:
+                workers = ({'download': download_workers, 'transcode': transcode_workers, 'upload': upload_workers}
+                           if use_pipeline else {'job': max_workers})
+                reporter = MetricsReporter(METRICS, metrics_textfile, metrics_jsonl, metrics_interval,
+                                           workers).start()
+            
+            if work_queue_spec:
+                work_queue = open_work_queue(work_queue_spec)
+                work_queue.enqueue([ytb_id for ytb_id, _ in pending_ytb_ids], costs)
+                logging.info(f"Work queue holds {work_queue.remaining()} unfinished YouTube videos")
+                outcomes = run_work_queue(work_queue, grouped_data, max_workers, raw_vid_root, processed_vid_root,
+                                          progress_tracker, proxy, options, uploader, lease_seconds, max_attempts,
+                                          cost_model=cost_model)
+            elif use_pipeline:
+                outcomes = run_pipeline(pending_ytb_ids, raw_vid_root, processed_vid_root, progress_tracker, proxy,
+                                        options, uploader, download_workers, transcode_workers, upload_workers,
+                                        queue_size, cost_model)
+            else:
+                outcomes = run_thread_pool(pending_ytb_ids, max_workers, raw_vid_root, processed_vid_root,
+                                           progress_tracker, proxy, options, uploader, cost_model)
+            
+            # Process completed tasks
+            try:
+                for ytb_id, success in outcomes:
+                    if success:
+                        successful_count += 1
+                    else:
                         failed_count += 1
-                        logging.error(f"Unexpected error processing {ytb_id}: {e}")
+                        
+                    completed_count = successful_count + failed_count
+                    if work_queue_spec:
+                        # Other nodes and retries share the queue, the local count is no total
+                        logging.info(f"Progress: {completed_count} done here, {work_queue.remaining()} left in the "
+                                     f"work queue - Success: {successful_count}, Failed: {failed_count}")
+                        continue
+                    progress_percentage = (completed_count / total_pending) * 100
+                    
+                    logging.info(f"Progress: {completed_count}/{total_pending} ({progress_percentage:.1f}%) - "
+                               f"Success: {successful_count}, Failed: {failed_count}")
+            finally:
+                cost_model.save()
+                if shard_writer is not None:
+                    shard_writer.close()
+                if frame_sink is not None:
+                    frame_sink.close()
+                if uploader is not None:
+                    uploader.close()
+                if journal_path:
+                    progress_tracker.close()
+                if reporter is not None:
+                    reporter.stop()
+                if verifier is not None:
+                    verifier.flush()
+                probe_cache.flush()
             
             # Final statistics
             end_time = time.time()
@@ -433,7 +1923,15 @@ if __name__ == '__main__':
             logging.info(f"Successful: {successful_count}")
             logging.info(f"Failed: {failed_count}")
             logging.info(f"Total time: {elapsed_time:.2f} seconds")
-            logging.info(f"Average time per video: {elapsed_time / (successful_count + failed_count):.2f} seconds")
+            if successful_count + failed_count:
+                logging.info(f"Average time per video: {elapsed_time / (successful_count + failed_count):.2f} seconds")
+            logging.info(f"Downloads ended at {download_controller.describe()}")
+            if raw_cache is not None:
+                logging.info(f"Raw cache: {raw_cache.summary()}")
+            if verifier is not None:
+                logging.info(f"Verification: {verifier.summary()}")
+            logging.info("Time spent per step:")
+            METRICS.log_summary()
             logging.info("="*50)
         
     except Exception as e:
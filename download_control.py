@@ -0,0 +1,261 @@
+"""
+Adaptive download control: AIMD concurrency and aria2c connections driven by throughput and
+yt-dlp errors, jittered backoff on throttling, and a record of permanently failed ytb_ids
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+DEFAULT_DOWNLOAD_ATTEMPTS = 3  # yt-dlp runs per download before giving up on it for this run
+DEFAULT_PERMANENT_FAILURES = 'permanent_failures.txt'
+DEFAULT_PERMANENT_FAILURE_TTL = 30 * 24 * 3600  # Seconds before a permanently failed ytb_id is tried again
+DEFAULT_BACKOFF_BASE = 5.0  # Seconds of the first backoff, doubled per consecutive throttle
+DEFAULT_BACKOFF_MAX = 600.0
+DEFAULT_RETRY_DELAY = 2.0  # Seconds before retrying a download that failed for another reason
+SLOW_DOWNLOAD_RATIO = 0.5  # A download below this fraction of the average throughput counts as congestion
+THROUGHPUT_SMOOTHING = 0.2  # Weight of the latest download in the average throughput
+
+# Lower-cased messages of yt-dlp's YouTube extractor for videos that are gone for everyone.
+# Region blocks, age gates and members-only videos are left out: a proxy or cookies fix them.
+PERMANENT_ERRORS = (
+    'private video. sign in if',
+    'this video has been removed by the uploader',
+    'this video has been removed for violating',
+    'this video is no longer available because the youtube account associated with this video has been terminated',
+    'this video is no longer available due to a copyright claim',
+)
+THROTTLE_ERRORS = (
+    'http error 429',
+    'too many requests',
+    'rate-limit',
+    'rate limit',
+    "confirm you're not a bot",
+    'confirm you’re not a bot',
+    'http error 403',
+)
+
+
+def classify_failure(output):
+    """
+    Sort a failed yt-dlp run by its output
+
+    Returns:
+        str: 'permanent' (private, removed, ...), 'throttled' (429, bot check) or 'retryable'
+    """
+    text = (output or '').lower()
+    # Throttling is checked first, a bot check can mention the video being unavailable
+    if any(fragment in text for fragment in THROTTLE_ERRORS):
+        return 'throttled'
+    # Only errors of the YouTube extractor count, aria2c and ffmpeg errors are about local files
+    youtube_errors = [line for line in text.splitlines() if 'error: [youtube]' in line]
+    if any(fragment in line for line in youtube_errors for fragment in PERMANENT_ERRORS):
+        return 'permanent'
+    return 'retryable'
+
+
+class PermanentFailures:
+    """
+    ytb_ids that can not be downloaded, one 'ytb_id<TAB>reason<TAB>recorded at' line each.
+
+    An entry expires ttl seconds after it was recorded (0 keeps it forever), so a video that
+    comes back is tried again. On load, entries whose reason no longer counts as permanent
+    (recorded with an older list of errors) are dropped, and retry drops them all.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_PERMANENT_FAILURE_TTL, retry=False):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}  # {ytb_id: (reason, recorded_at)}
+        if path and os.path.exists(path):
+            self.load(retry)
+
+    def load(self, retry):
+        loaded = {}
+        # Lines without a time were written before entries expired, they count from the last change
+        default_time = os.path.getmtime(self.path)
+        with open(self.path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if not fields[0]:
+                    continue
+                reason = fields[1] if len(fields) > 1 else ''
+                try:
+                    recorded_at = float(fields[2]) if len(fields) > 2 else default_time
+                except ValueError:
+                    recorded_at = default_time
+                loaded[fields[0]] = (reason, recorded_at)
+
+        if not retry:
+            self.entries = {ytb_id: entry for ytb_id, entry in loaded.items()
+                            if classify_failure(entry[0]) == 'permanent' and not self._expired(entry)}
+        if len(self.entries) < len(loaded):
+            logging.info(f"Retrying {len(loaded) - len(self.entries)} ytb_ids recorded as permanently failed")
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                for ytb_id, (reason, recorded_at) in self.entries.items():
+                    f.write(f"{ytb_id}\t{reason}\t{recorded_at:.0f}\n")
+            os.replace(tmp_path, self.path)
+
+    def _expired(self, entry):
+        return self.ttl > 0 and time.time() - entry[1] >= self.ttl
+
+    def __contains__(self, ytb_id):
+        with self.lock:
+            entry = self.entries.get(ytb_id)
+            return entry is not None and not self._expired(entry)
+
+    def __len__(self):
+        with self.lock:
+            return sum(1 for entry in self.entries.values() if not self._expired(entry))
+
+    def record(self, ytb_id, reason):
+        with self.lock:
+            entry = self.entries.get(ytb_id)
+            if entry is not None and not self._expired(entry):
+                return
+            recorded_at = time.time()
+            self.entries[ytb_id] = (reason, recorded_at)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(f"{ytb_id}\t{reason}\t{recorded_at:.0f}\n")
+
+
+def error_summary(output):
+    """Last ERROR line of yt-dlp output, to record as the failure reason"""
+    lines = [line.strip() for line in (output or '').splitlines() if line.strip()]
+    errors = [line for line in lines if 'ERROR' in line]
+    return (errors or lines or ['unknown error'])[-1][:300]
+
+
+class DownloadController:
+    """
+    Additive-increase / multiplicative-decrease control of download concurrency and of
+    aria2c connections per download.
+
+    A fast download adds 1/limit to the concurrency limit and one connection. Throttling
+    halves both and pauses every new download for a jittered, exponentially growing backoff.
+    A download much slower than the running average halves the concurrency limit, as the
+    link is saturated.
+    """
+
+    def __init__(self, max_concurrency, max_connections, min_concurrency=1, min_connections=1,
+                 max_attempts=DEFAULT_DOWNLOAD_ATTEMPTS, permanent_failures=None,
+                 backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX,
+                 retry_delay=DEFAULT_RETRY_DELAY, adaptive=True):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.max_connections = max(1, max_connections)
+        self.min_connections = max(1, min(min_connections, self.max_connections))
+        self.max_attempts = max(1, max_attempts)
+        self.permanent_failures = permanent_failures if permanent_failures is not None else PermanentFailures()
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_delay = retry_delay
+        self.adaptive = adaptive
+
+        self.cond = threading.Condition()
+        self.limit = float(self.max_concurrency)
+        self.connections = float(self.max_connections)
+        self.active = 0
+        self.paused_until = 0.0
+        self.consecutive_throttles = 0
+        self.avg_throughput = None
+
+    def describe(self):
+        with self.cond:
+            return (f"{int(self.limit)}/{self.max_concurrency} concurrent downloads, "
+                    f"{int(self.connections)}/{self.max_connections} connections each")
+
+    @contextmanager
+    def slot(self):
+        """
+        Wait for a download slot, honouring the concurrency limit and any throttling backoff
+
+        Yields:
+            int: aria2c connections to use for this download
+        """
+        with self.cond:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.active < max(1, int(self.limit)):
+                    break
+                self.cond.wait(timeout=wait if wait > 0 else None)
+            self.active += 1
+            connections = int(self.connections)
+        try:
+            yield connections
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+
+    def record_success(self, size, seconds):
+        """Feed the throughput of a finished download into the controller"""
+        throughput = size / seconds if seconds > 0 else 0.0
+        with self.cond:
+            self.consecutive_throttles = 0
+            if not self.adaptive:
+                return
+            if self.avg_throughput and throughput < SLOW_DOWNLOAD_RATIO * self.avg_throughput:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                logging.info(f"Download throughput dropped to {throughput / 1024 ** 2:.2f} MB/s, "
+                             f"lowering concurrency to {int(self.limit)}")
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                self.connections = min(self.max_connections, self.connections + 1)
+            if self.avg_throughput is None:
+                self.avg_throughput = throughput
+            else:
+                self.avg_throughput += THROUGHPUT_SMOOTHING * (throughput - self.avg_throughput)
+            self.cond.notify_all()
+
+    def record_failure(self, ytb_id, kind, output):
+        """
+        Feed a failed download into the controller
+
+        Returns:
+            float: seconds to wait before retrying it
+        """
+        if kind == 'permanent':
+            reason = error_summary(output)
+            self.permanent_failures.record(ytb_id, reason)
+            logging.warning(f"{ytb_id} can not be downloaded ({reason}), it will not be tried again "
+                            f"until its record expires")
+            return 0.0
+
+        with self.cond:
+            if kind == 'throttled':
+                self.consecutive_throttles += 1
+                backoff = min(self.backoff_max, self.backoff_base * 2 ** (self.consecutive_throttles - 1))
+                backoff *= random.uniform(0.5, 1.5)
+                self.paused_until = max(self.paused_until, time.monotonic() + backoff)
+                if self.adaptive:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self.connections = max(self.min_connections, self.connections / 2)
+                logging.warning(f"Throttled while downloading {ytb_id}, pausing downloads for {backoff:.0f}s "
+                                f"({int(self.limit)} concurrent, {int(self.connections)} connections)")
+                return 0.0  # The pause applies to every download, the retry waits for its slot
+        return self.retry_delay * random.uniform(0.5, 1.5)
+
+    def is_permanent(self, ytb_id):
+        return ytb_id in self.permanent_failures
+
+
+_controller = DownloadController(max_concurrency=1 << 16, max_connections=16, adaptive=False)
+
+
+def configure_download_controller(**kwargs):
+    """Set the process-wide DownloadController, see its arguments"""
+    global _controller
+    _controller = DownloadController(**kwargs)
+    return _controller
+
+
+def get_download_controller():
+    """The process-wide DownloadController"""
+    return _controller
@@ -0,0 +1,203 @@
+"""
+Planning step of merge_video.py: pairs every video clip of the remote tars with its audio
+file before anything is merged, from tar listings read in one pass per tar and cached
+"""
+
+import os
+import json
+import time
+import tarfile
+import logging
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_TAR_REMOTE = 'gdrive:CelebV-Text/video/'
+DEFAULT_LISTING_DIR = 'tar_listings'
+DEFAULT_MISMATCH_REPORT = 'merge_mismatch_report.json'
+DEFAULT_LIST_WORKERS = 8  # Tars listed at the same time
+
+
+def index_audio(audio_dir):
+    """
+    Scan the audio folder once
+
+    Returns:
+        dict: {clip name without extension: path of its .m4a}
+    """
+    index = {}
+    if not os.path.isdir(audio_dir):
+        return index
+    with os.scandir(audio_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.m4a'):
+                index[os.path.splitext(entry.name)[0]] = entry.path
+    return index
+
+
+def list_remote_tars(remote_dir=DEFAULT_TAR_REMOTE):
+    """
+    Tar files of the remote folder
+
+    Returns:
+        dict: {tar file name: size in bytes}, sorted by name
+    """
+    result = subprocess.run(['rclone', 'lsf', '--drive-shared-with-me', '--files-only', '--include', '*.tar',
+                             '--format', 'sp', '--separator', ';', remote_dir],
+                            capture_output=True, text=True, check=True)
+    tars = {}
+    for line in result.stdout.splitlines():
+        size, _, name = line.strip().partition(';')
+        if name.endswith('.tar'):
+            tars[name] = int(size)
+    return dict(sorted(tars.items()))
+
+
+def stream_tar_listing(remote_path):
+    """
+    Names of the regular files of a remote tar, from one streamed `rclone cat`
+
+    The tar is read once front to back and its clip data discarded: one rclone process and
+    one Drive request per tar, where ranged reads between headers would cost one of each
+    per clip.
+
+    Returns:
+        list: member names, in archive order
+    """
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(['rclone', 'cat', '--drive-shared-with-me', remote_path],
+                                stdout=subprocess.PIPE, stderr=stderr)
+        names = None
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+                names = [member.name for member in tar if member.isfile()]
+            # Only the zero padding of the last record follows the end-of-archive marker
+            while proc.stdout.read(1024 * 1024):
+                pass
+        except tarfile.TarError as e:
+            error = e
+        finally:
+            proc.stdout.close()
+            if names is None and proc.poll() is None:
+                proc.terminate()  # Not a tar, the rest of it is not needed
+            proc.wait()
+        # A stream cut short by rclone can end on a header boundary and still parse, so its exit
+        # status counts even when the listing looks complete; a negative one is the terminate above
+        if proc.returncode > 0 or (names is not None and proc.returncode != 0):
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(proc.returncode, proc.args,
+                                                stderr=stderr.read().decode(errors='replace'))
+        if names is None:
+            raise error
+    return names
+
+
+class TarListings:
+    """Member names of each tar, one JSON file per tar, invalidated when the tar's size changes"""
+
+    def __init__(self, listing_dir=DEFAULT_LISTING_DIR, remote_dir=DEFAULT_TAR_REMOTE, local_dir=None):
+        self.listing_dir = listing_dir
+        self.remote_dir = remote_dir
+        self.local_dir = local_dir
+        os.makedirs(listing_dir, exist_ok=True)
+
+    def _path(self, tar_filename):
+        return os.path.join(self.listing_dir, f"{tar_filename}.json")
+
+    def get(self, tar_filename, size):
+        """
+        Member names of a tar: from the cache, from a local copy of the tar, or streamed from the remote
+
+        Returns:
+            list: member names
+        """
+        path = self._path(tar_filename)
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    listing = json.load(f)
+                if listing['size'] == size:
+                    return listing['members']
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Ignoring unreadable listing {path}: {e}")
+
+        local_path = os.path.join(self.local_dir, tar_filename) if self.local_dir else None
+        if local_path and os.path.exists(local_path) and os.path.getsize(local_path) == size:
+            with tarfile.open(local_path, 'r') as tar:
+                members = [member.name for member in tar.getmembers() if member.isfile()]
+        else:
+            start_time = time.monotonic()
+            members = stream_tar_listing(self.remote_dir + tar_filename)
+            logging.info(f"Listed {len(members)} members of {tar_filename} in {time.monotonic() - start_time:.1f}s")
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': size, 'members': members}, f)
+        os.replace(tmp_path, path)
+        return members
+
+
+def plan_merges(tars, audio_index, listings, workers=DEFAULT_LIST_WORKERS):
+    """
+    Pair the video clips of every tar with their audio files
+
+    Args:
+        tars: {tar file name: size}
+        audio_index: result of index_audio
+        listings: TarListings
+        workers: tars listed at the same time
+
+    Returns:
+        dict: {tar file name: {'videos': clip count, 'pairs': {clip file name: audio path} or
+        None when the tar could not be listed, 'missing_audio': [clip names without audio]}}
+    """
+    def plan(item):
+        tar_filename, size = item
+        try:
+            members = listings.get(tar_filename, size)
+        except (subprocess.CalledProcessError, tarfile.TarError, OSError, ValueError) as e:
+            logging.error(f"Could not list {tar_filename}, its clips will be paired while merging: {e}")
+            return tar_filename, {'videos': None, 'pairs': None, 'missing_audio': []}
+
+        pairs, missing_audio = {}, []
+        videos = [os.path.basename(name) for name in members if name.endswith('.mp4')]
+        for file in videos:
+            audio_path = audio_index.get(os.path.splitext(file)[0])
+            if audio_path is None:
+                missing_audio.append(file)
+            else:
+                pairs[file] = audio_path
+        return tar_filename, {'videos': len(videos), 'pairs': pairs, 'missing_audio': missing_audio}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return dict(executor.map(plan, tars.items()))
+
+
+def write_mismatch_report(path, manifest, audio_index):
+    """
+    Write the clips that can not be merged: videos without audio per tar, and audio files
+    whose video is in none of the listed tars
+    """
+    paired = set()
+    for plan in manifest.values():
+        paired.update(os.path.splitext(file)[0] for file in plan['pairs'] or ())
+    complete = all(plan['pairs'] is not None for plan in manifest.values())
+
+    report = {
+        'generated_at': time.time(),
+        'tars': {
+            tar_filename: {
+                'videos': plan['videos'],
+                'pairs': None if plan['pairs'] is None else len(plan['pairs']),
+                'videos_without_audio': plan['missing_audio'],
+            }
+            for tar_filename, plan in manifest.items()
+        },
+        # Only meaningful when every tar could be listed
+        'audio_without_video': sorted(set(audio_index) - paired) if complete else None,
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+    return report
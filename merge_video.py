@@ -4,7 +4,20 @@ import subprocess
 import shutil
 import logging
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from backends import configure_backend, get_backend, DEFAULT_BACKEND
+from metrics import METRICS, MetricsReporter, timed, DEFAULT_METRICS_INTERVAL
+from merge_manifest import (index_audio, list_remote_tars, plan_merges, write_mismatch_report, TarListings,
+                            DEFAULT_TAR_REMOTE, DEFAULT_LIST_WORKERS, DEFAULT_MISMATCH_REPORT)
+from verify import (configure_verifier, get_verifier, DEFAULT_VERIFY_CACHE, DEFAULT_CHECKSUM_LOG,
+                    DEFAULT_DURATION_TOLERANCE)
+
+DEFAULT_MERGE_MODE = 'extract'  # 'extract' copies and extracts each tar first, 'stream' reads it from Google Drive as it merges
+DEFAULT_UPLOAD_EVERY = 100  # Merged clips per Dropbox move
+DEFAULT_MERGE_PREFETCH = 2  # Tars fetched ahead of the one being merged
 
 def setup_logging():
     """Setup logging configuration"""
@@ -53,6 +66,7 @@ def save_progress(completed_files):
         for file in sorted(completed_files):
             f.write(f"{file}\n")
 
+@timed('copy_from_gdrive')
 def copy_from_gdrive(tar_filename, raw_dir, logger):
     """Copy tar file from Google Drive"""
     try:
@@ -60,99 +74,352 @@ def copy_from_gdrive(tar_filename, raw_dir, logger):
         subprocess.run([
             'rclone', 'copy', '--drive-shared-with-me', gdrive_path, raw_dir, '-P'
         ], check=True)
+        METRICS.inc('download_bytes_total', os.path.getsize(os.path.join(raw_dir, tar_filename)))
         logger.info(f"Successfully copied {tar_filename} from Google Drive")
         return True
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, OSError) as e:
         logger.error(f"Error copying {tar_filename} from Google Drive: {e}")
         return False
 
-def process_tar_file(tar_filename, logger):
-    """Process a single tar file"""
+def merge_clip(video_path, audio_path, output_file, logger):
+    """Mux a video clip with its audio track, both streams copied, with the processing backend"""
+    with METRICS.timer('merge_ffmpeg'):
+        merged = get_backend().merge(video_path, audio_path, output_file)
+    if merged:
+        logger.info(f"Merged {os.path.basename(video_path)} successfully")
+    return merged
+
+def move_merged_to_dropbox(merged_dir, logger, files=None):
+    """Move files (names inside merged_dir), or every file of merged_dir, to Dropbox"""
+    names = files if files is not None else os.listdir(merged_dir)
+    merged_bytes = sum(os.path.getsize(os.path.join(merged_dir, name)) for name in names)
+    cmd = ['rclone', 'move', merged_dir + '/', 'dropbox:celebv_merged/', '-P']
+    list_path = None
+    if files is not None:
+        # Other clips of the folder may still be written by ffmpeg, move only the finished ones
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write(''.join(f"{name}\n" for name in files))
+            list_path = f.name
+        cmd[2:2] = ['--files-from', list_path]
+    try:
+        with METRICS.timer('move_to_dropbox'):
+            subprocess.run(cmd, check=True)
+    finally:
+        if list_path:
+            os.remove(list_path)
+    METRICS.inc('upload_bytes_total', merged_bytes)
+
+class ClipMerger:
+    """
+    Shared ffmpeg merge pool and Dropbox upload thread of every tar being processed.
+
+    The merges only copy streams, so each is one short ffmpeg process and a thread per
+    concurrent merge is enough to keep every core busy. Clips written out and not yet
+    merged are bounded so a fast tar reader can not fill the disk.
+    """
+
+    def __init__(self, logger, merge_workers, upload_every=DEFAULT_UPLOAD_EVERY):
+        self.logger = logger
+        self.upload_every = upload_every
+        self.merge_pool = ThreadPoolExecutor(max_workers=merge_workers, thread_name_prefix='Merge')
+        self.upload_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Upload')
+        self.slots = threading.BoundedSemaphore(2 * merge_workers)
+
+    def start_tar(self, merged_dir):
+        return TarMerge(self, merged_dir)
+
+    def shutdown(self):
+        self.merge_pool.shutdown()
+        self.upload_pool.shutdown()
+
+class TarMerge:
+    """Merges and uploads of the clips of one tar file, into its own merged folder"""
+
+    def __init__(self, merger, merged_dir):
+        self.merger = merger
+        self.merged_dir = merged_dir
+        self.lock = threading.Lock()
+        self.merge_futures = []
+        self.upload_futures = []
+        self.ready = []  # Merged clips not handed to an upload yet
+        self.merged_count = 0
+
+    def add(self, video_path, audio_path, remove_video=False):
+        """Queue the merge of a clip, waiting while too many clips wait for ffmpeg"""
+        self.merger.slots.acquire()
+        try:
+            future = self.merger.merge_pool.submit(self._merge, video_path, audio_path, remove_video)
+        except Exception:
+            self.merger.slots.release()
+            raise
+        self.merge_futures.append(future)
+
+    def _merge(self, video_path, audio_path, remove_video):
+        file = os.path.basename(video_path)
+        output_file = os.path.join(self.merged_dir, file)
+        try:
+            with METRICS.busy('merge'):
+                verifier = get_verifier()
+                expected = merged_duration(verifier, video_path, audio_path) if verifier is not None else None
+                if verifier is not None and os.path.exists(output_file) and \
+                        verifier.verify(output_file, expected_duration=expected, needs_audio=True):
+                    # Left by an earlier run that stopped before uploading it
+                    self.merger.logger.info(f"{file} is already merged and verified, skipping ffmpeg")
+                    METRICS.inc('merges_reused_total')
+                    merged = True
+                else:
+                    merged = merge_clip(video_path, audio_path, output_file, self.merger.logger)
+                    if merged and verifier is not None and \
+                            not verifier.verify(output_file, expected_duration=expected, needs_audio=True):
+                        self.merger.logger.error(f"Merged {file} failed verification, not uploading it")
+                        os.remove(output_file)
+                        merged = False
+                if merged and verifier is not None:
+                    verifier.record(output_file)
+            if remove_video:
+                os.remove(video_path)
+        finally:
+            self.merger.slots.release()
+        if merged:
+            with self.lock:
+                self.merged_count += 1
+                self.ready.append(file)
+                if len(self.ready) >= self.merger.upload_every:
+                    self._upload_ready()
+
+    def _upload_ready(self):
+        # Called with the lock held
+        batch, self.ready = self.ready, []
+        self.upload_futures.append(self.merger.upload_pool.submit(
+            move_merged_to_dropbox, self.merged_dir, self.merger.logger, batch))
+
+    def finish(self):
+        """
+        Wait for every merge, upload the remaining clips and wait for every upload
+
+        Returns:
+            bool: True if no merge raised and every upload succeeded
+        """
+        ok = True
+        for future in self.merge_futures:
+            try:
+                future.result()
+            except Exception as e:
+                self.merger.logger.error(f"Error merging into {self.merged_dir}: {e}")
+                ok = False
+        with self.lock:
+            if self.ready:
+                self._upload_ready()
+        for future in self.upload_futures:
+            try:
+                future.result()
+            except Exception as e:
+                self.merger.logger.error(f"Error moving clips of {self.merged_dir} to Dropbox: {e}")
+                ok = False
+        return ok
+
+def merged_duration(verifier, video_path, audio_path):
+    """Expected length of a merged clip: ffmpeg -shortest stops at the shorter input, None if unknown"""
+    durations = [verifier.duration(video_path), verifier.duration(audio_path)]
+    return None if None in durations else min(durations)
+
+def work_dirs(tar_filename):
+    """
+    Video and merged folders of one tar, so tars processed at the same time never share one.
+
+    With verification on, merged clips an earlier run left behind are kept, and reused once
+    they pass verification.
+    """
+    name = os.path.splitext(tar_filename)[0]
+    video_dir = os.path.join('celebvtext_video', name)
+    merged_dir = os.path.join('celebvtext_merged', name)
+    for directory in (video_dir, merged_dir):
+        if os.path.exists(directory) and (directory == video_dir or get_verifier() is None):
+            shutil.rmtree(directory)
+        os.makedirs(directory, exist_ok=True)
+    return video_dir, merged_dir
+
+def remove_work_dirs(*directories):
+    for directory in directories:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def find_audio(file, pairs, audio_dir='celebvtext_audio'):
+    """Audio path of a clip from the manifest's pairs, or looked up on disk when its tar could not be listed"""
+    if pairs is not None:
+        return pairs.get(file)
+    audio_path = os.path.join(audio_dir, f"{os.path.splitext(file)[0]}.m4a")
+    return audio_path if os.path.exists(audio_path) else None
+
+def log_merge_count(tar_filename, merged_count, pairs, logger):
+    if pairs is None:
+        logger.info(f"Merged {merged_count} files from {tar_filename}")
+    elif merged_count < len(pairs):
+        logger.warning(f"Merged {merged_count} of the {len(pairs)} expected files from {tar_filename}")
+    else:
+        logger.info(f"Merged {merged_count}/{len(pairs)} expected files from {tar_filename}")
+
+@timed('stream_tar_file')
+def stream_tar_file(tar_filename, merger, logger, pairs=None):
+    """
+    Process a tar file read as a stream from Google Drive, without storing or extracting it.
+
+    Each .mp4 member is written to a temporary file and queued for merging with its audio,
+    the file is deleted once merged, and merged clips are moved to Dropbox in batches while
+    the stream goes on, so only a few clips are on disk at any time. Clips missing from
+    pairs ({clip file name: audio path}, from the manifest) are skipped.
+    """
+    video_dir, merged_dir = work_dirs(tar_filename)
+    batch = merger.start_tar(merged_dir)
+
+    gdrive_path = f"gdrive:CelebV-Text/video/{tar_filename}"
+    proc = subprocess.Popen(['rclone', 'cat', '--drive-shared-with-me', gdrive_path], stdout=subprocess.PIPE)
+    streamed = False
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            for member in tar:
+                METRICS.inc('download_bytes_total', member.size)
+                file = os.path.basename(member.name)
+                if not member.isfile() or not file.endswith('.mp4'):
+                    continue
+
+                audio_path = find_audio(file, pairs)
+                if audio_path is None:
+                    # The stream skips over the member's data when the next one is read
+                    if pairs is None:
+                        logger.warning(f"Audio file for {file} not found, skipping it")
+                    continue
+
+                video_path = os.path.join(video_dir, file)
+                with METRICS.timer('extract_tar'), tar.extractfile(member) as src, open(video_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                batch.add(video_path, audio_path, remove_video=True)
+
+        # Read the padding after the end-of-archive marker so rclone exits cleanly
+        while proc.stdout.read(1 << 20):
+            pass
+        if proc.wait() != 0:
+            logger.error(f"rclone cat of {tar_filename} exited with code {proc.returncode}")
+        else:
+            streamed = True
+
+    except Exception as e:
+        logger.error(f"Error streaming {tar_filename}: {str(e)}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        # Clips merged before a failure are still uploaded, the rerun of the tar overwrites them
+        uploaded = batch.finish()
+        remove_work_dirs(video_dir)
+        if uploaded:
+            remove_work_dirs(merged_dir)
+
+    log_merge_count(tar_filename, batch.merged_count, pairs, logger)
+    if streamed and uploaded:
+        logger.info(f"All merged files from {tar_filename} moved to Dropbox")
+    return streamed and uploaded
+
+@timed('process_tar_file')
+def process_tar_file(tar_filename, merger, logger, pairs=None):
+    """Process a single tar file, extracting only the clips of pairs when given"""
     # Define directories
     raw_dir = 'celebvtext_video_raw'
-    video_dir = 'celebvtext_video'
-    audio_dir = 'celebvtext_audio'
-    merged_dir = 'celebvtext_merged'
     
     tar_path = os.path.join(raw_dir, tar_filename)
+    video_dir, merged_dir = work_dirs(tar_filename)
+    batch = merger.start_tar(merged_dir)
     
     try:
-        # Clean up video directory
-        if os.path.exists(video_dir):
-            shutil.rmtree(video_dir)
-        os.makedirs(video_dir, exist_ok=True)
-
-        # Clean up merged directory
-        if os.path.exists(merged_dir):
-            shutil.rmtree(merged_dir)
-        os.makedirs(merged_dir, exist_ok=True)
-
         # Extract tar file
-        with tarfile.open(tar_path, 'r') as tar:
-            tar.extractall(path=video_dir)
+        with METRICS.timer('extract_tar'), tarfile.open(tar_path, 'r') as tar:
+            members = [member for member in tar.getmembers()
+                       if pairs is None or os.path.basename(member.name) in pairs]
+            tar.extractall(path=video_dir, members=members)
             logger.info(f"Extracted files from {tar_filename} to {video_dir}")
 
-        # Process each video file
-        merged_count = 0
+        # Queue each video file
         for root, dirs, files in os.walk(video_dir):
             for file in files:
                 if file.endswith('.mp4'):
                     video_path = os.path.join(root, file)
-                    base_name = os.path.splitext(file)[0]
-                    audio_file = f"{base_name}.m4a"
-                    audio_path = os.path.join(audio_dir, audio_file)
+                    audio_path = find_audio(file, pairs)
                     
-                    if not os.path.exists(audio_path):
-                        logger.warning(f"Audio file {audio_file} not found, skipping {file}")
+                    if audio_path is None:
+                        logger.warning(f"Audio file for {file} not found, skipping it")
                         continue
                     
-                    output_file = os.path.join(merged_dir, file)
-                    
-                    # Merge using ffmpeg
-                    try:
-                        subprocess.run([
-                            'ffmpeg',
-                            '-i', video_path,
-                            '-i', audio_path,
-                            '-c:v', 'copy',
-                            '-c:a', 'copy',
-                            '-map', '0:v:0',
-                            '-map', '1:a:0',
-                            '-shortest',
-                            '-y',  # Overwrite output file
-                            output_file
-                        ], check=True, capture_output=True)
-                        logger.info(f"Merged {file} successfully")
-                        merged_count += 1
-                    except subprocess.CalledProcessError as e:
-                        logger.error(f"Error merging {file}: {e}")
-
-        logger.info(f"Merged {merged_count} files from {tar_filename}")
-
-        # Move merged files to Dropbox
-        if merged_count > 0:
-            subprocess.run([
-                'rclone',
-                'move',
-                merged_dir + '/',
-                'dropbox:celebv_merged/', '-P'
-            ], check=True)
-            logger.info(f"All merged files from {tar_filename} moved to Dropbox")
-        
-        # Remove the raw tar file
-        os.remove(tar_path)
-        logger.info(f"Removed raw tar file: {tar_filename}")
-        
-        return True
+                    batch.add(video_path, audio_path)
 
     except Exception as e:
         logger.error(f"Error processing {tar_filename}: {str(e)}")
+        if batch.finish():
+            remove_work_dirs(merged_dir)
+        remove_work_dirs(video_dir)
+        return False
+
+    # Merged files are moved to Dropbox in batches as they finish
+    uploaded = batch.finish()
+    remove_work_dirs(video_dir)
+    if uploaded:
+        remove_work_dirs(merged_dir)
+    log_merge_count(tar_filename, batch.merged_count, pairs, logger)
+    if not uploaded:
+        return False
+    logger.info(f"All merged files from {tar_filename} moved to Dropbox")
+    
+    # Remove the raw tar file
+    os.remove(tar_path)
+    logger.info(f"Removed raw tar file: {tar_filename}")
+    
+    return True
+
+def run_tar(tar_filename, merger, merge_mode, logger, pairs=None):
+    """Fetch and process one tar file, in the mode chosen for the run"""
+    if merge_mode == 'stream':
+        return stream_tar_file(tar_filename, merger, logger, pairs)
+    
+    # Copy from Google Drive
+    if not copy_from_gdrive(tar_filename, 'celebvtext_video_raw', logger):
+        logger.error(f"Failed to copy {tar_filename}, skipping to next file")
         return False
+    
+    # Process the tar file
+    return process_tar_file(tar_filename, merger, logger, pairs)
 
 def main():
     logger = setup_logging()
     logger.info("Starting merge video process")
     
+    merge_mode = os.getenv('CELEBV_MERGE_MODE', DEFAULT_MERGE_MODE)
+    upload_every = max(1, int(os.getenv('CELEBV_MERGE_UPLOAD_EVERY', DEFAULT_UPLOAD_EVERY)))
+    merge_workers = max(1, int(os.getenv('CELEBV_MERGE_WORKERS', os.cpu_count() or 1)))
+    prefetch = max(0, int(os.getenv('CELEBV_MERGE_PREFETCH', DEFAULT_MERGE_PREFETCH)))
+    if merge_mode not in ('stream', 'extract'):
+        logger.warning(f"Unknown CELEBV_MERGE_MODE {merge_mode}, using {DEFAULT_MERGE_MODE}")
+        merge_mode = DEFAULT_MERGE_MODE
+    logger.info(f"Merge mode: {merge_mode}, {merge_workers} merge workers, {prefetch} tars fetched ahead")
+    
+    # Same variable as download_and_process.py, 'pyav' muxes in-process instead of one ffmpeg run per clip
+    backend = configure_backend(os.getenv('CELEBV_BACKEND', DEFAULT_BACKEND))
+    logger.info(f"Processing backend: {backend.name}")
+    
+    # Same variables as download_and_process.py, an empty CELEBV_VERIFY_CACHE turns verification off
+    verifier = configure_verifier(os.getenv('CELEBV_VERIFY_CACHE', DEFAULT_VERIFY_CACHE),
+                                  int(os.getenv('CELEBV_VERIFY_WORKERS', os.cpu_count() or 1)),
+                                  float(os.getenv('CELEBV_VERIFY_TOLERANCE', DEFAULT_DURATION_TOLERANCE)),
+                                  os.getenv('CELEBV_CHECKSUM_LOG', DEFAULT_CHECKSUM_LOG))
+    logger.info(f"Verification of merged clips: {'on' if verifier is not None else 'off'}")
+    
+    # Metrics files are optional, same variables as download_and_process.py
+    metrics_textfile = os.getenv('CELEBV_METRICS_TEXTFILE', None)
+    metrics_jsonl = os.getenv('CELEBV_METRICS_JSONL', None)
+    reporter = None
+    if metrics_textfile or metrics_jsonl:
+        reporter = MetricsReporter(METRICS, metrics_textfile, metrics_jsonl,
+                                   float(os.getenv('CELEBV_METRICS_INTERVAL', DEFAULT_METRICS_INTERVAL)),
+                                   {'merge': merge_workers}).start()
+    
     # Create raw directory
     raw_dir = 'celebvtext_video_raw'
     os.makedirs(raw_dir, exist_ok=True)
@@ -161,29 +428,74 @@ def main():
     completed_files = load_progress()
     logger.info(f"Loaded progress: {len(completed_files)} files already completed")
     
-    # Generate list of tar files to process
-    tar_files = [f"sp_{i:04d}.tar" for i in range(2, 70)]
-    
-    # Filter out already completed files
-    remaining_files = [f for f in tar_files if f not in completed_files]
-    logger.info(f"Processing {len(remaining_files)} remaining files")
-    
-    for i, tar_filename in enumerate(remaining_files, 1):
-        logger.info(f"Processing file {i}/{len(remaining_files)}: {tar_filename}")
-        
-        # Copy from Google Drive
-        if not copy_from_gdrive(tar_filename, raw_dir, logger):
-            logger.error(f"Failed to copy {tar_filename}, skipping to next file")
-            continue
-        
-        # Process the tar file
-        if process_tar_file(tar_filename, logger):
-            completed_files.add(tar_filename)
-            save_progress(completed_files)
-            logger.info(f"Successfully completed processing {tar_filename}")
-        else:
-            logger.error(f"Failed to process {tar_filename}")
+    # List the tar files on Google Drive and pair their clips with the audio files
+    try:
+        tar_files = list_remote_tars(DEFAULT_TAR_REMOTE)
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Could not list the tar files on Google Drive: {e.stderr}")
+        if reporter is not None:
+            reporter.stop()
+        return
+    remaining_tars = {name: size for name, size in tar_files.items() if name not in completed_files}
+    audio_index = index_audio('celebvtext_audio')
+    logger.info(f"Found {len(tar_files)} tar files ({len(remaining_tars)} not completed) "
+                f"and {len(audio_index)} audio files")
+    
+    with METRICS.timer('plan_merges'):
+        manifest = plan_merges(remaining_tars, audio_index, TarListings(local_dir=raw_dir),
+                               int(os.getenv('CELEBV_MERGE_LIST_WORKERS', DEFAULT_LIST_WORKERS)))
+    report_path = os.getenv('CELEBV_MERGE_REPORT', DEFAULT_MISMATCH_REPORT)
+    report = write_mismatch_report(report_path, manifest, audio_index)
+    for tar_filename, plan in manifest.items():
+        if plan['pairs'] is not None:
+            logger.info(f"{tar_filename}: {len(plan['pairs'])}/{plan['videos']} clips have audio")
+    if report['audio_without_video']:
+        logger.warning(f"{len(report['audio_without_video'])} audio files match no clip of the remaining tars")
+    logger.info(f"Mismatch report written to {report_path}")
+    
+    # Tars without any clip to merge are skipped, not marked completed, so they are planned
+    # again when more audio files arrive
+    remaining_files = [name for name, plan in manifest.items() if plan['pairs'] is None or plan['pairs']]
+    skipped = len(manifest) - len(remaining_files)
+    if skipped:
+        logger.info(f"Skipping {skipped} tar files without any matching audio")
+    expected = sum(len(manifest[name]['pairs']) for name in remaining_files if manifest[name]['pairs'] is not None)
+    logger.info(f"Processing {len(remaining_files)} remaining files, {expected} clips expected")
+    
+    # The current tar and the prefetched ones are read at the same time, their clips share
+    # one merge pool and one upload thread
+    merger = ClipMerger(logger, merge_workers, upload_every)
+    try:
+        with ThreadPoolExecutor(max_workers=prefetch + 1, thread_name_prefix='Tar') as tar_pool:
+            futures = {}
+            for tar_filename in remaining_files:
+                futures[tar_pool.submit(run_tar, tar_filename, merger, merge_mode, logger,
+                                        manifest[tar_filename]['pairs'])] = tar_filename
+            
+            for i, future in enumerate(as_completed(futures), 1):
+                tar_filename = futures[future]
+                try:
+                    processed = future.result()
+                except Exception as e:
+                    logger.error(f"Error processing {tar_filename}: {e}")
+                    processed = False
+                if processed:
+                    completed_files.add(tar_filename)
+                    save_progress(completed_files)
+                    logger.info(f"Successfully completed processing {tar_filename} ({i}/{len(remaining_files)})")
+                else:
+                    logger.error(f"Failed to process {tar_filename} ({i}/{len(remaining_files)})")
+    finally:
+        merger.shutdown()
+        if verifier is not None:
+            verifier.flush()
     
+    if reporter is not None:
+        reporter.stop()
+    if verifier is not None:
+        logger.info(f"Verification: {verifier.summary()}")
+    logger.info("Time spent per step:")
+    METRICS.log_summary(logger)
     logger.info("Merge video process completed")
 
 if __name__ == '__main__':
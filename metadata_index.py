@@ -0,0 +1,210 @@
+"""
+Compact, memory-mapped index of celebvtext_info.json
+
+Compile once:
+    python metadata_index.py celebvtext_info.json celebvtext_info.idx
+
+then point CELEBV_JSON_PATH at the .idx file. The index holds the clips grouped by ytb_id in
+array-backed columns, loads in milliseconds, and decodes a group only when it is accessed.
+"""
+
+import os
+import sys
+import mmap
+import json
+import struct
+import logging
+import argparse
+from array import array
+from collections import defaultdict
+from collections.abc import Mapping
+
+MAGIC = b'CVTIDX01'
+# magic, byte order, clip count, group count, then the offset of every section below
+HEADER = struct.Struct('<8sBxxxIIxxxx' + 'Q' * 11)
+SECTIONS = ('start', 'end', 'top', 'bottom', 'left', 'right',
+            'group_offsets', 'name_offsets', 'names', 'ytb_offsets', 'ytb_ids')
+FLOAT_COLUMNS = ('start', 'end', 'top', 'bottom', 'left', 'right')
+BYTE_ORDERS = {'little': 0, 'big': 1}
+
+
+def is_metadata_index(file_path):
+    """Check whether file_path is a compiled metadata index rather than JSON"""
+    with open(file_path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def compile_index(json_path, index_path):
+    """
+    Compile celebvtext_info.json into a metadata index
+
+    Groups keep the order in which their ytb_id first appears in the JSON, and clips keep
+    their JSON order within a group, like load_and_group_data.
+
+    Returns:
+        tuple: (clip count, group count)
+    """
+    with open(json_path) as f:
+        data_dict = json.load(f)
+
+    groups = defaultdict(list)
+    for key, val in data_dict.items():
+        groups[val['ytb_id']].append((key, val))
+
+    columns = {name: array('d') for name in FLOAT_COLUMNS}
+    group_offsets = array('I', [0])
+    name_offsets, names = array('I', [0]), bytearray()
+    ytb_offsets, ytb_ids = array('I', [0]), bytearray()
+
+    for ytb_id, clips in groups.items():
+        for save_name, val in clips:
+            columns['start'].append(val['duration']['start_sec'])
+            columns['end'].append(val['duration']['end_sec'])
+            for side in ('top', 'bottom', 'left', 'right'):
+                columns[side].append(val['bbox'][side])
+            names += save_name.encode()
+            name_offsets.append(len(names))
+        group_offsets.append(len(name_offsets) - 1)
+        ytb_ids += ytb_id.encode()
+        ytb_offsets.append(len(ytb_ids))
+
+    sections = {
+        **{name: columns[name].tobytes() for name in FLOAT_COLUMNS},
+        'group_offsets': group_offsets.tobytes(),
+        'name_offsets': name_offsets.tobytes(),
+        'names': bytes(names),
+        'ytb_offsets': ytb_offsets.tobytes(),
+        'ytb_ids': bytes(ytb_ids),
+    }
+
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(b'\0' * HEADER.size)
+        offsets = []
+        for name in SECTIONS:
+            # Keep every section 8-byte aligned so the mapped columns can be cast in place
+            f.write(b'\0' * (-f.tell() % 8))
+            offsets.append(f.tell())
+            f.write(sections[name])
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, BYTE_ORDERS[sys.byteorder], len(columns['start']), len(groups), *offsets))
+    os.replace(tmp_path, index_path)
+
+    return len(columns['start']), len(groups)
+
+
+class MetadataIndex(Mapping):
+    """
+    Read-only, memory-mapped view of a compiled metadata index.
+
+    Behaves like the {ytb_id: [video processing data]} dict returned by load_and_group_data,
+    in the same order, but only decodes the groups that are accessed.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        with open(index_path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, byte_order, self.clip_count, self.group_count, *offsets = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Not a metadata index: {index_path}")
+        if byte_order != BYTE_ORDERS[sys.byteorder]:
+            raise ValueError(f"Metadata index {index_path} was compiled on a machine with another byte order")
+
+        ends = offsets[1:] + [len(self.mm)]
+        view = memoryview(self.mm)
+        raw = {name: view[start:end] for name, start, end in zip(SECTIONS, offsets, ends)}
+
+        self.columns = {name: raw[name][:self.clip_count * 8].cast('d') for name in FLOAT_COLUMNS}
+        self.group_offsets = raw['group_offsets'][:(self.group_count + 1) * 4].cast('I')
+        self.name_offsets = raw['name_offsets'][:(self.clip_count + 1) * 4].cast('I')
+        self.ytb_offsets = raw['ytb_offsets'][:(self.group_count + 1) * 4].cast('I')
+        self.names = raw['names']
+        self.ytb_ids = raw['ytb_ids']
+        self.positions = None
+
+    def ytb_id(self, group):
+        """ytb_id of the group at position group"""
+        return bytes(self.ytb_ids[self.ytb_offsets[group]:self.ytb_offsets[group + 1]]).decode()
+
+    def clip_range(self, group):
+        """Row range of the clips of the group at position group"""
+        return range(self.group_offsets[group], self.group_offsets[group + 1])
+
+    def clip(self, row):
+        """Video processing data of the clip at row"""
+        columns = self.columns
+        return {
+            'save_name': bytes(self.names[self.name_offsets[row]:self.name_offsets[row + 1]]).decode(),
+            'time': (columns['start'][row], columns['end'][row]),
+            'bbox': [columns['top'][row], columns['bottom'][row], columns['left'][row], columns['right'][row]],
+        }
+
+    def group(self, group):
+        """List of video processing data of the group at position group"""
+        return [self.clip(row) for row in self.clip_range(group)]
+
+    def group_clip_seconds(self, group):
+        """Total clip seconds of the group at position group, read straight from the columns"""
+        start, end = self.columns['start'], self.columns['end']
+        return sum(end[row] - start[row] for row in self.clip_range(group))
+
+    def iter_groups(self):
+        """Stream (ytb_id, list of video processing data) in index order"""
+        for group in range(self.group_count):
+            yield self.ytb_id(group), self.group(group)
+
+    def __len__(self):
+        return self.group_count
+
+    def __iter__(self):
+        for group in range(self.group_count):
+            yield self.ytb_id(group)
+
+    def __getitem__(self, ytb_id):
+        if self.positions is None:
+            self.positions = {self.ytb_id(group): group for group in range(self.group_count)}
+        return self.group(self.positions[ytb_id])
+
+    def items(self):
+        return self.iter_groups()
+
+    def close(self):
+        """Release the mapping, views handed out before are invalid afterwards"""
+        for name in FLOAT_COLUMNS:
+            self.columns[name].release()
+        for view in (self.group_offsets, self.name_offsets, self.ytb_offsets, self.names, self.ytb_ids):
+            view.release()
+        self.mm.close()
+
+
+def verify_index(json_path, index_path):
+    """Check that the index returns the same groups as load_and_group_data on the JSON"""
+    from download_and_process import load_and_group_data
+
+    expected = load_and_group_data(json_path)
+    index = MetadataIndex(index_path)
+    try:
+        return list(expected.items()) == list(index.items())
+    finally:
+        index.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Compile celebvtext_info.json into a memory-mapped index")
+    parser.add_argument('json_path', help="metadata JSON, e.g. celebvtext_info.json")
+    parser.add_argument('index_path', help="index file to write, e.g. celebvtext_info.idx")
+    parser.add_argument('--verify', action='store_true', help="check the index against the JSON after compiling")
+    args = parser.parse_args()
+
+    clip_count, group_count = compile_index(args.json_path, args.index_path)
+    logging.info(f"Compiled {clip_count} clips in {group_count} ytb_id groups into {args.index_path}")
+
+    if args.verify:
+        if not verify_index(args.json_path, args.index_path):
+            logging.error("Index does not match the JSON")
+            sys.exit(1)
+        logging.info("Index matches the JSON")
@@ -0,0 +1,280 @@
+"""
+In-process metrics: counters, gauges and duration histograms, written periodically to a
+Prometheus textfile and a JSONL stream
+"""
+
+import os
+import json
+import time
+import bisect
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+DEFAULT_METRICS_INTERVAL = 15  # Seconds between metric snapshots
+# Upper bounds of the duration histogram buckets in seconds, +Inf is implied
+DURATION_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+FPS_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800, 1600)
+PREFIX = 'celebv_'
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values"""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, gauges and histograms, each keyed by name and labels.
+
+    Collectors are callables run before every snapshot, to refresh gauges that are sampled
+    rather than updated in place, such as pipeline queue depths.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter"""
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """Set a gauge"""
+        with self.lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    def add_gauge(self, name, value, **labels):
+        """Add value to a gauge, negative to decrease it"""
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        """Record a value in a histogram, buckets are fixed by the first observation"""
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        """Run collector() before every snapshot"""
+        with self.lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Record the duration of a block in the <name>_seconds histogram, labelled by outcome"""
+        start_time = time.monotonic()
+        outcome = 'ok'
+        try:
+            yield
+        except BaseException:
+            outcome = 'error'
+            raise
+        finally:
+            self.observe(f'{name}_seconds', time.monotonic() - start_time, outcome=outcome, **labels)
+
+    @contextmanager
+    def busy(self, stage):
+        """Count a worker of a stage as busy for the duration of a block"""
+        start_time = time.monotonic()
+        self.add_gauge('workers_busy', 1, stage=stage)
+        try:
+            yield
+        finally:
+            self.add_gauge('workers_busy', -1, stage=stage)
+            self.inc('worker_busy_seconds_total', time.monotonic() - start_time, stage=stage)
+
+    def snapshot(self):
+        """
+        Current values of every metric, after running the collectors
+
+        Returns:
+            dict: {'time', 'counters', 'gauges', 'histograms'}, metrics keyed by name{labels}
+        """
+        for collector in list(self.collectors):
+            try:
+                collector()
+            except Exception as e:
+                logging.debug(f"Metrics collector failed: {e}")
+
+        with self.lock:
+            return {
+                'time': time.time(),
+                'counters': {name + _format_labels(labels): value
+                             for (name, labels), value in self.counters.items()},
+                'gauges': {name + _format_labels(labels): value
+                           for (name, labels), value in self.gauges.items()},
+                'histograms': {name + _format_labels(labels): {'count': h.count, 'sum': round(h.sum, 6)}
+                               for (name, labels), h in self.histograms.items()},
+            }
+
+    def prometheus_text(self):
+        """All metrics in the Prometheus text exposition format"""
+        for collector in list(self.collectors):
+            try:
+                collector()
+            except Exception as e:
+                logging.debug(f"Metrics collector failed: {e}")
+
+        lines = []
+        with self.lock:
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted(set(name for name, _ in metrics)):
+                    lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                    for (metric_name, labels), value in sorted(metrics.items()):
+                        if metric_name == name:
+                            lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+
+            for name in sorted(set(name for name, _ in self.histograms)):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for (metric_name, labels), h in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if metric_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(h.buckets) + ['+Inf'], h.counts):
+                        cumulative += count
+                        lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {h.sum}")
+                    lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {h.count}")
+        return '\n'.join(lines) + '\n'
+
+    def log_summary(self, logger=None):
+        """Log count, total and mean of every duration histogram, the slowest total first"""
+        logger = logger or logging.getLogger()
+        with self.lock:
+            rows = [(name + _format_labels(labels), h.count, h.sum)
+                    for (name, labels), h in self.histograms.items() if name.endswith('_seconds')]
+        for name, count, total in sorted(rows, key=lambda row: row[2], reverse=True):
+            logger.info(f"  {name}: {count} calls, {total:.1f}s total, {total / count:.2f}s mean")
+
+
+METRICS = Metrics()
+
+
+def timed(name, registry=None, none_is_failure=False):
+    """
+    Decorator recording the duration of every call in the <name>_seconds histogram.
+
+    A call counts as failed if it raises or returns False, or None with none_is_failure.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            metrics = registry or METRICS
+            start_time = time.monotonic()
+            outcome = 'error'
+            try:
+                result = fn(*args, **kwargs)
+                failed = result is False or (none_is_failure and result is None)
+                outcome = 'failed' if failed else 'ok'
+                return result
+            finally:
+                metrics.observe(f'{name}_seconds', time.monotonic() - start_time, outcome=outcome)
+        return wrapper
+    return decorator
+
+
+class MetricsReporter:
+    """
+    Background thread that rewrites a Prometheus textfile and appends a snapshot to a JSONL
+    file every interval seconds, and once more when stopped.
+
+    Worker utilization per stage is derived from the busy seconds between two snapshots.
+    """
+
+    def __init__(self, registry=None, textfile_path=None, jsonl_path=None, interval=DEFAULT_METRICS_INTERVAL,
+                 workers=None):
+        """
+        Args:
+            textfile_path: Prometheus textfile to rewrite, None to skip
+            jsonl_path: JSONL file to append snapshots to, None to skip
+            workers: {stage: worker count} used to compute worker utilization
+        """
+        self.metrics = registry or METRICS
+        self.textfile_path = textfile_path
+        self.jsonl_path = jsonl_path
+        self.interval = interval
+        self.workers = workers or {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="MetricsReporter", daemon=True)
+        self.last_busy = {}
+        self.last_time = time.monotonic()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                logging.error(f"Failed to write metrics: {e}")
+
+    def _update_utilization(self):
+        now = time.monotonic()
+        elapsed = now - self.last_time
+        self.last_time = now
+        with self.metrics.lock:
+            busy = {dict(labels).get('stage'): value for (name, labels), value in self.metrics.counters.items()
+                    if name == 'worker_busy_seconds_total'}
+        for stage, workers in self.workers.items():
+            delta = busy.get(stage, 0.0) - self.last_busy.get(stage, 0.0)
+            if elapsed > 0 and workers:
+                self.metrics.set_gauge('worker_utilization', round(min(delta / (workers * elapsed), 1.0), 4),
+                                       stage=stage)
+            self.metrics.set_gauge('workers', workers, stage=stage)
+        self.last_busy = busy
+
+    def write(self):
+        """Write one snapshot to the configured files"""
+        self._update_utilization()
+        if self.textfile_path:
+            tmp_path = f"{self.textfile_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(self.metrics.prometheus_text())
+            os.replace(tmp_path, self.textfile_path)
+        if self.jsonl_path:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(self.metrics.snapshot()) + '\n')
@@ -0,0 +1,102 @@
+"""
+Staged pipeline: each stage runs on its own worker threads, with bounded queues in between
+"""
+
+import logging
+import queue
+import threading
+
+_DONE = object()  # Sentinel telling a worker that its stage has no more jobs
+
+
+class StagedPipeline:
+    """
+    Run jobs through a chain of stages, each with its own worker pool.
+
+    Stages are connected by bounded queues, so a slow stage pauses the stages in front of it
+    instead of letting work pile up on disk. A stage function returns True to pass the job
+    on to the next stage, or False to finish the job early.
+    """
+
+    def __init__(self, stages, queue_size=4, on_failed=None):
+        """
+        Args:
+            stages: list of (name, fn, workers) where fn(job) returns bool
+            queue_size: capacity of the queue in front of each stage
+            on_failed: fn(job) called for every job a stage returned False for or raised on,
+                e.g. to free what the stages after it would have cleaned up
+        """
+        self.stages = stages
+        self.on_failed = on_failed
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        self.alive = [workers for _, _, workers in stages]
+
+    def queue_depths(self):
+        """Number of jobs waiting in front of each stage"""
+        return {name: q.qsize() for (name, _, _), q in zip(self.stages, self.queues)}
+
+    def _worker(self, index):
+        name, fn, _ = self.stages[index]
+        is_last = index + 1 == len(self.stages)
+
+        while True:
+            job = self.queues[index].get()
+            if job is _DONE:
+                break
+
+            try:
+                passed = fn(job)
+            except Exception as e:
+                logging.error(f"Unexpected error in {name} stage: {e}")
+                passed = False
+
+            if not passed and self.on_failed is not None:
+                try:
+                    self.on_failed(job)
+                except Exception as e:
+                    logging.error(f"Cleanup after the {name} stage failed: {e}")
+
+            if passed and not is_last:
+                self.queues[index + 1].put(job)
+            else:
+                self.results.put((job, passed))
+
+        # The last worker of a stage to finish tells the next stage there is nothing more to come
+        with self.lock:
+            self.alive[index] -= 1
+            last_worker = self.alive[index] == 0
+        if last_worker:
+            if is_last:
+                self.results.put(_DONE)
+            else:
+                for _ in range(self.stages[index + 1][2]):
+                    self.queues[index + 1].put(_DONE)
+
+    def _feed(self, jobs):
+        try:
+            for job in jobs:
+                self.queues[0].put(job)
+        finally:
+            for _ in range(self.stages[0][2]):
+                self.queues[0].put(_DONE)
+
+    def run(self, jobs):
+        """
+        Feed jobs through the pipeline
+
+        Yields:
+            tuple: (job, bool) as each job leaves the pipeline, True if it passed every stage
+        """
+        for index, (name, _, workers) in enumerate(self.stages):
+            for i in range(workers):
+                threading.Thread(target=self._worker, args=(index,),
+                                 name=f"{name.capitalize()}Worker-{i}", daemon=True).start()
+        threading.Thread(target=self._feed, args=(jobs,), name="PipelineFeeder", daemon=True).start()
+
+        while True:
+            item = self.results.get()
+            if item is _DONE:
+                break
+            yield item
@@ -0,0 +1,142 @@
+"""
+Durable clip-level progress journal in SQLite, a drop-in replacement for progress.txt
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import defaultdict
+
+STAGES = ('downloaded', 'transcoded', 'uploaded')
+DEFAULT_COMMIT_EVERY = 200  # Buffered clip records per commit
+DEFAULT_COMMIT_INTERVAL = 5.0  # Seconds a clip record may stay buffered
+
+
+class ProgressJournal:
+    """
+    Clip-level progress in SQLite (WAL mode).
+
+    Records which stages (downloaded, transcoded, uploaded) every clip has passed, so a
+    resumed run only redoes the missing stages of the missing clips. Clip records are
+    buffered and committed in batches; whole ytb_id completions are committed at once.
+
+    Offers the same whole-ytb_id interface as ThreadSafeProgress.
+    """
+
+    def __init__(self, db_path, commit_every=DEFAULT_COMMIT_EVERY, commit_interval=DEFAULT_COMMIT_INTERVAL):
+        self.db_path = db_path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        self.buffer = []  # [(ytb_id, save_name, stage, timestamp)]
+        self.last_commit = time.monotonic()
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS clip_stages (
+                ytb_id TEXT NOT NULL,
+                save_name TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (save_name, stage)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS clip_stages_ytb_id ON clip_stages (ytb_id)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS completed (
+                ytb_id TEXT PRIMARY KEY,
+                completed_at REAL NOT NULL
+            )""")
+        self.conn.commit()
+
+        self.completed_ytb_ids = set(row[0] for row in self.conn.execute("SELECT ytb_id FROM completed"))
+
+    def import_progress_file(self, progress_file):
+        """
+        Import ytb_ids completed in a progress.txt file
+
+        Returns:
+            int: number of newly imported ytb_ids
+        """
+        if not os.path.exists(progress_file):
+            return 0
+
+        with open(progress_file, 'r') as f:
+            ytb_ids = set(line.strip() for line in f if line.strip())
+
+        with self.lock:
+            new_ids = ytb_ids - self.completed_ytb_ids
+            now = time.time()
+            self.conn.executemany("INSERT OR IGNORE INTO completed VALUES (?, ?)",
+                                  [(ytb_id, now) for ytb_id in new_ids])
+            self.conn.commit()
+            self.completed_ytb_ids |= new_ids
+        logging.info(f"Imported {len(new_ids)} completed ytb_ids from {progress_file}")
+        return len(new_ids)
+
+    def is_completed(self, ytb_id):
+        """Check if ytb_id is already completed"""
+        with self.lock:
+            return ytb_id in self.completed_ytb_ids
+
+    def mark_completed(self, ytb_id):
+        """Mark ytb_id as completed and commit it with any buffered clip records"""
+        with self.lock:
+            if ytb_id not in self.completed_ytb_ids:
+                self.completed_ytb_ids.add(ytb_id)
+                self.conn.execute("INSERT OR IGNORE INTO completed VALUES (?, ?)", (ytb_id, time.time()))
+                self._commit()
+
+    def get_completed_count(self):
+        """Get number of completed ytb_ids"""
+        with self.lock:
+            return len(self.completed_ytb_ids)
+
+    def mark_clips(self, ytb_id, save_names, stage):
+        """Record that clips of a ytb_id passed a stage, committed with the next batch"""
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage: {stage}")
+        now = time.time()
+        with self.lock:
+            self.buffer.extend((ytb_id, save_name, stage, now) for save_name in save_names)
+            if len(self.buffer) >= self.commit_every or time.monotonic() - self.last_commit >= self.commit_interval:
+                self._commit()
+
+    def clip_stages(self, ytb_id):
+        """
+        Stages passed by the clips of a ytb_id, including buffered records
+
+        Returns:
+            dict: {save_name: set of stages}
+        """
+        stages = defaultdict(set)
+        with self.lock:
+            for save_name, stage in self.conn.execute(
+                    "SELECT save_name, stage FROM clip_stages WHERE ytb_id = ?", (ytb_id,)):
+                stages[save_name].add(stage)
+            for buffered_ytb_id, save_name, stage, _ in self.buffer:
+                if buffered_ytb_id == ytb_id:
+                    stages[save_name].add(stage)
+        return dict(stages)
+
+    def flush(self):
+        """Commit buffered clip records"""
+        with self.lock:
+            self._commit()
+
+    def close(self):
+        """Commit buffered clip records and close the database"""
+        with self.lock:
+            self._commit()
+            self.conn.close()
+
+    def _commit(self):
+        # Called with the lock held
+        if self.buffer:
+            self.conn.executemany("INSERT OR REPLACE INTO clip_stages VALUES (?, ?, ?, ?)", self.buffer)
+            self.buffer = []
+        self.conn.commit()
+        self.last_commit = time.monotonic()
@@ -0,0 +1,219 @@
+"""
+Local cache of raw videos with a size cap and LRU eviction, so reruns skip the download
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+
+DEFAULT_RAW_CACHE_GB = 50
+INDEX_NAME = 'index.json'
+
+
+class RawCache:
+    """
+    Raw videos kept in a folder, keyed by file name (<ytb_id>.mp4 or a section file name).
+
+    Files enter the cache as hard links of the downloaded file when both folders are on the
+    same filesystem, so caching costs no extra disk while the working copy exists, and are
+    copied otherwise. The least recently used entries are evicted to stay under max_bytes,
+    except pinned ones: an entry stays pinned from the moment a job fetches or stores it
+    until the job releases it after its upload.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {key: size}, least recently used first
+        self.pins = {}  # {key: number of jobs using it}
+        self.stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'stored': 0, 'evicted': 0, 'evicted_bytes': 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.load()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self):
+        """Rebuild the LRU order from the saved index, then from file mtimes for unknown files"""
+        order = []
+        index_path = os.path.join(self.cache_dir, INDEX_NAME)
+        if os.path.exists(index_path):
+            try:
+                with open(index_path) as f:
+                    order = json.load(f)['lru']
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Ignoring unreadable raw cache index {index_path}: {e}")
+
+        on_disk = {name: os.stat(self._path(name)) for name in os.listdir(self.cache_dir)
+                   if name != INDEX_NAME and not name.endswith('.tmp') and os.path.isfile(self._path(name))}
+        known = [key for key in order if key in on_disk]
+        unknown = sorted(set(on_disk) - set(known), key=lambda key: on_disk[key].st_mtime)
+        for key in unknown + known:
+            self.entries[key] = on_disk[key].st_size
+        with self.lock:
+            self._evict(0)
+
+    def _save(self):
+        # Called with the lock held
+        index_path = os.path.join(self.cache_dir, INDEX_NAME)
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'lru': list(self.entries), 'saved_at': time.time()}, f)
+        os.replace(tmp_path, index_path)
+
+    def total_bytes(self):
+        with self.lock:
+            return sum(self.entries.values())
+
+    def _evict(self, needed):
+        """Evict unpinned entries, least recently used first, until needed more bytes fit. Lock held."""
+        total = sum(self.entries.values())
+        for key in list(self.entries):
+            if total + needed <= self.max_bytes:
+                break
+            if self.pins.get(key):
+                continue
+            size = self.entries.pop(key)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.stats['evicted'] += 1
+            self.stats['evicted_bytes'] += size
+            logging.info(f"Evicted {key} ({size / 1024 ** 2:.1f} MB) from the raw cache")
+        return total + needed <= self.max_bytes
+
+    def fetch(self, video_path):
+        """
+        Place the cached copy of video_path's file name at video_path and pin it
+
+        Returns:
+            bool: True on a cache hit
+        """
+        key = os.path.basename(video_path)
+        with self.lock:
+            size = self.entries.get(key)
+            if size is None:
+                self.stats['misses'] += 1
+                return False
+            self.entries.move_to_end(key)
+            self.pins[key] = self.pins.get(key, 0) + 1
+
+        try:
+            _link_or_copy(self._path(key), video_path)
+        except OSError as e:
+            logging.warning(f"Could not take {key} from the raw cache: {e}")
+            with self.lock:
+                self.stats['misses'] += 1
+                self._unpin(key)
+            return False
+
+        with self.lock:
+            self.stats['hits'] += 1
+            self.stats['bytes_saved'] += size
+            self._save()
+        logging.info(f"Raw cache hit: {key} ({size / 1024 ** 2:.1f} MB not downloaded)")
+        return True
+
+    def store(self, video_path):
+        """
+        Add a freshly downloaded file to the cache and pin it, evicting older entries as needed
+
+        Returns:
+            bool: True if the file was cached
+        """
+        key = os.path.basename(video_path)
+        size = os.path.getsize(video_path)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.pins[key] = self.pins.get(key, 0) + 1
+                return True
+            if size > self.max_bytes or not self._evict(size):
+                logging.info(f"Not caching {key}, the raw cache is full of files in use")
+                return False
+            # Reserve the space before copying, so concurrent stores can not overshoot the cap
+            self.entries[key] = size
+            self.pins[key] = self.pins.get(key, 0) + 1
+
+        try:
+            _link_or_copy(video_path, self._path(key))
+        except OSError as e:
+            logging.warning(f"Could not add {key} to the raw cache: {e}")
+            with self.lock:
+                self.entries.pop(key, None)
+                self._unpin(key)
+            return False
+
+        with self.lock:
+            self.stats['stored'] += 1
+            self._save()
+        return True
+
+    def release(self, video_path):
+        """Unpin the entry of video_path once its job no longer needs it"""
+        with self.lock:
+            self._unpin(os.path.basename(video_path))
+
+    def discard(self, video_path):
+        """Drop the entry of video_path's file name, e.g. when its file failed verification"""
+        key = os.path.basename(video_path)
+        with self.lock:
+            if self.entries.pop(key, None) is None:
+                return
+            self.pins.pop(key, None)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            self._save()
+        logging.warning(f"Dropped {key} from the raw cache")
+
+    def _unpin(self, key):
+        # Called with the lock held
+        if self.pins.get(key, 0) > 1:
+            self.pins[key] -= 1
+        else:
+            self.pins.pop(key, None)
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+            total = sum(self.entries.values())
+            count = len(self.entries)
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / lookups if lookups else 0.0
+        return (f"{stats['hits']} hits, {stats['misses']} misses ({hit_rate:.1%}), "
+                f"{stats['bytes_saved'] / 1024 ** 3:.2f} GB not downloaded, {stats['evicted']} evicted, "
+                f"{count} files / {total / 1024 ** 3:.2f} GB cached")
+
+
+def _link_or_copy(src, dst):
+    """Hard link src to dst, or copy it across filesystems; dst is replaced atomically"""
+    tmp_path = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+_raw_cache = None
+
+
+def configure_raw_cache(cache_dir, max_bytes):
+    """Set the process-wide raw cache, None to disable it"""
+    global _raw_cache
+    _raw_cache = RawCache(cache_dir, max_bytes) if cache_dir else None
+    return _raw_cache
+
+
+def get_raw_cache():
+    """The process-wide RawCache, or None when caching is off"""
+    return _raw_cache
@@ -0,0 +1,64 @@
+"""
+CPU budget for concurrent ffmpeg runs: thread counts and x264-style presets per run, so
+that parallel transcodes share the machine instead of each trying to use every core
+"""
+
+import os
+import logging
+
+# Fastest to slowest, the presets shared by libx264 and libx265
+PRESETS = ('ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow')
+
+
+class ResourceGovernor:
+    """
+    Split a CPU budget evenly between the ffmpeg runs that may execute at the same time.
+
+    With preset 'auto', runs that get few threads use a faster preset so a machine with more
+    transcode workers than cores still keeps up, and runs with 4 or more threads use
+    'medium', the libx264 default.
+    """
+
+    def __init__(self, cpu_budget=None, concurrent_jobs=1, preset='auto'):
+        """
+        Args:
+            cpu_budget: cores all ffmpeg runs together may use, default every core
+            concurrent_jobs: ffmpeg runs that may execute at the same time
+            preset: encoder preset, or 'auto' to choose one from the threads per run
+        """
+        self.cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.concurrent_jobs = max(1, concurrent_jobs)
+        self.preset = preset
+
+    def threads_per_job(self):
+        """ffmpeg threads of one run"""
+        return max(1, self.cpu_budget // self.concurrent_jobs)
+
+    def preset_for(self, threads):
+        """Encoder preset of a run with threads threads"""
+        if self.preset != 'auto':
+            return self.preset
+        if threads >= 4:
+            return 'medium'
+        return 'fast' if threads >= 2 else 'veryfast'
+
+    def describe(self):
+        threads = self.threads_per_job()
+        return (f"{self.cpu_budget} cores over {self.concurrent_jobs} concurrent ffmpeg runs, "
+                f"{threads} threads each, preset {self.preset_for(threads)}")
+
+
+_governor = ResourceGovernor()
+
+
+def configure_governor(cpu_budget=None, concurrent_jobs=1, preset='auto'):
+    """Set the process-wide CPU budget"""
+    global _governor
+    _governor = ResourceGovernor(cpu_budget, concurrent_jobs, preset)
+    logging.info(f"Resource governor: {_governor.describe()}")
+    return _governor
+
+
+def get_governor():
+    """The process-wide ResourceGovernor"""
+    return _governor
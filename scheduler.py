@@ -0,0 +1,157 @@
+"""
+Longest-job-first scheduling of ytb_ids, with a per-job cost model learned from past timings
+"""
+
+import os
+import json
+import logging
+import threading
+
+DEFAULT_COST_MODEL = 'cost_model.json'
+FEATURES = ('intercept', 'clips', 'clip_seconds', 'raw_seconds')
+# Seconds per unit of each feature until enough timings are recorded to fit them
+DEFAULT_COEFFICIENTS = (10.0, 1.0, 0.5, 0.05)
+DEFAULT_RIDGE = 1.0  # L2 penalty on the non-intercept coefficients
+MIN_SAMPLES = 20  # Timings needed before the fitted model replaces the defaults
+MAX_SAMPLES = 5000  # Most recent timings kept for fitting
+SAVE_EVERY = 10  # Timings recorded between saves of the model file
+
+
+def job_features(ytb_id, video_data_list, raw_vid_root=None):
+    """
+    Cost features of a ytb_id
+
+    The raw video duration is taken from the probe cache when the raw file is already on
+    disk, otherwise the end of the last clip is used as a lower bound.
+
+    Returns:
+        list: values of FEATURES
+    """
+    clip_seconds = sum(end_sec - start_sec for start_sec, end_sec in
+                       (video_data['time'] for video_data in video_data_list))
+    raw_seconds = max((video_data['time'][1] for video_data in video_data_list), default=0.0)
+
+    if raw_vid_root is not None:
+        raw_vid_path = os.path.join(raw_vid_root, f"{ytb_id}.mp4")
+        if os.path.exists(raw_vid_path):
+            from video_probe import get_video_info
+            try:
+                raw_seconds = get_video_info(raw_vid_path)['duration'] or raw_seconds
+            except Exception as e:
+                logging.debug(f"Could not probe {raw_vid_path} for its cost: {e}")
+
+    return [1.0, float(len(video_data_list)), clip_seconds, raw_seconds]
+
+
+def solve(matrix, vector):
+    """Solve a small dense linear system by Gaussian elimination with partial pivoting"""
+    n = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            raise ValueError("Singular system")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col + 1, n):
+            factor = rows[r][col] / rows[col][col]
+            for c in range(col, n + 1):
+                rows[r][c] -= factor * rows[col][c]
+    solution = [0.0] * n
+    for r in reversed(range(n)):
+        solution[r] = (rows[r][n] - sum(rows[r][c] * solution[c] for c in range(r + 1, n))) / rows[r][r]
+    return solution
+
+
+class CostModel:
+    """
+    Linear estimate of the seconds a ytb_id takes, fitted by ridge regression.
+
+    Timings of finished jobs are recorded with observe(), the model is refitted on every
+    timing and persisted to a JSON file, so later runs start with the learned coefficients.
+    """
+
+    def __init__(self, model_path=None, ridge=DEFAULT_RIDGE):
+        self.model_path = model_path
+        self.ridge = ridge
+        self.lock = threading.Lock()
+        self.coefficients = list(DEFAULT_COEFFICIENTS)
+        self.samples = []  # [(features, seconds)]
+        self.unsaved = 0
+        self.load()
+
+    def load(self):
+        """Load coefficients and timings from the model file, if it exists"""
+        if not self.model_path or not os.path.exists(self.model_path):
+            return
+        try:
+            with open(self.model_path) as f:
+                state = json.load(f)
+            if state.get('features') != list(FEATURES):
+                logging.warning(f"Ignoring cost model {self.model_path} with other features")
+                return
+            self.coefficients = state['coefficients']
+            self.samples = [(features, seconds) for features, seconds in state['samples']]
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable cost model {self.model_path}: {e}")
+
+    def save(self):
+        """Persist coefficients and timings to the model file"""
+        if not self.model_path:
+            return
+        with self.lock:
+            state = {'features': list(FEATURES), 'coefficients': self.coefficients, 'samples': self.samples}
+            self.unsaved = 0
+        tmp_path = f"{self.model_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.model_path)
+
+    def estimate(self, features):
+        """Estimated seconds of a job"""
+        return max(sum(c * x for c, x in zip(self.coefficients, features)), 0.0)
+
+    def observe(self, features, seconds):
+        """Record the measured seconds of a finished job and refit the model"""
+        with self.lock:
+            self.samples.append((list(features), seconds))
+            del self.samples[:-MAX_SAMPLES]
+            if len(self.samples) >= MIN_SAMPLES:
+                self.fit()
+            self.unsaved += 1
+            save = self.unsaved >= SAVE_EVERY
+        if save:
+            self.save()
+
+    def fit(self):
+        """Refit the coefficients on the recorded timings, call with the lock held"""
+        n = len(FEATURES)
+        gram = [[0.0] * n for _ in range(n)]
+        moment = [0.0] * n
+        for features, seconds in self.samples:
+            for i in range(n):
+                moment[i] += features[i] * seconds
+                for j in range(n):
+                    gram[i][j] += features[i] * features[j]
+        for i in range(1, n):
+            gram[i][i] += self.ridge
+        try:
+            self.coefficients = solve(gram, moment)
+        except ValueError:
+            logging.debug("Cost model timings are degenerate, keeping the previous coefficients")
+
+
+def order_by_cost(pending_ytb_ids, cost_model, raw_vid_root=None):
+    """
+    Sort pending ytb_ids by estimated cost, most expensive first
+
+    Args:
+        pending_ytb_ids: list of (ytb_id, video_data_list)
+        cost_model: CostModel instance
+
+    Returns:
+        tuple: (sorted list of (ytb_id, video_data_list), {ytb_id: estimated seconds})
+    """
+    costs = {ytb_id: cost_model.estimate(job_features(ytb_id, video_data_list, raw_vid_root))
+             for ytb_id, video_data_list in pending_ytb_ids}
+    ordered = sorted(pending_ytb_ids, key=lambda item: costs[item[0]], reverse=True)
+    return ordered, costs
@@ -0,0 +1,267 @@
+"""
+Rolling tar shards (WebDataset layout) of processed clips, each with a JSON index of member
+offsets, uploaded as soon as they are sealed
+"""
+
+import os
+import json
+import time
+import socket
+import tarfile
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS
+
+DEFAULT_SHARD_SIZE_MB = 1024
+DEFAULT_SHARD_MAX_AGE = 600  # Seconds a shard may stay open before it is sealed, whatever its size
+DEFAULT_SHARD_LOG = 'shards.jsonl'
+SHARD_PREFIX = 'celebv'
+
+
+def index_path(shard_path):
+    """Sidecar index of a shard: <shard>.json next to <shard>.tar"""
+    return os.path.splitext(shard_path)[0] + '.json'
+
+
+def read_member(shard_path, index_entry):
+    """Bytes of one member of a local shard, read at its offset from the index"""
+    with open(shard_path, 'rb') as f:
+        f.seek(index_entry['offset'])
+        return f.read(index_entry['size'])
+
+
+class ShardWriter:
+    """
+    Append processed clips to a tar shard until it reaches a target size or age, then seal it.
+
+    Sealing closes the tar, writes the sidecar index ({'shard', 'bytes', 'members': [{'name',
+    'ytb_id', 'offset', 'size'}]}, offsets of member data so a single ranged read returns a
+    clip) and queues both files for upload. Members are named after the clip's save_name, so
+    WebDataset readers see one sample per clip. Sidecar members such as keyframe indexes
+    follow their clip, named <save_name>.<ext>, and carry 'sidecar_of' in the index.
+
+    A ytb_id is only complete once every shard holding one of its clips is uploaded: its
+    clips are marked 'uploaded' and it is reported to the listeners then, not when its job
+    ends. Clips in a shard that was never uploaded are redone by the next run. Uploaded
+    shards are appended to log_path, which also keeps shard names unique across runs; one
+    process per shard folder.
+    """
+
+    def __init__(self, shard_dir, remote, upload_fn, progress_tracker=None, target_bytes=DEFAULT_SHARD_SIZE_MB * 1024 ** 2,
+                 max_age=DEFAULT_SHARD_MAX_AGE, log_path=DEFAULT_SHARD_LOG, prefix=None):
+        """
+        Args:
+            shard_dir: local folder the open shard is written to
+            remote: rclone remote folder the sealed shards are moved to
+            upload_fn: callable taking [(file path, remote)] and returning {file path: True if moved}
+            progress_tracker: ThreadSafeProgress or ProgressJournal notified of uploaded clips and
+                complete ytb_ids, or None
+            target_bytes: a shard is sealed before a clip would take it past this size
+            max_age: seconds after which an open shard is sealed
+            log_path: JSONL record of uploaded shards and their clips
+            prefix: shard name prefix, default celebv-<hostname>
+        """
+        self.shard_dir = shard_dir
+        self.remote = remote
+        self.upload_fn = upload_fn
+        self.progress_tracker = progress_tracker
+        self.target_bytes = target_bytes
+        self.max_age = max_age
+        self.log_path = log_path
+        self.prefix = prefix or f"{SHARD_PREFIX}-{socket.gethostname()}"
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.current = None  # Open shard: {'name', 'path', 'tar', 'members', 'opened_at'}
+        self.job_shards = {}  # {ytb_id: names of its shards not uploaded yet}
+        self.job_success = {}  # {ytb_id: False once its job or one of its shards failed}
+        self.shard_jobs = {}  # {shard name: {ytb_id: [save names]}}
+        self.closed = threading.Event()
+        self.upload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ShardUpload")
+
+        os.makedirs(shard_dir, exist_ok=True)
+        self.seq = self._next_seq()
+        self._remove_unsent()
+        self.sealer = threading.Thread(target=self._seal_loop, name="ShardSealer", daemon=True)
+        self.sealer.start()
+
+    def _next_seq(self):
+        seq = 0
+        if self.log_path and os.path.exists(self.log_path):
+            with open(self.log_path) as f:
+                for line in f:
+                    try:
+                        name = json.loads(line)['shard']
+                    except (ValueError, KeyError):
+                        continue
+                    stem, _, number = os.path.splitext(name)[0].rpartition('-')
+                    if stem == self.prefix and number.isdigit():
+                        seq = max(seq, int(number) + 1)
+        return seq
+
+    def _remove_unsent(self):
+        """Drop shards a previous run left behind, their ytb_ids were not completed and are redone"""
+        for name in os.listdir(self.shard_dir):
+            if name.startswith(self.prefix) and name.endswith(('.tar', '.json')):
+                logging.warning(f"Removing shard {name} left over from a previous run")
+                os.remove(os.path.join(self.shard_dir, name))
+
+    def add_listener(self, listener):
+        """Call listener(ytb_id, success) whenever the shards holding the clips of a ytb_id are uploaded"""
+        self.listeners.append(listener)
+
+    def add_job(self, ytb_id, members, success=True, sidecars=None):
+        """
+        Append the processed clips of a ytb_id to the open shard
+
+        Args:
+            ytb_id: YouTube video ID
+            members: [(local file path, member name)], a path may appear under several names
+            success: False if some clips of the job failed, the ytb_id is then never completed
+            sidecars: {clip member name: (local file path, member name)} of small files stored right
+                after their clip in the same shard, e.g. keyframe indexes; not recorded as clips
+        """
+        sidecars = sidecars or {}
+        finished = False
+        with self.lock:
+            self.job_success[ytb_id] = self.job_success.get(ytb_id, True) and success
+            shards = self.job_shards.setdefault(ytb_id, set())
+            for file_path, name in members:
+                size = os.path.getsize(file_path)
+                if self.current is not None and self.current['members'] and \
+                        self.current['bytes'] + size > self.target_bytes:
+                    self._seal()
+                if self.current is None:
+                    self._open()
+                self._append(file_path, name, ytb_id)
+                if name in sidecars:
+                    self._append(*sidecars[name], ytb_id, sidecar_of=name)
+                shards.add(self.current['name'])
+                self.shard_jobs[self.current['name']].setdefault(ytb_id, []).append(name)
+            if not shards:
+                finished = True
+                del self.job_shards[ytb_id]
+                success = self.job_success.pop(ytb_id)
+        if finished:
+            self._notify(ytb_id, success)
+
+    def _open(self):
+        # Called with the lock held
+        name = f"{self.prefix}-{self.seq:06d}.tar"
+        self.seq += 1
+        path = os.path.join(self.shard_dir, name)
+        self.current = {'name': name, 'path': path, 'tar': tarfile.open(path, 'w', format=tarfile.PAX_FORMAT),
+                        'members': [], 'bytes': 0, 'opened_at': time.monotonic()}
+        self.shard_jobs[name] = {}
+
+    def _append(self, file_path, name, ytb_id, sidecar_of=None):
+        # Called with the lock held
+        tar = self.current['tar']
+        info = tar.gettarinfo(file_path, arcname=name)
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        with open(file_path, 'rb') as f:
+            tar.addfile(info, f)
+        # tar.offset is past the member's data, padded to a whole block
+        padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        member = {'name': name, 'ytb_id': ytb_id, 'offset': tar.offset - padded, 'size': info.size}
+        if sidecar_of is not None:
+            member['sidecar_of'] = sidecar_of
+        self.current['members'].append(member)
+        self.current['bytes'] = tar.offset
+
+    def _seal(self):
+        # Called with the lock held
+        shard, self.current = self.current, None
+        shard['tar'].close()
+        with open(index_path(shard['path']), 'w') as f:
+            json.dump({'shard': shard['name'], 'bytes': os.path.getsize(shard['path']),
+                       'members': shard['members']}, f)
+        METRICS.inc('shards_sealed_total')
+        clips = sum('sidecar_of' not in member for member in shard['members'])
+        logging.info(f"Sealed shard {shard['name']}: {clips} clips, "
+                     f"{shard['bytes'] / 1024 ** 2:.1f} MB")
+        self.upload_executor.submit(self._upload, shard)
+
+    def _seal_loop(self):
+        while not self.closed.wait(min(30.0, max(1.0, self.max_age / 4))):
+            with self.lock:
+                if self.current is not None and time.monotonic() - self.current['opened_at'] >= self.max_age:
+                    self._seal()
+
+    def _upload(self, shard):
+        files = [shard['path'], index_path(shard['path'])]
+        try:
+            moved = self.upload_fn([(file_path, self.remote) for file_path in files])
+            uploaded = all(moved.get(file_path) for file_path in files)
+        except Exception as e:
+            logging.error(f"Upload of shard {shard['name']} failed: {e}")
+            uploaded = False
+
+        if uploaded:
+            METRICS.inc('shards_uploaded_total')
+            if self.log_path:
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps({'shard': shard['name'], 'bytes': shard['bytes'], 'uploaded_at': time.time(),
+                                        'clips': {member['name']: member['ytb_id'] for member in shard['members']
+                                                  if 'sidecar_of' not in member}})
+                            + "\n")
+        else:
+            logging.error(f"Shard {shard['name']} was not uploaded, its ytb_ids will be redone")
+
+        finished = []
+        with self.lock:
+            jobs = self.shard_jobs.pop(shard['name'])
+            for ytb_id in jobs:
+                if not uploaded:
+                    self.job_success[ytb_id] = False
+                shards = self.job_shards[ytb_id]
+                shards.discard(shard['name'])
+                if not shards:
+                    del self.job_shards[ytb_id]
+                    finished.append((ytb_id, self.job_success.pop(ytb_id)))
+
+        if uploaded and self.progress_tracker is not None:
+            for ytb_id, names in jobs.items():
+                self.progress_tracker.mark_clips(ytb_id, names, 'uploaded')
+        for ytb_id, success in finished:
+            self._notify(ytb_id, success)
+
+    def _notify(self, ytb_id, success):
+        if success and self.progress_tracker is not None:
+            self.progress_tracker.mark_completed(ytb_id)
+        for listener in self.listeners:
+            try:
+                listener(ytb_id, success)
+            except Exception as e:
+                logging.error(f"Shard listener failed for {ytb_id}: {e}")
+
+    def pending_jobs(self):
+        """Number of ytb_ids waiting for a shard upload"""
+        with self.lock:
+            return len(self.job_shards)
+
+    def close(self):
+        """Seal the open shard and wait for every upload"""
+        self.closed.set()
+        self.sealer.join()
+        with self.lock:
+            if self.current is not None:
+                self._seal()
+        self.upload_executor.shutdown(wait=True)
+
+
+_shard_writer = None
+
+
+def configure_shard_writer(shard_dir, *args, **kwargs):
+    """Set the process-wide ShardWriter, see its arguments; None as shard_dir disables it"""
+    global _shard_writer
+    _shard_writer = ShardWriter(shard_dir, *args, **kwargs) if shard_dir else None
+    return _shard_writer
+
+
+def get_shard_writer():
+    """The process-wide ShardWriter, or None when clips are uploaded as separate files"""
+    return _shard_writer
@@ -0,0 +1,120 @@
+"""
+Deterministic sharding of ytb_ids across nodes, balanced by total clip seconds
+"""
+
+import hashlib
+import logging
+
+from metadata_index import MetadataIndex
+
+DEFAULT_SHARD_SLACK = 0.05  # A shard may take this much more than its even share of clip seconds
+
+
+def group_stats(grouped_data):
+    """
+    Clip count and total clip seconds of every ytb_id
+
+    Returns:
+        dict: {ytb_id: (clip count, clip seconds)}
+    """
+    if isinstance(grouped_data, MetadataIndex):
+        # Read straight from the index columns without decoding the groups
+        return {grouped_data.ytb_id(group): (len(grouped_data.clip_range(group)), grouped_data.group_clip_seconds(group))
+                for group in range(len(grouped_data))}
+
+    return {ytb_id: (len(video_data_list), sum(end_sec - start_sec for start_sec, end_sec in
+                                               (video_data['time'] for video_data in video_data_list)))
+            for ytb_id, video_data_list in grouped_data.items()}
+
+
+def shard_preference(ytb_id, shard_count):
+    """Shards in the order a ytb_id prefers them (rendezvous hashing), stable across runs and nodes"""
+    def score(shard):
+        return hashlib.sha1(f"{shard}:{ytb_id}".encode()).digest()
+    return sorted(range(shard_count), key=score, reverse=True)
+
+
+def plan_shards(stats, shard_count, slack=DEFAULT_SHARD_SLACK):
+    """
+    Assign every ytb_id to a shard.
+
+    ytb_ids are placed heaviest first, each on the first shard in its hash preference order
+    whose load stays within (1 + slack) of an even share of the clip seconds, or on the least
+    loaded shard if none does. Every node computes the same plan from the same metadata.
+
+    Args:
+        stats: {ytb_id: (clip count, clip seconds)} from group_stats
+        shard_count: number of shards
+
+    Returns:
+        dict: {ytb_id: shard index}
+    """
+    total = sum(secs for _, secs in stats.values())
+    capacity = (1 + slack) * total / shard_count
+    loads = [0.0] * shard_count
+    assignment = {}
+
+    for ytb_id in sorted(stats, key=lambda ytb_id: (-stats[ytb_id][1], ytb_id)):
+        secs = stats[ytb_id][1]
+        for shard in shard_preference(ytb_id, shard_count):
+            if loads[shard] + secs <= capacity:
+                break
+        else:
+            shard = min(range(shard_count), key=lambda s: loads[s])
+        assignment[ytb_id] = shard
+        loads[shard] += secs
+
+    return assignment
+
+
+def filter_shard(grouped_data, shard_index, shard_count):
+    """
+    Keep only the ytb_ids of one shard, in their original order
+
+    Returns:
+        dict: {ytb_id: [list of video processing data]}
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard index {shard_index} out of range for {shard_count} shards")
+
+    assignment = plan_shards(group_stats(grouped_data), shard_count)
+    if isinstance(grouped_data, MetadataIndex):
+        return {grouped_data.ytb_id(group): grouped_data.group(group) for group in range(len(grouped_data))
+                if assignment[grouped_data.ytb_id(group)] == shard_index}
+    return {ytb_id: video_data_list for ytb_id, video_data_list in grouped_data.items()
+            if assignment[ytb_id] == shard_index}
+
+
+def shard_plan_report(grouped_data, shard_count):
+    """
+    Expected load of every shard
+
+    Returns:
+        list: one dict per shard with ytb_id count, clip count, clip seconds and share of the total
+    """
+    stats = group_stats(grouped_data)
+    assignment = plan_shards(stats, shard_count)
+    total_secs = sum(secs for _, secs in stats.values()) or 1.0
+
+    report = [{'shard': shard, 'ytb_ids': 0, 'clips': 0, 'clip_seconds': 0.0, 'preferred': 0}
+              for shard in range(shard_count)]
+    for ytb_id, shard in assignment.items():
+        clips, secs = stats[ytb_id]
+        report[shard]['ytb_ids'] += 1
+        report[shard]['clips'] += clips
+        report[shard]['clip_seconds'] += secs
+        report[shard]['preferred'] += shard_preference(ytb_id, shard_count)[0] == shard
+
+    for entry in report:
+        entry['clip_seconds'] = round(entry['clip_seconds'], 2)
+        entry['share'] = round(entry['clip_seconds'] / total_secs, 4)
+    return report
+
+
+def log_shard_plan(report):
+    """Log a shard plan report as a table"""
+    logging.info(f"{'shard':>5} {'ytb_ids':>8} {'clips':>8} {'clip hours':>10} {'share':>7} {'on hash shard':>13}")
+    for entry in report:
+        preferred = entry['preferred'] / entry['ytb_ids'] if entry['ytb_ids'] else 0.0
+        logging.info(f"{entry['shard']:>5} {entry['ytb_ids']:>8} {entry['clips']:>8} "
+                     f"{entry['clip_seconds'] / 3600:>10.2f} {entry['share']:>7.2%} {preferred:>13.1%}")
@@ -0,0 +1,201 @@
+"""
+Direct-to-tensor output: cropped face frames decoded once by ffmpeg and stored as raw RGB
+uint8 in chunk files that training jobs memory-map, with a per-clip offset index
+"""
+
+import os
+import json
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+
+from metrics import METRICS
+
+DEFAULT_FRAME_SIZE = 224  # Side of the square frames, in pixels
+DEFAULT_FRAME_STRIDE = 1  # Keep every Nth frame
+DEFAULT_CHUNK_MB = 1024
+INDEX_NAME = 'index.jsonl'
+CHANNELS = 3  # rgb24
+
+
+class FrameSink:
+    """
+    Store the frames of each clip contiguously in a chunk file: frames x size x size x 3 bytes,
+    no header, so a chunk memory-maps as a flat uint8 array.
+
+    Concurrent clips write to different chunks, a chunk is closed once it grows past
+    chunk_bytes. Every stored clip appends one line to index.jsonl: {'clip', 'ytb_id',
+    'chunk', 'offset', 'frames', 'height', 'width', 'channels', 'stride'}. The line is only
+    written once the frames are on disk, so the index never points past the data; frames of
+    a clip that failed midway are truncated away. The last line of a clip wins.
+    """
+
+    def __init__(self, root, size=DEFAULT_FRAME_SIZE, stride=DEFAULT_FRAME_STRIDE, chunk_bytes=DEFAULT_CHUNK_MB * 1024 ** 2,
+                 prefix=None):
+        self.root = root
+        self.size = size
+        self.stride = max(1, stride)
+        self.chunk_bytes = chunk_bytes
+        self.prefix = prefix or f"frames-{socket.gethostname()}"
+        self.frame_bytes = size * size * CHANNELS
+        self.lock = threading.Lock()
+        self.free_chunks = []  # Open chunks no clip is writing to
+        os.makedirs(root, exist_ok=True)
+        self.seq = self._next_seq()
+        self.index_file = open(os.path.join(root, INDEX_NAME), 'a')
+
+    def _next_seq(self):
+        seq = 0
+        for name in os.listdir(self.root):
+            stem, ext = os.path.splitext(name)
+            head, _, number = stem.rpartition('-')
+            if ext == '.u8' and head == self.prefix and number.isdigit():
+                seq = max(seq, int(number) + 1)
+        return seq
+
+    def video_filter(self, crop):
+        """ffmpeg filter chain: frame sampling, the clip's crop, then the resize to size x size"""
+        filters = [f"select=not(mod(n\\,{self.stride}))"] if self.stride > 1 else []
+        filters += [crop, f"scale={self.size}:{self.size}:flags=area"]
+        return ','.join(filters)
+
+    def output_args(self):
+        """ffmpeg output options writing raw RGB frames to stdout"""
+        return ['-an', '-vsync', 'passthrough', '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1']
+
+    def _take_chunk(self):
+        with self.lock:
+            if self.free_chunks:
+                return self.free_chunks.pop()
+            name = f"{self.prefix}-{self.seq:06d}.u8"
+            self.seq += 1
+        return {'name': name, 'file': open(os.path.join(self.root, name), 'wb')}
+
+    def _return_chunk(self, chunk):
+        if chunk['file'].tell() >= self.chunk_bytes:
+            chunk['file'].close()
+            logging.info(f"Closed frame chunk {chunk['name']}")
+            return
+        with self.lock:
+            self.free_chunks.append(chunk)
+
+    def write_clip(self, cmd, clip_name, ytb_id, alias_names=()):
+        """
+        Run an ffmpeg command that writes rawvideo to stdout and store its frames
+
+        Args:
+            cmd: ffmpeg argument list, ending with output_args()
+            clip_name: name the clip is indexed under
+            ytb_id: YouTube video ID of the clip
+            alias_names: other clip names indexed to the same frames, e.g. duplicates
+
+        Returns:
+            int: number of frames stored, 0 if ffmpeg failed
+        """
+        chunk = self._take_chunk()
+        f = chunk['file']
+        offset = f.tell()
+        frames = 0
+        stored = False
+        try:
+            with tempfile.TemporaryFile() as stderr:
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+                try:
+                    while True:
+                        frame = proc.stdout.read(self.frame_bytes)
+                        if len(frame) < self.frame_bytes:
+                            break
+                        f.write(frame)
+                        frames += 1
+                finally:
+                    proc.stdout.close()
+                    returncode = proc.wait()
+                if returncode != 0 or frames == 0:
+                    stderr.seek(0)
+                    logging.error(f"ffmpeg produced {frames} frames for {clip_name} (exit code {returncode}): "
+                                  f"{stderr.read().decode(errors='replace').strip()}")
+                    return 0
+
+            f.flush()
+            os.fsync(f.fileno())
+            entry = {'ytb_id': ytb_id, 'chunk': chunk['name'], 'offset': offset, 'frames': frames,
+                     'height': self.size, 'width': self.size, 'channels': CHANNELS, 'stride': self.stride}
+            with self.lock:
+                for name in (clip_name, *alias_names):
+                    self.index_file.write(json.dumps({'clip': name, **entry}) + "\n")
+                self.index_file.flush()
+            stored = True
+            METRICS.inc('frames_written_total', frames)
+            METRICS.inc('frame_bytes_total', frames * self.frame_bytes)
+            return frames
+        finally:
+            if not stored:
+                f.seek(offset)
+                f.truncate()
+            self._return_chunk(chunk)
+
+    def close(self):
+        with self.lock:
+            for chunk in self.free_chunks:
+                chunk['file'].close()
+            self.free_chunks = []
+            self.index_file.close()
+
+
+class FrameStore:
+    """
+    Read side of a FrameSink folder: clip name -> uint8 array of shape (frames, height, width, 3)
+
+    Arrays are views of memory-mapped chunks, so reading a clip costs no decode and no copy
+    until its pages are touched. Needs numpy.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.entries = {}
+        self.chunks = {}
+        with open(os.path.join(root, INDEX_NAME)) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entry = json.loads(line)
+                    self.entries[entry['clip']] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, clip_name):
+        return clip_name in self.entries
+
+    def names(self):
+        return list(self.entries)
+
+    def _chunk(self, name):
+        import numpy as np  # Only the readers need numpy
+        if name not in self.chunks:
+            self.chunks[name] = np.memmap(os.path.join(self.root, name), dtype=np.uint8, mode='r')
+        return self.chunks[name]
+
+    def clip(self, clip_name):
+        """Frames of a clip as a read-only (frames, height, width, channels) uint8 array"""
+        entry = self.entries[clip_name]
+        shape = (entry['frames'], entry['height'], entry['width'], entry['channels'])
+        length = shape[0] * shape[1] * shape[2] * shape[3]
+        return self._chunk(entry['chunk'])[entry['offset']:entry['offset'] + length].reshape(shape)
+
+
+_frame_sink = None
+
+
+def configure_frame_sink(root, *args, **kwargs):
+    """Set the process-wide FrameSink, see its arguments; None as root disables it"""
+    global _frame_sink
+    _frame_sink = FrameSink(root, *args, **kwargs) if root else None
+    return _frame_sink
+
+
+def get_frame_sink():
+    """The process-wide FrameSink, or None when clips are encoded to files"""
+    return _frame_sink
@@ -0,0 +1,91 @@
+"""
+Tests of upload.BatchUploader in both modes against the fake rclone of the benchmark, which
+maps every 'remote:path' to a local folder
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import socket
+import shutil
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKES_DIR = os.path.join(REPO_DIR, 'benchmark', 'fakes')
+sys.path.insert(0, REPO_DIR)
+
+from upload import BatchUploader  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class BatchUploaderTest(unittest.TestCase):
+    mode = 'files-from'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        self.remote_root = os.path.join(self.tmp_dir, 'remotes')
+        os.makedirs(self.src_dir)
+        os.makedirs(os.path.join(self.remote_root, 'gdrive', 'clips'))
+        self.saved_env = {key: os.environ.get(key) for key in ('PATH', 'CELEBV_FAKE_REMOTE_ROOT')}
+        os.environ['PATH'] = FAKES_DIR + os.pathsep + os.environ['PATH']
+        os.environ['CELEBV_FAKE_REMOTE_ROOT'] = self.remote_root
+        self.uploader = BatchUploader(mode=self.mode, batch_size=3, flush_interval=0.2,
+                                      rcd_addr=f"127.0.0.1:{free_port()}").start()
+
+    def tearDown(self):
+        self.uploader.close()
+        for key, value in self.saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(self.tmp_dir)
+
+    def make_file(self, name, size=1024):
+        path = os.path.join(self.src_dir, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def remote_path(self, name):
+        return os.path.join(self.remote_root, 'gdrive', 'clips', name)
+
+    def test_moves_files(self):
+        paths = [self.make_file(f"clip_{i}.mp4", 1024 * (i + 1)) for i in range(5)]
+        futures = [self.uploader.submit(path, 'gdrive:clips') for path in paths]
+        self.assertEqual([future.result(timeout=30) for future in futures], [True] * 5)
+        for i, path in enumerate(paths):
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(os.path.getsize(self.remote_path(os.path.basename(path))), 1024 * (i + 1))
+
+    def test_missing_file_is_not_uploaded(self):
+        present = self.make_file('present.mp4')
+        missing = os.path.join(self.src_dir, 'missing.mp4')
+        futures = [self.uploader.submit(present, 'gdrive:clips'), self.uploader.submit(missing, 'gdrive:clips')]
+        self.assertEqual([future.result(timeout=30) for future in futures], [True, False])
+        self.assertFalse(os.path.exists(self.remote_path('missing.mp4')))
+
+    def test_unreachable_remote_fails(self):
+        path = self.make_file('clip.mp4')
+        # A regular file where the remote folder should be makes every move fail
+        with open(os.path.join(self.remote_root, 'broken'), 'w'):
+            pass
+        future = self.uploader.submit(path, 'broken:clips')
+        self.assertFalse(future.result(timeout=30))
+        self.assertTrue(os.path.exists(path))
+
+
+class RcdBatchUploaderTest(BatchUploaderTest):
+    mode = 'rcd'
+
+
+if __name__ == '__main__':
+    unittest.main()
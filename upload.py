@@ -0,0 +1,217 @@
+"""
+Batched uploads with rclone: many files per rclone run, or one long-lived rclone rcd daemon
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from metrics import METRICS
+
+DEFAULT_BATCH_SIZE = 50  # Files per rclone run
+DEFAULT_FLUSH_INTERVAL = 5.0  # Seconds a file may wait for its batch to fill up
+DEFAULT_RCD_ADDR = '127.0.0.1:5572'
+
+
+class BatchUploader:
+    """
+    Gather files to move to rclone remotes and send them in batches.
+
+    Modes:
+        'files-from': one `rclone move --files-from` run per batch and (source folder, remote) pair
+        'rcd': a local `rclone rcd` daemon started once and driven over its HTTP API, so auth and
+               remote connections are set up once for the whole run
+
+    Each submitted file gets a Future resolving to True once the file is on the remote
+    and removed locally, or False if its move failed.
+    """
+
+    def __init__(self, mode='files-from', batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 workers=2, rcd_addr=DEFAULT_RCD_ADDR):
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rcd_addr = rcd_addr
+        self.pending = []  # [(file_path, remote, future, submit time)]
+        self.cond = threading.Condition()
+        self.closed = False
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Uploader")
+        self.rcd_process = None
+        self.flusher = None
+
+    def start(self):
+        """Start the daemon (in rcd mode) and the background flusher"""
+        if self.mode == 'rcd':
+            self._start_rcd()
+        self.flusher = threading.Thread(target=self._flush_loop, name="UploadFlusher", daemon=True)
+        self.flusher.start()
+        return self
+
+    def submit(self, file_path, remote):
+        """
+        Queue a file to be moved into a remote folder
+
+        Returns:
+            Future: resolves to True if the file was moved
+        """
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("Uploader is closed")
+            self.pending.append((file_path, remote, future, time.monotonic()))
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify()
+        return future
+
+    def flush(self):
+        """Send everything queued so far without waiting for the batch to fill up"""
+        with self.cond:
+            pending, self.pending = self.pending, []
+        for i in range(0, len(pending), self.batch_size):
+            self.executor.submit(self._send, pending[i:i + self.batch_size])
+
+    def close(self):
+        """Send the remaining files, wait for all uploads and stop the daemon"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+        self.executor.shutdown(wait=True)
+        if self.rcd_process is not None:
+            self.rcd_process.terminate()
+            self.rcd_process.wait()
+
+    def _flush_loop(self):
+        while True:
+            with self.cond:
+                while not self.closed and not self._batch_ready():
+                    self.cond.wait(timeout=self.flush_interval / 2)
+                if self.closed:
+                    return
+                batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            self.executor.submit(self._send, batch)
+
+    def _batch_ready(self):
+        if len(self.pending) >= self.batch_size:
+            return True
+        return bool(self.pending) and time.monotonic() - self.pending[0][3] >= self.flush_interval
+
+    def _send(self, batch):
+        sizes = [os.path.getsize(file_path) if os.path.exists(file_path) else 0 for file_path, _, _, _ in batch]
+        try:
+            with METRICS.timer('upload_batch', mode=self.mode):
+                if self.mode == 'rcd':
+                    results = self._send_rcd(batch)
+                else:
+                    results = self._send_files_from(batch)
+        except Exception as e:
+            logging.error(f"Upload batch of {len(batch)} files failed: {e}")
+            results = [False] * len(batch)
+
+        for (file_path, remote, future, _), success, size in zip(batch, results, sizes):
+            METRICS.inc('upload_files_total', outcome='ok' if success else 'failed')
+            if success:
+                METRICS.inc('upload_bytes_total', size)
+                logging.info(f"Successfully moved {os.path.basename(file_path)} to {remote}")
+            else:
+                logging.error(f"Failed to move {os.path.basename(file_path)} to {remote}")
+            future.set_result(success)
+
+    def _send_files_from(self, batch):
+        groups = defaultdict(list)
+        for file_path, remote, _, _ in batch:
+            if os.path.exists(file_path):
+                groups[(os.path.dirname(os.path.abspath(file_path)), remote)].append(os.path.basename(file_path))
+            else:
+                logging.error(f"{file_path} does not exist, nothing to upload")
+
+        moved = set()
+        for (src_dir, remote), names in groups.items():
+            sizes = {name: os.path.getsize(os.path.join(src_dir, name)) for name in names}
+            with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+                f.write("\n".join(names) + "\n")
+                list_path = f.name
+            try:
+                # --no-traverse avoids listing the whole destination folder for a handful of files
+                result = subprocess.run([
+                    'rclone', 'move', '--files-from', list_path, '--no-traverse', src_dir, remote
+                ], capture_output=True, text=True)
+                if result.returncode != 0:
+                    logging.error(f"rclone move of {len(names)} files to {remote} failed: {result.stderr}")
+                on_remote = self._remote_sizes(remote, list_path)
+            finally:
+                os.remove(list_path)
+
+            # A file counts as moved once it is on the remote with its full size and gone locally
+            for name, size in sizes.items():
+                if on_remote.get(name) == size and not os.path.exists(os.path.join(src_dir, name)):
+                    moved.add((src_dir, remote, name))
+
+        return [(os.path.dirname(os.path.abspath(file_path)), remote, os.path.basename(file_path)) in moved
+                for file_path, remote, _, _ in batch]
+
+    @staticmethod
+    def _remote_sizes(remote, list_path):
+        """{file name: size} of the files of list_path found in a remote folder"""
+        result = subprocess.run([
+            'rclone', 'lsf', '--files-only', '--format', 'ps', '--separator', ';', '--files-from', list_path, remote
+        ], capture_output=True, text=True)
+        if result.returncode != 0:
+            logging.error(f"Could not list {remote} to confirm the upload: {result.stderr}")
+            return {}
+        sizes = {}
+        for line in result.stdout.splitlines():
+            name, _, size = line.rpartition(';')
+            if name:
+                sizes[name] = int(size)
+        return sizes
+
+    def _start_rcd(self):
+        self.rcd_process = subprocess.Popen([
+            'rclone', 'rcd', '--rc-no-auth', f'--rc-addr={self.rcd_addr}'
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        for _ in range(50):
+            try:
+                self._rc('rc/noop', {})
+                logging.info(f"rclone rcd listening on {self.rcd_addr}")
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.rcd_process.terminate()
+        raise RuntimeError(f"rclone rcd did not start on {self.rcd_addr}")
+
+    def _rc(self, command, params):
+        request = urllib.request.Request(
+            f"http://{self.rcd_addr}/{command}",
+            data=json.dumps(params).encode(),
+            headers={'Content-Type': 'application/json'},
+        )
+        with urllib.request.urlopen(request, timeout=3600) as response:
+            return json.load(response)
+
+    def _send_rcd(self, batch):
+        results = []
+        for file_path, remote, _, _ in batch:
+            name = os.path.basename(file_path)
+            try:
+                self._rc('operations/movefile', {
+                    'srcFs': os.path.dirname(os.path.abspath(file_path)),
+                    'srcRemote': name,
+                    'dstFs': remote,
+                    'dstRemote': name,
+                })
+                results.append(True)
+            except OSError as e:
+                logging.error(f"rclone rcd move of {name} to {remote} failed: {e}")
+                results.append(False)
+        return results
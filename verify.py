@@ -0,0 +1,357 @@
+"""
+Integrity checks of finished files (raw videos, processed clips, merged clips): MP4 box
+structure, ffprobe container and duration, and a sha256 checksum, cached by size and mtime
+"""
+
+import os
+import json
+import time
+import struct
+import hashlib
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_VERIFY_CACHE = 'verify_cache.json'
+DEFAULT_CHECKSUM_LOG = 'checksums.jsonl'
+DEFAULT_DURATION_TOLERANCE = 0.5  # Seconds a file may differ from its expected duration
+HASH_CHUNK = 1024 * 1024
+
+
+def check_boxes(path):
+    """
+    Walk the top-level boxes of an MP4 file
+
+    A file cut short while it was written has a last box that claims more bytes than the
+    file holds, or no moov box at all when the muxer writes it last.
+
+    Returns:
+        str: None if the structure is complete, else the reason it is not
+    """
+    file_size = os.path.getsize(path)
+    boxes = set()
+    offset = 0
+    with open(path, 'rb') as f:
+        while offset < file_size:
+            f.seek(offset)
+            header = f.read(8)
+            if len(header) < 8:
+                return f"truncated box header at byte {offset}"
+            size, box = struct.unpack('>I4s', header)
+            if size == 1:
+                large = f.read(8)
+                if len(large) < 8:
+                    return f"truncated box header at byte {offset}"
+                size = struct.unpack('>Q', large)[0]
+            elif size == 0:
+                size = file_size - offset  # Box runs to the end of the file
+            if size < 8 or not all(32 <= c < 127 for c in box):
+                return f"unexpected box {box!r} at byte {offset}"
+            if offset + size > file_size:
+                return f"{box.decode(errors='replace')} box ends past the end of the file"
+            boxes.add(box)
+            offset += size
+    if b'moov' not in boxes:
+        return "no moov box"
+    if b'mdat' not in boxes and b'moof' not in boxes:
+        return "no media data"
+    return None
+
+
+def probe_container(path):
+    """
+    Container format, duration and stream types of a file with ffprobe
+
+    Returns:
+        dict: format, duration (None if unknown), has_video, has_audio
+    """
+    result = subprocess.run([
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'format=format_name,duration:stream=codec_type',
+        '-of', 'json',
+        path
+    ], check=True, capture_output=True, text=True)
+    probe = json.loads(result.stdout)
+    codec_types = {stream.get('codec_type') for stream in probe.get('streams', [])}
+    duration = probe.get('format', {}).get('duration')
+    return {
+        'format': probe.get('format', {}).get('format_name'),
+        'duration': float(duration) if duration not in (None, 'N/A') else None,
+        'has_video': 'video' in codec_types,
+        'has_audio': 'audio' in codec_types,
+    }
+
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def inspect_file(path, checksum=True):
+    """
+    Facts about a file that do not depend on what it is expected to be
+
+    Args:
+        checksum: hash the file, skipped for files that are not recorded
+
+    Returns:
+        dict: size, error (None if the structure and container are sound), format, duration,
+        has_video, has_audio and sha256 (None if not hashed)
+    """
+    facts = {'size': os.path.getsize(path), 'error': None, 'format': None, 'duration': None,
+             'has_video': None, 'has_audio': None, 'sha256': None}
+    if facts['size'] == 0:
+        facts['error'] = "empty file"
+        return facts
+    facts['error'] = check_boxes(path)
+    if facts['error'] is not None:
+        return facts
+    try:
+        facts.update(probe_container(path))
+    except subprocess.CalledProcessError as e:
+        facts['error'] = f"ffprobe failed: {(e.stderr or '').strip()}"
+        return facts
+    except FileNotFoundError:
+        pass  # Without ffprobe only the box structure is checked
+    if checksum:
+        facts['sha256'] = sha256sum(path)
+    return facts
+
+
+class Verifier:
+    """
+    Decide whether finished files can be trusted, so reruns skip good outputs and redo only
+    corrupt or partial ones.
+
+    The facts of each file (box structure, ffprobe result, and the sha256 of recorded files
+    only) are computed once and cached in memory and in cache_path, keyed by path, size and
+    mtime like the probe cache; a rewritten file is inspected again. Expectations such as the clip duration are checked
+    against the cached facts on every call. Files are inspected on a thread pool, the work
+    runs in ffprobe and in hashlib, which release the GIL.
+
+    The cache is saved at most every SAVE_INTERVAL seconds and on flush, dropping files that
+    are gone (uploaded or cleaned up). Checksums of the outputs a script hands on are kept in
+    checksum_log, one JSON line per file, so they outlive the local files.
+    """
+
+    SAVE_INTERVAL = 30.0
+
+    def __init__(self, cache_path=DEFAULT_VERIFY_CACHE, workers=None, tolerance=DEFAULT_DURATION_TOLERANCE,
+                 checksum_log=DEFAULT_CHECKSUM_LOG):
+        self.cache_path = cache_path
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.tolerance = tolerance
+        self.checksum_log = checksum_log
+        self.lock = threading.Lock()
+        self.warned_no_ffprobe = False
+        self.dirty = False
+        self.last_save = time.monotonic()
+        self.stats = {'inspected': 0, 'cached': 0, 'passed': 0, 'failed': 0}
+        self.entries = self.load()
+
+    @staticmethod
+    def cache_key(path, stat):
+        return f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    @staticmethod
+    def key_path(key):
+        return key.rsplit('|', 2)[0]
+
+    def load(self):
+        """Load persisted entries, dropping those whose file is gone or changed"""
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable verify cache {self.cache_path}: {e}")
+            return {}
+
+        valid = {}
+        for key, facts in entries.items():
+            path = self.key_path(key)
+            try:
+                if self.cache_key(path, os.stat(path)) == key:
+                    valid[key] = facts
+            except OSError:
+                continue
+        return valid
+
+    def save(self):
+        """Persist the entries of files that still exist, call with the lock held"""
+        self.entries = {key: facts for key, facts in self.entries.items() if os.path.exists(self.key_path(key))}
+        self.dirty = False
+        self.last_save = time.monotonic()
+        if not self.cache_path:
+            return
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def flush(self):
+        """Save the cache now if it changed"""
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+    def facts(self, path, checksum=False):
+        """
+        Cached facts of a file, inspecting it if it is new or changed
+
+        Args:
+            checksum: make sure the facts hold the sha256, hashing the file if they do not
+
+        Returns:
+            dict: see inspect_file, None if the file does not exist
+        """
+        try:
+            key = self.cache_key(path, os.stat(path))
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            facts = self.entries.get(key)
+        if facts is not None:
+            if checksum and facts['error'] is None and facts.get('sha256') is None:
+                facts = dict(facts, sha256=sha256sum(path))
+                with self.lock:
+                    self.entries[key] = facts
+                    self.dirty = True
+            with self.lock:
+                self.stats['cached'] += 1
+            return facts
+
+        facts = dict(inspect_file(path, checksum), verified_at=time.time())
+        if facts['error'] is None and facts['format'] is None and not self.warned_no_ffprobe:
+            self.warned_no_ffprobe = True
+            logging.warning("ffprobe unavailable, only the MP4 structure of files is verified")
+        with self.lock:
+            self.stats['inspected'] += 1
+            self.entries[key] = facts
+            self.dirty = True
+            if time.monotonic() - self.last_save >= self.SAVE_INTERVAL:
+                self.save()
+        return facts
+
+    def duration(self, path):
+        """
+        Duration of a file in seconds, None if unknown
+
+        Taken from the cached facts when the file was inspected, otherwise from a single
+        ffprobe run that is not cached: meant for inputs that are deleted once used.
+        """
+        try:
+            key = self.cache_key(path, os.stat(path))
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            facts = self.entries.get(key)
+        if facts is not None:
+            return facts['duration']
+        try:
+            return probe_container(path)['duration']
+        except (subprocess.CalledProcessError, FileNotFoundError, ValueError):
+            return None
+
+    def check(self, path, expected_duration=None, min_duration=None, needs_audio=False):
+        """
+        Check a file against what it should be
+
+        Args:
+            path: file to check
+            expected_duration: seconds the file should last, within the tolerance
+            min_duration: seconds the file should last at least, e.g. the end of its last clip
+            needs_audio: the file must have an audio stream
+
+        Returns:
+            str: None if the file is good, else the reason it is not
+        """
+        facts = self.facts(path)
+        if facts is None:
+            reason = "missing"
+        elif facts['error'] is not None:
+            reason = facts['error']
+        elif facts['has_video'] is False:
+            reason = "no video stream"
+        elif needs_audio and facts['has_audio'] is False:
+            reason = "no audio stream"
+        elif facts['duration'] is not None and expected_duration is not None \
+                and abs(facts['duration'] - expected_duration) > self.tolerance:
+            reason = f"lasts {facts['duration']:.2f}s, expected {expected_duration:.2f}s"
+        elif facts['duration'] is not None and min_duration is not None \
+                and facts['duration'] < min_duration - self.tolerance:
+            reason = f"lasts {facts['duration']:.2f}s, needs at least {min_duration:.2f}s"
+        else:
+            reason = None
+
+        with self.lock:
+            self.stats['passed' if reason is None else 'failed'] += 1
+        return reason
+
+    def verify(self, path, record=False, **expectations):
+        """
+        True if path exists and passes check, logging why it does not
+
+        Args:
+            record: append the checksum of a passing file to the checksum log
+        """
+        reason = self.check(path, **expectations)
+        if reason is not None and reason != "missing":
+            logging.warning(f"{path} failed verification: {reason}")
+        if reason is None and record:
+            self.record(path)
+        return reason is None
+
+    def verify_many(self, items, record=False):
+        """
+        Verify files in parallel
+
+        Args:
+            items: [(path, {expectations, see check})]
+            record: append the checksums of passing files to the checksum log
+
+        Returns:
+            dict: {path: True if it passed}
+        """
+        if not items:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(items)), thread_name_prefix="Verify") as executor:
+            return dict(executor.map(lambda item: (item[0], self.verify(item[0], record, **item[1])), items))
+
+    def record(self, path):
+        """Append the name, size, duration and sha256 of a file to the checksum log"""
+        if not self.checksum_log:
+            return
+        facts = self.facts(path, checksum=True)
+        if facts is None or facts['sha256'] is None:
+            return
+        line = json.dumps({'file': os.path.basename(path), 'size': facts['size'], 'duration': facts['duration'],
+                           'sha256': facts['sha256'], 'recorded_at': time.time()})
+        with self.lock, open(self.checksum_log, 'a') as f:
+            f.write(line + "\n")
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+        return (f"{stats['passed']} passed, {stats['failed']} failed, {stats['inspected']} files inspected, "
+                f"{stats['cached']} from the cache")
+
+
+_verifier = None
+
+
+def configure_verifier(cache_path, *args, **kwargs):
+    """Set the process-wide Verifier, see its arguments; None as cache_path disables verification"""
+    global _verifier
+    _verifier = Verifier(cache_path, *args, **kwargs) if cache_path else None
+    return _verifier
+
+
+def get_verifier():
+    """The process-wide Verifier, or None when existing files are trusted as they are"""
+    return _verifier
@@ -0,0 +1,215 @@
+"""
+ffprobe helpers for raw videos: stream info cached on disk and in memory, and a keyframe
+index cached next to the raw file
+"""
+
+import os
+import json
+import bisect
+import time
+import logging
+import threading
+import subprocess
+from fractions import Fraction
+
+KEYFRAME_INDEX_SUFFIX = '.keyframes.json'
+
+
+def keyframe_index_path(video_path):
+    """Path of the keyframe index cached next to a video"""
+    return video_path + KEYFRAME_INDEX_SUFFIX
+
+
+def read_keyframes(video_path):
+    """
+    Read keyframe timestamps of the first video stream with ffprobe.
+
+    Only packet headers are read, nothing is decoded.
+
+    Returns:
+        list: sorted keyframe timestamps in seconds
+    """
+    result = subprocess.run([
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
+        video_path
+    ], check=True, capture_output=True, text=True)
+
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' not in flags or pts_time in ('', 'N/A'):
+            continue
+        keyframes.append(float(pts_time))
+    return sorted(keyframes)
+
+
+def load_keyframes(video_path):
+    """
+    Load keyframe timestamps of a video, reading them once and caching them next to the file.
+
+    The cache is keyed by file size and mtime, so a re-downloaded file is indexed again.
+
+    Returns:
+        list: sorted keyframe timestamps in seconds
+    """
+    stat = os.stat(video_path)
+    index_path = keyframe_index_path(video_path)
+
+    if os.path.exists(index_path):
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+                return index['keyframes']
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable keyframe index {index_path}: {e}")
+
+    keyframes = read_keyframes(video_path)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'keyframes': keyframes}, f)
+    os.replace(tmp_path, index_path)
+    logging.info(f"Indexed {len(keyframes)} keyframes of {os.path.basename(video_path)}")
+    return keyframes
+
+
+def preceding_keyframe(keyframes, secs):
+    """Timestamp of the last keyframe at or before secs, 0.0 if there is none"""
+    i = bisect.bisect_right(keyframes, secs)
+    return keyframes[i - 1] if i > 0 else 0.0
+
+
+def probe_video(video_path):
+    """
+    Read stream info of a video with ffprobe
+
+    Returns:
+        dict: width, height, fps, duration and has_audio
+    """
+    result = subprocess.run([
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'stream=codec_type,width,height,avg_frame_rate:format=duration',
+        '-of', 'json',
+        video_path
+    ], check=True, capture_output=True, text=True)
+    probe = json.loads(result.stdout)
+
+    streams = probe.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    if video is None:
+        raise ValueError(f"No video stream in {video_path}")
+
+    rate = video.get('avg_frame_rate', '0/0')
+    fps = float(Fraction(rate)) if not rate.endswith('/0') else 0.0
+    duration = probe.get('format', {}).get('duration')
+
+    return {
+        'width': int(video['width']),
+        'height': int(video['height']),
+        'fps': fps,
+        'duration': float(duration) if duration not in (None, 'N/A') else None,
+        'has_audio': any(stream.get('codec_type') == 'audio' for stream in streams),
+    }
+
+
+class ProbeCache:
+    """
+    Video probe results kept in memory and optionally persisted to a JSON file.
+
+    Entries are keyed by path, size and mtime, so every clip of a raw video is served from
+    memory after the first probe, and a re-downloaded file is probed again. The file is
+    saved at most every SAVE_INTERVAL seconds and on flush, dropping the entries of files
+    that are gone, e.g. raw videos deleted after their upload.
+    """
+
+    SAVE_INTERVAL = 30.0
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.last_save = time.monotonic()
+        self.entries = self.load()
+
+    @staticmethod
+    def cache_key(video_path, stat):
+        return f"{os.path.abspath(video_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    def load(self):
+        """Load persisted entries, dropping those whose file is gone or changed"""
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+
+        try:
+            with open(self.cache_path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable probe cache {self.cache_path}: {e}")
+            return {}
+
+        valid = {}
+        for key, info in entries.items():
+            path = key.split('|', 1)[0]
+            try:
+                if self.cache_key(path, os.stat(path)) == key:
+                    valid[key] = info
+            except OSError:
+                continue
+        return valid
+
+    def save(self):
+        """Persist the entries of files that still exist, call with the lock held"""
+        self.entries = {key: info for key, info in self.entries.items() if os.path.exists(key.split('|', 1)[0])}
+        self.dirty = False
+        self.last_save = time.monotonic()
+        if not self.cache_path:
+            return
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def get(self, video_path):
+        """
+        Probe info of a video, probing it only on the first request
+
+        Returns:
+            dict: see probe_video
+        """
+        key = self.cache_key(video_path, os.stat(video_path))
+        with self.lock:
+            info = self.entries.get(key)
+        if info is not None:
+            return info
+
+        info = probe_video(video_path)
+        with self.lock:
+            self.entries[key] = info
+            self.dirty = True
+            if time.monotonic() - self.last_save >= self.SAVE_INTERVAL:
+                self.save()
+        return info
+
+    def flush(self):
+        """Save the cache now if it changed"""
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+
+_probe_cache = ProbeCache()
+
+
+def configure_probe_cache(cache_path):
+    """Persist probe results of this process to cache_path"""
+    global _probe_cache
+    _probe_cache = ProbeCache(cache_path)
+    return _probe_cache
+
+
+def get_video_info(video_path):
+    """Probe info of a video from the process-wide probe cache"""
+    return _probe_cache.get(video_path)
@@ -0,0 +1,375 @@
+"""
+Shared work queue of ytb_ids with time-limited leases, so several nodes can pull work
+from one queue instead of splitting it up front
+"""
+
+import os
+import json
+import time
+import fcntl
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+DEFAULT_LEASE_SECONDS = 300  # A claimed ytb_id returns to the queue if its lease is not renewed in time
+DEFAULT_MAX_ATTEMPTS = 3  # Claims of a ytb_id before it is given up as failed
+DEFAULT_POLL_INTERVAL = 10  # Seconds between claims while the remaining work is leased by others
+
+
+class WorkQueue(ABC):
+    """
+    Queue of ytb_ids shared between workers on any number of nodes.
+
+    A worker claims a ytb_id under a lease, renews the lease while processing it, and then
+    completes or fails it. Expired leases return their ytb_id to the queue, or give it up as
+    failed once it was claimed max_attempts times, so a ytb_id that keeps crashing its node
+    is not retried forever. Higher priority ytb_ids are claimed first. A Redis-like service
+    can back the queue by implementing these methods.
+    """
+
+    @abstractmethod
+    def enqueue(self, ytb_ids, priorities=None):
+        """Add ytb_ids that are not in the queue yet, priorities is an optional {ytb_id: priority}"""
+
+    @abstractmethod
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS, skip=()):
+        """Lease the next ytb_id not in skip, or return None if none is claimable right now"""
+
+    @abstractmethod
+    def renew(self, ytb_id, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Extend a lease, returns False if the worker no longer holds it"""
+
+    @abstractmethod
+    def complete(self, ytb_id, worker_id):
+        """Mark a leased ytb_id as done"""
+
+    @abstractmethod
+    def fail(self, ytb_id, worker_id, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Return a leased ytb_id to the queue, or give it up after max_attempts claims"""
+
+    @abstractmethod
+    def release(self, ytb_id, worker_id):
+        """Return a leased ytb_id to the queue without counting its claim, e.g. when the worker can not process it"""
+
+    @abstractmethod
+    def remaining(self, skip=()):
+        """Number of ytb_ids not yet done or given up, leased ones included, those in skip left out"""
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """Work queue in a SQLite file shared by all workers"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        # The default rollback journal is used on purpose: WAL does not work on network filesystems
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                ytb_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL DEFAULT 'pending',
+                priority REAL NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, priority)")
+
+    def _transaction(self, fn):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self.conn)
+                self.conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, ytb_ids, priorities=None):
+        priorities = priorities or {}
+        rows = [(ytb_id, priorities.get(ytb_id, 0)) for ytb_id in ytb_ids]
+        self._transaction(lambda conn: conn.executemany(
+            "INSERT OR IGNORE INTO jobs (ytb_id, priority) VALUES (?, ?)", rows))
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS, skip=()):
+        def claim_next(conn):
+            now = time.time()
+            given_up = conn.execute("""
+                UPDATE jobs SET state = 'failed', lease_until = NULL
+                WHERE state = 'leased' AND lease_until < ? AND attempts >= ?""", (now, max_attempts)).rowcount
+            if given_up:
+                logging.warning(f"Gave up {given_up} ytb_ids whose last lease expired after {max_attempts} claims")
+            row = conn.execute("""
+                SELECT ytb_id FROM jobs
+                WHERE (state = 'pending' OR (state = 'leased' AND lease_until < ?))
+                    AND ytb_id NOT IN (SELECT value FROM json_each(?))
+                ORDER BY priority DESC LIMIT 1""", (now, json.dumps(list(skip)))).fetchone()
+            if row is None:
+                return None
+            conn.execute("""
+                UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1
+                WHERE ytb_id = ?""", (worker_id, now + lease_seconds, row[0]))
+            return row[0]
+        return self._transaction(claim_next)
+
+    def renew(self, ytb_id, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        return self._transaction(lambda conn: conn.execute("""
+            UPDATE jobs SET lease_until = ?
+            WHERE ytb_id = ? AND state = 'leased' AND worker = ?""",
+            (time.time() + lease_seconds, ytb_id, worker_id)).rowcount == 1)
+
+    def complete(self, ytb_id, worker_id):
+        # Completed work is recorded even if the lease expired in the meantime
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET state = 'done', worker = ?, lease_until = NULL WHERE ytb_id = ?", (worker_id, ytb_id)))
+
+    def fail(self, ytb_id, worker_id, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self._transaction(lambda conn: conn.execute("""
+            UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, lease_until = NULL
+            WHERE ytb_id = ? AND state = 'leased' AND worker = ?""", (max_attempts, ytb_id, worker_id)))
+
+    def release(self, ytb_id, worker_id):
+        self._transaction(lambda conn: conn.execute("""
+            UPDATE jobs SET state = 'pending', worker = NULL, lease_until = NULL, attempts = MAX(0, attempts - 1)
+            WHERE ytb_id = ? AND state = 'leased' AND worker = ?""", (ytb_id, worker_id)))
+
+    def remaining(self, skip=()):
+        with self.lock:
+            return self.conn.execute("""
+                SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'leased')
+                    AND ytb_id NOT IN (SELECT value FROM json_each(?))""", (json.dumps(list(skip)),)).fetchone()[0]
+
+
+class DirectoryWorkQueue(WorkQueue):
+    """
+    Work queue in a shared directory, one small file per ytb_id.
+
+    The state of a ytb_id is the folder its file is in (pending, leased, done, failed). Every
+    state change runs under an flock on queue.lock, so a renewal can never race a reclaim.
+    A claim writes the lease into the record before moving it to leased/, so a leased file
+    always carries its expiry. File names carry the claim order, so listing pending/ in
+    sorted order yields the highest priority first.
+    """
+
+    STATES = ('pending', 'leased', 'done', 'failed')
+
+    def __init__(self, root):
+        self.root = root
+        for state in self.STATES:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    def _path(self, state, name):
+        return os.path.join(self.root, state, name)
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.root, 'queue.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def _ytb_id(name):
+        return name.split('.', 1)[1]
+
+    def _read(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+    def _write(self, path, record):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    def _find(self, state, ytb_id):
+        for name in os.listdir(os.path.join(self.root, state)):
+            if not name.endswith('.tmp') and self._ytb_id(name) == ytb_id:
+                return name
+        return None
+
+    def enqueue(self, ytb_ids, priorities=None):
+        priorities = priorities or {}
+        with self._locked():
+            existing = set()
+            for state in self.STATES:
+                existing.update(self._ytb_id(name) for name in os.listdir(os.path.join(self.root, state))
+                                if not name.endswith('.tmp'))
+            seq = int(time.time() * 1000) * 1000
+            new_ids = sorted((ytb_id for ytb_id in set(ytb_ids) - existing),
+                             key=lambda ytb_id: -priorities.get(ytb_id, 0))
+            for i, ytb_id in enumerate(new_ids):
+                self._write(self._path('pending', f"{seq + i:016d}.{ytb_id}"),
+                            {'worker': None, 'lease_until': None, 'attempts': 0})
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS, skip=()):
+        with self._locked():
+            self._reclaim_expired(lease_seconds, max_attempts)
+            for name in sorted(os.listdir(os.path.join(self.root, 'pending'))):
+                if name.endswith('.tmp') or self._ytb_id(name) in skip:
+                    continue
+                pending_path = self._path('pending', name)
+                try:
+                    record = self._read(pending_path)
+                except (FileNotFoundError, ValueError):
+                    continue
+                record.update(worker=worker_id, lease_until=time.time() + lease_seconds,
+                              attempts=record['attempts'] + 1)
+                self._write(pending_path, record)
+                os.rename(pending_path, self._path('leased', name))
+                return self._ytb_id(name)
+        return None
+
+    def _reclaim_expired(self, lease_seconds, max_attempts):
+        # Called with the lock held
+        now = time.time()
+        for name in os.listdir(os.path.join(self.root, 'leased')):
+            if name.endswith('.tmp'):
+                continue
+            path = self._path('leased', name)
+            try:
+                record = self._read(path)
+                lease_until = record['lease_until']
+                if lease_until is None:
+                    # Moved by a claim of an older version that stopped before writing its lease
+                    lease_until = os.path.getmtime(path) + lease_seconds
+                if lease_until >= now:
+                    continue
+            except (FileNotFoundError, ValueError):
+                continue
+            target = 'failed' if record['attempts'] >= max_attempts else 'pending'
+            logging.warning(f"Lease of {self._ytb_id(name)} held by {record['worker']} expired"
+                            + (f", giving up after {record['attempts']} claims" if target == 'failed' else ""))
+            record.update(worker=None, lease_until=None)
+            self._write(path, record)
+            os.rename(path, self._path(target, name))
+
+    def _owned(self, ytb_id, worker_id):
+        name = self._find('leased', ytb_id)
+        if name is None:
+            return None, None
+        try:
+            record = self._read(self._path('leased', name))
+        except (FileNotFoundError, ValueError):
+            return None, None
+        return (name, record) if record['worker'] == worker_id else (None, None)
+
+    def renew(self, ytb_id, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        with self._locked():
+            name, record = self._owned(ytb_id, worker_id)
+            if name is None:
+                return False
+            record['lease_until'] = time.time() + lease_seconds
+            self._write(self._path('leased', name), record)
+            return True
+
+    def complete(self, ytb_id, worker_id):
+        # Completed work is recorded even if the lease expired in the meantime
+        with self._locked():
+            for state in ('leased', 'pending', 'failed'):
+                name = self._find(state, ytb_id)
+                if name is not None:
+                    os.rename(self._path(state, name), self._path('done', name))
+                    return
+
+    def fail(self, ytb_id, worker_id, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        with self._locked():
+            name, record = self._owned(ytb_id, worker_id)
+            if name is None:
+                return
+            record.update(worker=None, lease_until=None)
+            self._write(self._path('leased', name), record)
+            target = 'failed' if record['attempts'] >= max_attempts else 'pending'
+            os.rename(self._path('leased', name), self._path(target, name))
+
+    def release(self, ytb_id, worker_id):
+        with self._locked():
+            name, record = self._owned(ytb_id, worker_id)
+            if name is None:
+                return
+            record.update(worker=None, lease_until=None, attempts=max(0, record['attempts'] - 1))
+            self._write(self._path('leased', name), record)
+            os.rename(self._path('leased', name), self._path('pending', name))
+
+    def remaining(self, skip=()):
+        return sum(1 for state in ('pending', 'leased')
+                   for name in os.listdir(os.path.join(self.root, state))
+                   if not name.endswith('.tmp') and self._ytb_id(name) not in skip)
+
+
+def open_work_queue(spec):
+    """
+    Open a work queue from a spec string
+
+    Args:
+        spec: 'sqlite:<path to db file>' or 'dir:<path to shared directory>'
+    """
+    kind, _, path = spec.partition(':')
+    if kind == 'sqlite':
+        return SQLiteWorkQueue(path)
+    if kind == 'dir':
+        return DirectoryWorkQueue(path)
+    raise ValueError(f"Unknown work queue: {spec}")
+
+
+def iter_claims(work_queue, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS, poll_interval=DEFAULT_POLL_INTERVAL,
+                max_attempts=DEFAULT_MAX_ATTEMPTS, skip=None):
+    """
+    Claim ytb_ids one at a time until nothing is pending or leased anymore
+
+    Args:
+        skip: set of ytb_ids the worker does not claim, it may add to it between claims; the
+            iteration also ends when only those are left
+    """
+    skip = skip if skip is not None else set()
+    while True:
+        ytb_id = work_queue.claim(worker_id, lease_seconds, max_attempts, skip)
+        if ytb_id is not None:
+            yield ytb_id
+        elif work_queue.remaining(skip) == 0:
+            return
+        else:
+            # Everything left is leased by other workers, wait for it to finish or expire
+            time.sleep(poll_interval)
+
+
+class LeaseKeeper:
+    """
+    Renew a lease in the background while its ytb_id is being processed, as a context
+    manager or between start() and stop() when the lease outlives the processing
+    """
+
+    def __init__(self, work_queue, ytb_id, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.work_queue = work_queue
+        self.ytb_id = ytb_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._renew_loop, name=f"Lease-{ytb_id}", daemon=True)
+
+    def _renew_loop(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            try:
+                if not self.work_queue.renew(self.ytb_id, self.worker_id, self.lease_seconds):
+                    logging.warning(f"Lost lease of {self.ytb_id}, another worker may pick it up")
+                    self.lost = True
+                    return
+            except Exception as e:
+                logging.error(f"Failed to renew lease of {self.ytb_id}: {e}")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()